@@ -0,0 +1,348 @@
+import asyncio
+import contextlib
+import dataclasses
+import itertools
+import json
+import os
+import socket
+import stat
+import struct
+import tempfile
+import time
+import asyncclick as click
+from loguru import logger
+from typing import (
+    Any,
+    Dict,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from . import core as pcore
+from . import connector as pconn
+
+_socket_name = 'pilot-broker.sock'
+# a line is one whole request or response, which may carry a large output
+_line_limit = 2**26
+
+Target = Union[str, Tuple[Optional[str], str]]
+
+
+class BrokerError(Exception):
+    pass
+
+
+def _private_dir() -> str:
+    '''a directory only this user can enter, which keeps the socket
+
+    It is $XDG_RUNTIME_DIR, or pilot-<uid> in the temp directory, which is
+    world-writable, so another user may have made it first.
+    '''
+    path = os.environ.get('XDG_RUNTIME_DIR')
+    if not path:
+        path = os.path.join(tempfile.gettempdir(), f'pilot-{os.getuid()}')
+        with contextlib.suppress(FileExistsError):
+            os.mkdir(path, 0o700)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or (st.st_mode
+                                                                    & 0o077):
+        raise BrokerError(
+            f'{path} must be a directory of uid {os.getuid()} with mode 0700')
+    return path
+
+
+def default_path() -> str:
+    return os.path.join(_private_dir(), _socket_name)
+
+
+def _peer_uid(sock: socket.socket) -> Optional[int]:
+    '''uid of the other end of a unix socket, None if it is unknown'''
+    if hasattr(socket, 'SO_PEERCRED'):
+        # struct ucred of Linux: pid, uid, gid
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[1]
+    if hasattr(socket, 'LOCAL_PEERCRED'):
+        # struct xucred of BSD and macOS: version, uid, ...
+        creds = sock.getsockopt(0, socket.LOCAL_PEERCRED,
+                                struct.calcsize('Ii'))
+        return struct.unpack('Ii', creds)[1]
+    return None
+
+
+def _check_peer(writer: asyncio.StreamWriter) -> None:
+    uid = _peer_uid(writer.get_extra_info('socket'))
+    if uid is None:
+        # only the mode of the directory guards it
+        logger.debug('Cannot tell the uid of the peer on this platform')
+    elif uid != os.getuid():
+        raise BrokerError(f'Peer of uid {uid} is not this user')
+
+
+class Broker:
+    '''Serve run and scp of other processes by a long-lived client pool.
+
+    Requests and responses are JSON lines on a unix socket, matched by id,
+    so one socket can carry concurrent requests. Connections stay in the
+    pool between requests, so later requests skip the SSH handshake. The
+    broker stops after idle_timeout seconds without any request.
+
+    Only processes of the same user are served, which is checked by the
+    credentials of the peer, and the socket is 0600 in a 0700 directory.
+    '''
+    def __init__(self,
+                 pool: pcore.ClientCachedPool,
+                 path: Optional[str] = None,
+                 idle_timeout: Optional[float] = 600) -> None:
+        self._pool = pool
+        self._path = path or default_path()
+        self._idle_timeout = idle_timeout
+        self._in_flight = 0
+        self._last_active = time.monotonic()
+        self._stop = asyncio.Event()
+        self._writers = set()
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self._path} in_flight={self._in_flight}>'
+
+    async def _remove_stale_socket(self) -> None:
+        if not os.path.exists(self._path):
+            return
+        try:
+            _, writer = await asyncio.open_unix_connection(self._path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(self._path)
+            return
+        writer.close()
+        raise click.UsageError(f'Another broker is serving on {self._path}')
+
+    async def serve(self) -> None:
+        await self._remove_stale_socket()
+        # the socket is 0600 from the start, not after a chmod
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle,
+                                                     path=self._path,
+                                                     limit=_line_limit)
+        finally:
+            os.umask(umask)
+        logger.info('{} started', self)
+        try:
+            async with server:
+                await self._wait_stop()
+                # the server waits for connections of clients to close
+                for writer in self._writers:
+                    writer.close()
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path)
+            logger.info('{} stopped', self)
+
+    async def _wait_stop(self) -> None:
+        while not self._stop.is_set():
+            timeout = self._idle_timeout
+            if timeout is not None and self._in_flight == 0:
+                idle = time.monotonic() - self._last_active
+                if idle >= self._idle_timeout:
+                    logger.info('{} is idle for {:.0f}s', self, idle)
+                    return
+                timeout -= idle
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._stop.wait(), timeout=timeout)
+
+    def shutdown(self) -> None:
+        self._stop.set()
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        try:
+            _check_peer(writer)
+        except BrokerError as e:
+            logger.warning('{} refused a connection, due to {}', self, e)
+            writer.close()
+            return
+        tasks = set()
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(self._respond(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, line: bytes,
+                       writer: asyncio.StreamWriter) -> None:
+        self._in_flight += 1
+        self._last_active = time.monotonic()
+        request = {}
+        try:
+            request = json.loads(line)
+            response = {'result': await self._dispatch(request)}
+        except Exception as e:
+            logger.debug('{} failed on {}, due to {}', self, request, e)
+            response = {'error': str(e), 'type': e.__class__.__name__}
+        finally:
+            self._in_flight -= 1
+            self._last_active = time.monotonic()
+        response['id'] = request.get('id')
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+
+    async def _target(self, target) -> Any:
+        if isinstance(target, list):
+            client_name, path = target
+            return await self._pool.get_client(client_name), path
+        return target
+
+    async def _dispatch(self, request: Dict[str, Any]) -> Any:
+        op = request['op']
+        if op == 'ping':
+            return os.getpid()
+        elif op == 'run':
+            client = await self._pool.get_client(request['client'])
+            # undecodable bytes survive JSON, the caller decodes them back
+            res = await client.run(*request['args'],
+                                   check=False,
+                                   errors='surrogateescape',
+                                   **request['kwargs'])
+            return {
+                'stdout': res.stdout,
+                'stderr': res.stderr,
+                'exit_status': res.exit_status,
+            }
+        elif op == 'scp':
+            source = await self._target(request['source'])
+            destination = await self._target(request['destination'])
+            stat = await pcore.ShellClient.scp(source, destination,
+                                               **request['kwargs'])
+            return dataclasses.asdict(stat)
+        elif op == 'close':
+            client = await self._pool.get_client(request['client'])
+            await client.close_all()
+            return None
+        elif op == 'metrics':
+            return pconn.metrics_registry.to_dict()
+        elif op == 'shutdown':
+            self.shutdown()
+            return None
+        raise BrokerError(f'Unknown op: {op}')
+
+
+class BrokerClient:
+    '''Send requests to a Broker, use it by async with.'''
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._path = path or default_path()
+        self._ids = itertools.count()
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self._path}>'
+
+    async def __aenter__(self) -> 'BrokerClient':
+        self._reader, self._writer = await asyncio.open_unix_connection(
+            self._path, limit=_line_limit)
+        try:
+            # commands and their results go to whoever made the socket
+            _check_peer(self._writer)
+        except BrokerError:
+            self._writer.close()
+            raise
+        self._read_task = asyncio.create_task(self._read_responses())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb) -> None:
+        self._writer.close()
+        self._read_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._read_task
+
+    async def _read_responses(self) -> None:
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                fut = self._waiters.pop(response['id'], None)
+                if fut is not None and not fut.done():
+                    fut.set_result(response)
+        finally:
+            for fut in self._waiters.values():
+                if not fut.done():
+                    fut.set_exception(
+                        ConnectionError(f'{self} lost the broker'))
+            self._waiters.clear()
+
+    async def _request(self, op: str, **kwargs) -> Any:
+        request_id = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = fut
+        self._writer.write(
+            json.dumps(dict(id=request_id, op=op, **kwargs)).encode() + b'\n')
+        await self._writer.drain()
+        response = await fut
+        if 'error' in response:
+            raise BrokerError(f'{response["type"]}: {response["error"]}')
+        return response['result']
+
+    async def ping(self) -> int:
+        '''pid of the broker'''
+        return await self._request('ping')
+
+    async def run(self,
+                  client_name: str,
+                  *args,
+                  check: bool = True,
+                  encoding: Optional[str] = 'utf-8',
+                  errors: str = 'strict',
+                  **kwargs) -> pconn.CmdRunResult:
+        if pconn.Connection._has_redirection(kwargs):
+            raise click.UsageError('Cannot redirect output through broker')
+        logger.log('CMD', '{} run on {}: <{}>', self, client_name, args)
+        origin = await self._request('run',
+                                     client=client_name,
+                                     args=args,
+                                     kwargs=kwargs)
+        res = pconn.CmdRunResult(args,
+                                 kwargs,
+                                 pconn.CompletedOrigin(**origin),
+                                 check=check,
+                                 encoding=encoding,
+                                 errors=errors)
+        res.check_raise()
+        return res
+
+    async def scp(self, source: Target, destination: Target,
+                  **kwargs) -> pconn.TransferStat:
+        def target(t):
+            if isinstance(t, tuple):
+                return t
+            # the broker may run in another directory
+            return os.path.abspath(t)
+
+        stat = await self._request('scp',
+                                   source=target(source),
+                                   destination=target(destination),
+                                   kwargs=kwargs)
+        return pconn.TransferStat(**stat)
+
+    async def close(self, client_name: str) -> None:
+        '''close connections of the client in the broker'''
+        await self._request('close', client=client_name)
+
+    async def metrics(self) -> Dict[str, Any]:
+        '''metrics of connections in the broker, by hosts'''
+        return await self._request('metrics')
+
+    async def shutdown(self) -> None:
+        await self._request('shutdown')
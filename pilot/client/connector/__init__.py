@@ -14,6 +14,7 @@ from .result import (
     ExitStatusNotSuccess,
     RunResult,
     CmdRunResult,
+    CompletedOrigin,
 )
 from .agent import (
     ConnectAgent,
@@ -24,9 +25,34 @@ from .connector import (
     Connector,
     ConnectorCachedPool,
 )
+from .limit import (
+    Priority,
+    priority,
+    current_priority,
+    Limiter,
+    TokenBucket,
+    Admission,
+)
+from .channel import (
+    ChannelPool, )
+from .file import (
+    AsyncFile, )
+from .metrics import (
+    Histogram,
+    HostMetrics,
+    MetricsRegistry,
+    registry as metrics_registry,
+)
+from .buffer import (
+    SpillBuffer, )
+from .transfer import (
+    Transfer,
+    TransferStat,
+)
 from .connection import (
     Connection,
     RemoteConnection,
+    LazyConnection,
 )
 from .subprocess import (
     SubprocessAgent, )
@@ -34,9 +60,16 @@ from .asyncssh import (
     AsyncsshAgent,
     AsyncsshConnection,
     AsyncsshRootAgent,
+    load_pub_key,
+    authorize_key,
+    provision_key,
 )
 from .expect import (
     ExpectAgent, )
+from .address import (
+    LocalAddressIndex,
+    local_addresses,
+)
 from .shell import (
     AutoShellAgent, )
 
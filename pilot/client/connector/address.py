@@ -0,0 +1,102 @@
+import asyncio
+import time
+from loguru import logger
+from typing import (
+    Callable,
+    FrozenSet,
+    Optional,
+)
+
+
+def interface_addresses() -> FrozenSet[str]:
+    '''addresses of local interfaces, listing them shells out'''
+    import ifcfg
+
+    addresses = {'localhost'}
+    for interface in ifcfg.interfaces().values():
+        addresses.update(interface.get('inet4') or ())
+        addresses.update(interface.get('inet6') or ())
+    return frozenset(addresses)
+
+
+class LocalAddressIndex:
+    '''Set of local addresses, which tells whether a host is this one.
+
+    The set is built at the first lookup, then rebuilt in the background at
+    the first lookup after refresh_interval seconds, or at once by refresh.
+    Lookups in the meantime use the last set, so each of them is a set
+    lookup instead of listing interfaces.
+    '''
+    def __init__(
+            self,
+            refresh_interval: Optional[float] = 300,
+            load: Callable[[], FrozenSet[str]] = interface_addresses) -> None:
+        self._refresh_interval = refresh_interval
+        self._load = load
+        self._addresses: Optional[FrozenSet[str]] = None
+        self._built_at: Optional[float] = None
+        # created in the running loop, the index is made at import
+        self._lock: Optional[asyncio.Lock] = None
+        self._refreshing: Optional[asyncio.Task] = None
+        # seconds which the last build took
+        self.build_time: float = 0
+        # times which the set is built, including the first one
+        self.refresh_count: int = 0
+
+    def __repr__(self) -> str:
+        size = None if self._addresses is None else len(self._addresses)
+        return f'<{self.__class__.__name__} addresses={size} refresh_count={self.refresh_count} build_time={self.build_time:.3f}s>'
+
+    @property
+    def stale(self) -> bool:
+        if self._built_at is None:
+            return True
+        if self._refresh_interval is None:
+            return False
+        return time.monotonic() - self._built_at >= self._refresh_interval
+
+    async def _build(self) -> FrozenSet[str]:
+        start = time.monotonic()
+        # ifcfg runs ifconfig or ip, which blocks
+        addresses = await asyncio.get_running_loop().run_in_executor(
+            None, self._load)
+        self._built_at = time.monotonic()
+        self.build_time = self._built_at - start
+        self._addresses = addresses
+        self.refresh_count += 1
+        logger.debug('{} is built', self)
+        return addresses
+
+    @property
+    def _build_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def refresh(self) -> FrozenSet[str]:
+        async with self._build_lock:
+            return await self._build()
+
+    def _on_refreshed(self, task: asyncio.Task) -> None:
+        self._refreshing = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning('{} failed to refresh, due to {}', self,
+                           task.exception())
+
+    async def get(self) -> FrozenSet[str]:
+        if self._addresses is None:
+            # concurrent first lookups wait for one build
+            async with self._build_lock:
+                if self._addresses is None:
+                    await self._build()
+        elif self.stale and self._refreshing is None:
+            self._refreshing = asyncio.create_task(self.refresh())
+            self._refreshing.add_done_callback(self._on_refreshed)
+        return self._addresses
+
+    async def is_local(self, host: str) -> bool:
+        return host in await self.get()
+
+
+# shared by connects of all clients
+local_addresses = LocalAddressIndex()
@@ -14,7 +14,9 @@ from . import level as plevel
 from . import info as pinfo
 from . import connector as pconn
 from . import connection as pconnection
+from . import limit as plimit
 from pilot import utils
+from pilot import trace as ptrace
 
 Conn = TypeVar('Conn', bound=pconnection.Connection)
 
@@ -33,6 +35,7 @@ class ConnectAgent(ABC, Generic[Conn]):
                       *args,
                       log: bool = True,
                       connector: Optional[pconn.Connector] = None,
+                      admission: Optional[plimit.Admission] = None,
                       **kwargs):
         if not hasattr(cls, 'required_enter_info_type'):
             raise NotImplementedError(
@@ -52,7 +55,20 @@ class ConnectAgent(ABC, Generic[Conn]):
         cm = cls._handle_context_log(
             enter_info) if log is True else contextlib.nullcontext()
         with cm:
-            async with cls._connect(enter_info, *args, **kwargs) as conn:
+            async with contextlib.AsyncExitStack() as stack:
+                # the span ends once connected, not when it is closed
+                with ptrace.span('connect',
+                                 agent=cls.__name__,
+                                 host=getattr(enter_info, 'host', None)):
+                    # because of no nullcontext for async
+                    admitted = contextlib.AsyncExitStack(
+                    ) if admission is None else admission.slot()
+                    async with admitted:
+                        conn = await stack.enter_async_context(
+                            cls._connect(enter_info, *args, **kwargs))
+                if admission is not None:
+                    # commands of the connection are admitted by it too
+                    conn.admission = admission
                 yield conn
 
     @classmethod
@@ -1,53 +1,203 @@
+import asyncio
+import codecs
 import contextlib
+import functools
+import io
 import os
+import shlex
+import stat as pstat
 import asyncssh
 import dataclasses
 import asyncclick as click
 from loguru import logger
+from typing import Optional
 
 from . import subprocess as pproc
 from . import expect as pexp
 from . import result as pres
 from . import agent as pagent
 from . import connection as pconn
+from . import channel as pchan
+from . import transfer as ptrans
+from . import buffer as pbuffer
+from . import info as pinfo
+from . import limit as plimit
+from . import metrics as pmetrics
+
+
+class _TextTarget:
+    '''text file which output of a binary mode process is decoded for'''
+    def __init__(self, file, encoding: str = 'utf-8') -> None:
+        self._file = file
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+
+    def fileno(self) -> int:
+        # asyncssh writes to it by write then, not by its fd
+        raise io.UnsupportedOperation('fileno')
+
+    def write(self, data: bytes) -> None:
+        self._file.write(self._decoder.decode(data))
+
+    def close(self) -> None:
+        tail = self._decoder.decode(b'', final=True)
+        if tail:
+            self._file.write(tail)
+        self._file.close()
+
+
+def _is_text_file(target) -> bool:
+    '''whether asyncssh writes str to target in text mode, which it does
+    to text files unless they are written by fd as a pipe or tty'''
+    if not hasattr(target, 'write') or not hasattr(target, 'encoding'):
+        return False
+    try:
+        return pstat.S_ISREG(os.fstat(target.fileno()).st_mode)
+    except OSError:
+        return True
 
 
 class AsyncsshConnection(pconn.RemoteConnection):
     result_cls = pres.CmdRunResult
 
-    def __init__(self, conn, **kwargs):
+    def __init__(self,
+                 pool: pchan.ChannelPool,
+                 max_tunnel_opens: Optional[int] = None,
+                 **kwargs):
         super().__init__(**kwargs)
-        self._conn = conn
+        self._pool = pool
+        # hosts which tunnel over this connection open their channels by it
+        self.tunnel_limiter = plimit.Limiter(max_tunnel_opens)
 
     @property
     def origin(self):
-        return self._conn
+        return self._pool.primary
+
+    @property
+    def pool(self) -> pchan.ChannelPool:
+        return self._pool
+
+    @property
+    def is_alive(self) -> bool:
+        # without a transport, it is reconnected instead of waiting for the
+        # next channel to reopen one
+        return not self._pool.broken and self._pool.has_transport
+
+    @staticmethod
+    def _to_command(argv):
+        # a list is argv, which is quoted for the remote shell
+        if argv and isinstance(argv[0], (list, tuple)):
+            return (shlex.join(argv[0]), *argv[1:])
+        return argv
+
+    @staticmethod
+    def _binary_kwargs(kwargs):
+        '''kwargs of create_process in binary mode, which only takes bytes
+        input and writes bytes to redirected output'''
+        kwargs = dict(kwargs)
+        if isinstance(kwargs.get('input'), str):
+            kwargs['input'] = kwargs['input'].encode()
+        for name in ('stdout', 'stderr'):
+            if _is_text_file(kwargs.get(name)):
+                kwargs[name] = _TextTarget(kwargs[name])
+        return kwargs
 
     async def _run(self, *argv, **kwargs):
-        try:
-            return await self._conn.run(*argv, **kwargs)
-        except asyncssh.misc.ChannelOpenError as e:
-            # TODO:
-            pass
+        argv = self._to_command(argv)
+        kwargs = self._binary_kwargs(kwargs)
+
+        async def run(conn):
+            process = await conn.create_process(*argv, encoding=None, **kwargs)
+            try:
+                stdout, stderr = await asyncio.gather(
+                    self._read_output(process.stdout, 'stdout' in kwargs),
+                    self._read_output(process.stderr, 'stderr' in kwargs))
+                completed = await process.wait()
+            finally:
+                process.close()
+            no_exit = completed.exit_status is None and completed.exit_signal is None
+            if no_exit and conn.is_closed():
+                raise pchan.TransportLost(
+                    f'{self} lost transport while running {argv}')
+            return pres.CompletedOrigin(stdout=stdout,
+                                        stderr=stderr,
+                                        exit_status=completed.exit_status)
+
+        return await self._pool.call(run)
+
+    async def _read_output(self, reader, redirected):
+        # redirected output is written by asyncssh itself
+        if redirected:
+            return None
+        return await pbuffer.read_into(reader, self.spill_threshold)
+
+    @contextlib.asynccontextmanager
+    async def _stream(self, *argv, **kwargs):
+        argv = self._to_command(argv)
+        kwargs = self._binary_kwargs(kwargs)
+        async with self._pool.open(lambda conn: conn.create_process(
+                *argv, encoding=None, **kwargs)) as process:
+
+            async def wait():
+                completed = await process.wait()
+                return completed.exit_status
+
+            stdout = None if 'stdout' in kwargs else process.stdout
+            stderr = None if 'stderr' in kwargs else process.stderr
+            yield stdout, stderr, wait, process.close
+
+    @contextlib.asynccontextmanager
+    async def _open_shell(self):
+        async with self._pool.open(lambda conn: conn.create_process(
+                '/bin/sh', encoding=None)) as process:
+
+            async def wait():
+                completed = await process.wait()
+                return completed.exit_status
+
+            try:
+                yield process.stdin, process.stdout, process.stderr, wait
+            finally:
+                process.close()
+                await process.wait_closed()
+
+    @contextlib.asynccontextmanager
+    async def sftp(self):
+        async with self._pool.open(
+                lambda conn: conn.start_sftp_client()) as sftp:
+            async with sftp:
+                yield sftp
+
+    @contextlib.asynccontextmanager
+    async def _open_file(self, path, mode):
+        async with self.sftp() as sftp:
+            async with ptrans.SFTPFileSystem(sftp, str(self)).open(path,
+                                                                   mode) as f:
+                yield f
 
     @staticmethod
-    async def scp(source, destination, **kwargs):
-        def get_path(target):
+    async def scp(source, destination, **kwargs) -> ptrans.TransferStat:
+        async def get_fs(target, stack):
             if not isinstance(target, tuple):
                 target = (None, target)
 
             conn, path = target
+            if isinstance(conn, pconn.LazyConnection):
+                conn = await conn.get()
             if isinstance(conn, AsyncsshConnection):
-                return (conn.origin, path), f'{conn}:{path}'
+                sftp = await stack.enter_async_context(conn.sftp())
+                return ptrans.SFTPFileSystem(sftp, str(conn)), path
             elif isinstance(conn, pproc.SubprocessConnection) or conn is None:
-                return path, path
-            raise pconn.UsageError(f'Not support {conn.__class__.__name__}')
+                return ptrans.LocalFileSystem(), path
+            raise click.UsageError(f'Not support {conn.__class__.__name__}')
 
-        sinfo, sstr = get_path(source)
-        dinfo, dstr = get_path(destination)
-        logger.info(f'Start to scp {sstr} to {dstr}')
-        await asyncssh.scp(sinfo, dinfo, **kwargs)
-        logger.info(f'Success to scp {sstr} to {dstr}')
+        async with contextlib.AsyncExitStack() as stack:
+            sfs, spath = await get_fs(source, stack)
+            dfs, dpath = await get_fs(destination, stack)
+            logger.info(f'Start to scp {sfs}:{spath} to {dfs}:{dpath}')
+            stat = await ptrans.Transfer(sfs, dfs, **kwargs).copy(spath, dpath)
+            logger.info(
+                f'Success to scp {sfs}:{spath} to {dfs}:{dpath}: {stat}')
+        return stat
 
 
 class AsyncsshAgent(pagent.ConnectRemoteAgent):
@@ -55,32 +205,133 @@ class AsyncsshAgent(pagent.ConnectRemoteAgent):
 
     @classmethod
     @contextlib.asynccontextmanager
-    async def _connect(cls, enter_info, **kwargs):
+    async def _connect(cls,
+                       enter_info,
+                       tunnel=None,
+                       max_tunnel_opens=32,
+                       max_sessions=10,
+                       max_transports=1,
+                       keepalive_interval=15,
+                       keepalive_count_max=3,
+                       reconnect_max=5,
+                       reconnect_interval=1,
+                       **kwargs):
         connection_info = {
             'port': enter_info.port,
             'username': enter_info.username
         }
         ssh_kwargs = connection_info.copy()
+        # a dead transport is found after keepalive_interval * keepalive_count_max
+        ssh_kwargs['keepalive_interval'] = keepalive_interval
+        ssh_kwargs['keepalive_count_max'] = keepalive_count_max
 
         pwd = enter_info.password
         if pwd is not None:
             ssh_kwargs['password'] = pwd
 
+        def open_transport():
+            if tunnel is None:
+                return asyncssh.connect(enter_info.host,
+                                        known_hosts=None,
+                                        **ssh_kwargs)
+            return _open_tunneled(tunnel, enter_info.host, ssh_kwargs)
+
         # TODO:
         # when connect fail, check reason and handle it.
         # case 1: the ip is not available
         # case 2: whthout authorized key
         try:
-            async with asyncssh.connect(enter_info.host,
-                                        known_hosts=None,
-                                        **ssh_kwargs) as conn:
+            async with pchan.ChannelPool(open_transport,
+                                         max_sessions=max_sessions,
+                                         max_transports=max_transports,
+                                         reconnect_max=reconnect_max,
+                                         reconnect_interval=reconnect_interval,
+                                         metrics=pmetrics.registry.host(
+                                             enter_info.host)) as pool:
+                await pool.add_transport()
                 connection_info['host'] = enter_info.host
                 kwargs.update(connection_info)
-                yield AsyncsshConnection(conn, **kwargs)
+                conn = AsyncsshConnection(pool,
+                                          max_tunnel_opens=max_tunnel_opens,
+                                          **kwargs)
+                try:
+                    yield conn
+                finally:
+                    await conn.aclose()
         except (OSError, ConnectionRefusedError) as e:
             raise click.UsageError(f'Failed to connect, due to {e}') from e
 
 
+@contextlib.asynccontextmanager
+async def _open_tunneled(tunnel, host, ssh_kwargs):
+    '''transport to host over the primary transport of tunnel
+
+    A dead tunnel is reconnected by its LazyConnection, a closed transport
+    of it is reopened by its pool, and the channel is opened in a slot of
+    tunnel, so hosts behind one bastion do not flood it with handshakes at
+    once.
+    '''
+    if isinstance(tunnel, pconn.LazyConnection):
+        tunnel = await tunnel.get()
+    if not isinstance(tunnel, AsyncsshConnection):
+        raise click.UsageError(
+            f'Cannot tunnel over {tunnel.__class__.__name__}')
+    async with tunnel.tunnel_limiter.slot():
+        bastion = await tunnel.pool.transport()
+        transport = await asyncssh.connect(host,
+                                           known_hosts=None,
+                                           tunnel=bastion,
+                                           **ssh_kwargs)
+    async with transport:
+        yield transport
+
+
+_default_pub_key_path = '~/.ssh/id_rsa.pub'
+
+
+@functools.lru_cache(maxsize=None)
+def load_pub_key(path: Optional[str] = None) -> str:
+    '''local public key, which is read once for all hosts'''
+    with open(os.path.expanduser(path or _default_pub_key_path)) as f:
+        return f.read().strip()
+
+
+async def authorize_key(conn: pconn.Connection,
+                        pub_key: str,
+                        auth_dir: str = '~/.ssh') -> bool:
+    '''add pub_key to authorized_keys unless it is there, in one round trip
+
+    Return whether it is added.
+    '''
+    key = shlex.quote(pub_key)
+    path = f'{auth_dir}/authorized_keys'
+    res = await conn.run(
+        f'umask 077; mkdir -p {auth_dir} && '
+        f'if grep -qxF {key} {path} 2>/dev/null; then echo present; '
+        f'else echo {key} >> {path} && echo added; fi')
+    return res.stdout.strip() == 'added'
+
+
+async def provision_key(connector,
+                        enter_info: pinfo.LoginSSHInfo,
+                        pub_key: str,
+                        tunnel: Optional[pconn.Connection] = None) -> bool:
+    '''authorize pub_key on the host of enter_info by its password'''
+    if tunnel is None:
+        tunnel = await connector.connect_by_agent(pproc.SubprocessAgent)
+    # not to be mistaken for the ssh connection of the same host
+    conn_info = pinfo.ConnectInfo(force_id=f'expect:{enter_info.info_str}',
+                                  enter_info=enter_info)
+    conn = await connector.connect_by_agent(pexp.ExpectAgent,
+                                            info=conn_info,
+                                            tunnel=tunnel)
+    try:
+        return await authorize_key(conn, pub_key)
+    finally:
+        # the login session is useless once the key works
+        await connector.close(conn_info)
+
+
 class AsyncsshRootAgent(AsyncsshAgent):
     pass_connector = True
 
@@ -91,7 +342,7 @@ class AsyncsshRootAgent(AsyncsshAgent):
         async def _connect(key_set):
             try:
                 if enter_info.username != 'root':
-                    logger.waring(
+                    logger.warning(
                         'Detected that username ({}) is not root on AsyncsshRootAgent, so changed to root',
                         enter_info.username)
                     root_enter_info = dataclasses.replace(enter_info,
@@ -110,34 +361,17 @@ class AsyncsshRootAgent(AsyncsshAgent):
                     'Happened permission denied, so try to setup ssh key by expect. Then retry again'
                 )
 
-                local = await connector.connect(pproc.SubprocessAgent)
-
-                tunnel = kwargs.get('tunnel', local)
-                bridge_expect = await connector.connect(pexp.ExpectAgent,
-                                                        enter_info,
-                                                        tunnel=tunnel)
-
-                res = await local.run('/bin/echo "$HOME"')
-                home = res.stdout.strip()
-                ssh_config_dir = os.path.join(home, '.ssh')
-
-                res = await local.run(f'hostname')
-                hostname = res.stdout.strip()
-
-                ssh_pub_key_path = os.path.join(ssh_config_dir, 'id_rsa.pub')
-                res = await local.run(f'/bin/cat {ssh_pub_key_path}')
-                pub_key = res.stdout.strip()
-
-                target_auth_dir = '/root/.ssh'
-                target_auth_path = f'{target_auth_dir}/authorized_keys'
-                await bridge_expect.run(
-                    f'test -d {target_auth_dir} || mkdir {target_auth_dir}',
-                    redirect_tty=True)
-                await bridge_expect.run(
-                    f'grep -q {hostname} {target_auth_path} 2>/dev/null || echo \'{pub_key}\' >> {target_auth_path}',
-                    redirect_tty=True)
-                logger.warning('{}\'s {} was setuped: {}', enter_info,
-                               target_auth_path, pub_key)
+                # expect runs on the bastion of a jump host
+                tunnel = kwargs.get('tunnel')
+                if isinstance(tunnel, pconn.LazyConnection):
+                    tunnel = await tunnel.get()
+                added = await provision_key(connector,
+                                            root_enter_info,
+                                            load_pub_key(),
+                                            tunnel=tunnel)
+                logger.warning('{}\'s authorized_keys was setuped: {}',
+                               root_enter_info,
+                               'added' if added else 'present')
 
                 logger.warning('Retry to connect {} again', enter_info)
                 async with _connect(True) as conn:
@@ -0,0 +1,79 @@
+import re
+import uuid
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+)
+
+from . import result as pres
+
+
+class Batch:
+    '''Join commands into one script and split its output back per command.
+
+    Every command runs in its own subshell between begin/end markers, the
+    end marker of stdout also carries the exit status of the command.
+    '''
+    def __init__(self, cmds: Iterable[str]) -> None:
+        self._cmds: List[str] = list(cmds)
+        self._marker = f'__pilot_batch_{uuid.uuid4().hex}'
+
+    def __len__(self) -> int:
+        return len(self._cmds)
+
+    @property
+    def cmds(self) -> List[str]:
+        return self._cmds
+
+    @property
+    def script(self) -> str:
+        m = self._marker
+        lines = []
+        for i, cmd in enumerate(self._cmds):
+            lines.append(f"printf '{m}:{i}:B\\n'; printf '{m}:{i}:B\\n' >&2")
+            # newline before ')' in case cmd ends with a comment
+            lines.append(f'( {cmd}\n)')
+            lines.append(f"printf '\\n{m}:{i}:E:%d\\n' $?; "
+                         f"printf '\\n{m}:{i}:E\\n' >&2")
+        return '\n'.join(lines)
+
+    def _parse(self, output) -> Dict[int, re.Match]:
+        '''output is bytes-like, which is not decoded as a whole'''
+        if output is None:
+            return {}
+        m = re.escape(self._marker)
+        pattern = f'{m}:(?P<i>[0-9]+):B\n(?P<out>.*?)\n{m}:(?P=i):E(:(?P<status>-?[0-9]+))?\n'
+        return {
+            int(match.group('i')): match
+            for match in re.finditer(pattern.encode(), output, re.DOTALL)
+        }
+
+    def split(self,
+              result: pres.CmdRunResult,
+              kwargs: Dict[str, Any],
+              connection=None,
+              check: bool = True,
+              encoding: Optional[str] = 'utf-8',
+              errors: str = 'strict') -> List[pres.CmdRunResult]:
+        outs = self._parse(result.stdout_view)
+        errs = self._parse(result.stderr_view)
+        results = []
+        for i, cmd in enumerate(self._cmds):
+            out = outs.get(i)
+            err = errs.get(i)
+            origin = pres.CompletedOrigin(
+                stdout=None if out is None else out.group('out'),
+                stderr=None if err is None else err.group('out'),
+                exit_status=None if out is None else int(out.group('status')))
+            results.append(
+                pres.CmdRunResult((cmd, ),
+                                  kwargs,
+                                  origin,
+                                  connection=connection,
+                                  check=check,
+                                  encoding=encoding,
+                                  errors=errors))
+        return results
@@ -0,0 +1,85 @@
+import mmap
+import tempfile
+from typing import (
+    Optional,
+    Union,
+)
+
+default_spill_threshold = 1024 * 1024
+_chunk_size = 65536
+
+
+class SpillBuffer:
+    '''Output which is kept in memory until threshold, then in a temp file.
+
+    view is a bytes-like object of the whole output, a memoryview while it is
+    in memory or a read-only mmap of the temp file.
+    '''
+    def __init__(self, threshold: int = default_spill_threshold) -> None:
+        self._threshold = threshold
+        self._memory = bytearray()
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._size = 0
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} size={self._size} spilled={self.spilled}>'
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def write(self, data: bytes) -> None:
+        if self._mmap is not None:
+            raise RuntimeError(f'{self} is already viewed')
+        if self._file is None and len(
+                self._memory) + len(data) > self._threshold:
+            self._file = tempfile.TemporaryFile(prefix='pilot_output_')
+            self._file.write(self._memory)
+            self._memory = bytearray()
+        if self._file is None:
+            self._memory += data
+        else:
+            self._file.write(data)
+        self._size += len(data)
+
+    @property
+    def view(self) -> Union[memoryview, mmap.mmap]:
+        if self._file is None:
+            return memoryview(self._memory)
+        if self._mmap is None:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(),
+                                   0,
+                                   access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def decode(self, encoding: str = 'utf-8', errors: str = 'strict') -> str:
+        return str(self.view, encoding, errors)
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a view of it is still used, it is closed when dropped
+                return
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+
+    def __del__(self) -> None:
+        self.close()
+
+
+async def read_into(reader,
+                    threshold: int = default_spill_threshold) -> SpillBuffer:
+    buf = SpillBuffer(threshold)
+    while True:
+        chunk = await reader.read(_chunk_size)
+        if not chunk:
+            return buf
+        buf.write(chunk)
@@ -0,0 +1,274 @@
+import asyncio
+import contextlib
+import asyncssh
+from loguru import logger
+from typing import (
+    Any,
+    AsyncContextManager,
+    Callable,
+    List,
+    Optional,
+)
+
+from . import limit as plimit
+from . import connector as pconnector
+from . import metrics as pmetrics
+
+
+class TransportLost(ConnectionError):
+    '''the transport is closed while its channel is running'''
+
+
+class _Transport:
+    def __init__(self, conn, limit: int) -> None:
+        self.conn = conn
+        self.limit = limit
+        self.in_flight = 0
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.in_flight}/{self.limit}>'
+
+    @property
+    def available(self) -> bool:
+        return self.in_flight < self.limit
+
+    @property
+    def closed(self) -> bool:
+        return self.conn.is_closed()
+
+
+class ChannelPool(contextlib.AsyncExitStack):
+    '''Schedule channels of one host over one or more SSH transports.
+
+    Each transport runs at most max_sessions channels at once (sshd's
+    MaxSessions). When all of them are busy, another transport is opened
+    until max_transports, after that callers wait by priority class, then
+    in FIFO order.
+
+    A closed transport is dropped. When all of them are closed, the next
+    caller reopens one with backoff, and the pool is broken if it fails.
+    '''
+    def __init__(self,
+                 open_transport: Callable[[], AsyncContextManager],
+                 max_sessions: int = 10,
+                 max_transports: int = 1,
+                 reconnect_max: int = 5,
+                 reconnect_interval: float = 1,
+                 reconnect_max_interval: float = 30,
+                 metrics: Optional[pmetrics.HostMetrics] = None) -> None:
+        super().__init__()
+        if max_sessions < 1 or max_transports < 1:
+            raise ValueError(
+                f'max_sessions({max_sessions}) and max_transports({max_transports}) must be positive'
+            )
+        self._open_transport = open_transport
+        self._max_sessions = max_sessions
+        self._max_transports = max_transports
+        self._transports: List[_Transport] = []
+        self._opening = 0
+        self._queue = plimit.WaitQueue()
+        self._reconnect_backoff = dict(retry_max=reconnect_max,
+                                       interval=reconnect_interval,
+                                       max_interval=reconnect_max_interval)
+        self._broken = False
+        self._metrics = metrics or pmetrics.HostMetrics('unknown')
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} transports={self._transports} waiting={self.waiting}>'
+
+    @property
+    def primary(self):
+        self._drop_closed()
+        if not self._transports:
+            raise RuntimeError(f'{self} has no transport')
+        return self._transports[0].conn
+
+    @property
+    def has_transport(self) -> bool:
+        '''whether a transport is open or being opened'''
+        self._drop_closed()
+        return bool(self._transports) or self._opening > 0
+
+    async def transport(self):
+        '''a live transport, which is reopened if all of them are closed'''
+        self._drop_closed()
+        if self._transports:
+            return self._transports[0].conn
+        # no slot is kept, as the caller opens no session channel by it
+        transport = await self._acquire()
+        self._release(transport)
+        return transport.conn
+
+    @property
+    def transport_num(self) -> int:
+        return len(self._transports)
+
+    @property
+    def in_flight(self) -> int:
+        return sum(t.in_flight for t in self._transports)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._queue)
+
+    @property
+    def broken(self) -> bool:
+        return self._broken
+
+    async def add_transport(self) -> _Transport:
+        self._opening += 1
+        try:
+            with self._metrics.time('connect'):
+                conn = await self.enter_async_context(self._open_transport())
+        finally:
+            self._opening -= 1
+        transport = _Transport(conn, self._max_sessions)
+        self._transports.append(transport)
+        logger.debug('{} opened transport {}', self, len(self._transports))
+        return transport
+
+    async def _reopen_transport(self) -> _Transport:
+        delays = pconnector.backoff(**self._reconnect_backoff)
+        # count it as opening while sleeping, so nobody else opens one
+        self._opening += 1
+        try:
+            while True:
+                try:
+                    transport = await self.add_transport()
+                    break
+                except (OSError, asyncssh.Error) as e:
+                    delay = next(delays, None)
+                    if delay is None:
+                        raise
+                    logger.warning(
+                        '{} failed to reopen transport, due to {}, retry after {}s',
+                        self, e, delay)
+                    await asyncio.sleep(delay)
+        finally:
+            self._opening -= 1
+        self._broken = False
+        return transport
+
+    def _drop_closed(self) -> None:
+        alive = [t for t in self._transports if not t.closed]
+        if len(alive) != len(self._transports):
+            logger.warning('{} dropped {} closed transport(s)', self,
+                           len(self._transports) - len(alive))
+            self._transports = alive
+
+    def _find_available(self) -> Optional[_Transport]:
+        return min((t for t in self._transports if t.available),
+                   key=lambda t: t.in_flight,
+                   default=None)
+
+    def _can_open_transport(self) -> bool:
+        return len(self._transports) + self._opening < self._max_transports
+
+    async def _acquire(self) -> _Transport:
+        woken = False
+        open_failed = False
+        while True:
+            self._drop_closed()
+            # a woken waiter was in the queue already, so it goes first
+            if woken or not self._queue:
+                transport = self._find_available()
+                if transport is not None:
+                    transport.in_flight += 1
+                    return transport
+                if not open_failed and self._can_open_transport():
+                    opened = await self._open_extra_transport()
+                    if opened is not None:
+                        return opened
+                    # slots may be released while opening, nobody wakes
+                    # who is not in the queue, so look again before waiting
+                    open_failed = True
+                    continue
+            open_failed = False
+            transport = await self._queue.wait(on_abandon=self._abandon)
+            if transport is not None and not transport.closed:
+                return transport
+            # the transport is closed, look for another one
+            self._abandon(transport)
+            woken = True
+
+    async def _open_extra_transport(self) -> Optional[_Transport]:
+        reopen = not self._transports
+        try:
+            if reopen:
+                transport = await self._reopen_transport()
+            else:
+                transport = await self.add_transport()
+        except (OSError, asyncssh.Error) as e:
+            if reopen:
+                self._broken = True
+                # nobody else can serve them
+                self._queue.fail_all(e)
+                raise
+            logger.warning('{} failed to open extra transport, due to {}',
+                           self, e)
+            return None
+        transport.in_flight += 1
+        # the new transport can serve who came before
+        while transport.available and self._queue.wake_next(transport):
+            transport.in_flight += 1
+        return transport
+
+    def _abandon(self, transport: Optional[_Transport]) -> None:
+        if transport is None:
+            self._queue.wake_next(None)
+        else:
+            self._release(transport)
+
+    def _release(self, transport: _Transport) -> None:
+        if transport.closed:
+            transport.in_flight -= 1
+            self._drop_closed()
+            # let the next waiter look for another transport
+            self._queue.wake_next(None)
+            return
+        if transport.in_flight > transport.limit or not self._queue.wake_next(
+                transport):
+            transport.in_flight -= 1
+
+    def _shrink(self, transport: _Transport,
+                error: asyncssh.ChannelOpenError) -> None:
+        if transport.in_flight <= 1:
+            raise error
+        transport.limit = transport.in_flight - 1
+        logger.warning(
+            '{} was refused to open channel ({}), so lower its session limit to {}',
+            self, error.reason, transport.limit)
+
+    @contextlib.asynccontextmanager
+    async def open(self, func: Callable[..., Any], *args, **kwargs):
+        while True:
+            with self._metrics.time('channel_wait'):
+                transport = await self._acquire()
+            try:
+                with self._metrics.time('channel_open'):
+                    res = await func(transport.conn, *args, **kwargs)
+            except asyncssh.ChannelOpenError as e:
+                try:
+                    if not transport.closed:
+                        self._shrink(transport, e)
+                finally:
+                    self._release(transport)
+                continue
+            except asyncssh.DisconnectError as e:
+                self._release(transport)
+                if transport.closed:
+                    raise TransportLost(
+                        f'{self} lost transport, due to {e}') from e
+                raise
+            except BaseException:
+                self._release(transport)
+                raise
+            break
+        try:
+            yield res
+        finally:
+            self._release(transport)
+
+    async def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        async with self.open(func, *args, **kwargs) as res:
+            return res
@@ -1,53 +1,262 @@
 import abc
+import asyncio
+import contextlib
 import io
+import weakref
 import asyncclick as click
 from loguru import logger
 
 from . import result as pres
+from . import stream as pstream
+from . import batch as pbatch
+from . import session as psession
+from . import file as pfile
+from . import buffer as pbuffer
+from . import metrics as pmetrics
+from . import limit as plimit
+from pilot import trace as ptrace
 
 
 class Connection(metaclass=abc.ABCMeta):
     result_cls = pres.RunResult
 
-    def __init__(self, parent_client=None):
+    def __init__(self,
+                 parent_client=None,
+                 persistent_shell=False,
+                 spill_threshold=pbuffer.default_spill_threshold):
         self._client = parent_client
+        # output larger than this is kept in a temp file instead of memory
+        self.spill_threshold = spill_threshold
+        self._session = psession.ShellSession(
+            self._open_shell) if persistent_shell else None
+        # limit.Admission of the host, which is set by the agent
+        self.admission = None
+        # results whose output is in temp files, released by aclose
+        self._spilled_results = weakref.WeakSet()
 
     def __repr__(self):
         return self.__class__.__name__
 
+    @property
+    def is_alive(self):
+        return True
+
+    @property
+    def metrics_host(self):
+        return 'localhost'
+
+    @property
+    def metrics(self):
+        return pmetrics.registry.host(self.metrics_host)
+
     @staticmethod
     def _change_option(kwargs):
         redirect_tty = kwargs.pop('redirect_tty', None)
         redirect_stdout_tty = kwargs.pop('redirect_stdout_tty', None)
         redirect_stderr_tty = kwargs.pop('redirect_stderr_tty', None)
         if redirect_tty is True:
-            kwargs['stdout'] = io.open(1, closefd=False)
-            kwargs['stderr'] = io.open(2, closefd=False)
+            kwargs['stdout'] = io.open(1, 'w', closefd=False)
+            kwargs['stderr'] = io.open(2, 'w', closefd=False)
         else:
             if redirect_stdout_tty:
-                kwargs['stdout'] = io.open(1, closefd=False)
+                kwargs['stdout'] = io.open(1, 'w', closefd=False)
             if redirect_stderr_tty:
-                kwargs['stderr'] = io.open(2, closefd=False)
+                kwargs['stderr'] = io.open(2, 'w', closefd=False)
 
-    async def run(self, *args, show_detail_opt=None, check=True, **kwargs):
+    @staticmethod
+    def _has_redirection(kwargs):
+        keys = ('redirect_tty', 'redirect_stdout_tty', 'redirect_stderr_tty',
+                'stdout', 'stderr')
+        return any(kwargs.get(key) for key in keys)
+
+    async def run(self,
+                  *args,
+                  show_detail_opt=None,
+                  check=True,
+                  encoding='utf-8',
+                  errors='strict',
+                  **kwargs):
         self._change_option(kwargs)
-        result_cls = self.result_cls
-        log_level = 'CMD_READ' if kwargs.pop('read_only', False) else 'CMD'
+        read_only = kwargs.pop('read_only', False)
+        log_level = 'CMD_READ' if read_only else 'CMD'
 
         logger.log(log_level, '{} run: <{}>', str(self), args)
-        origin = await self._run(*args, **kwargs)
-        result = result_cls(args, kwargs, origin, connection=self, check=check)
-        await result.wait()
+        with ptrace.span('run', connection=str(self), cmd=args) as span:
+            with self._prioritize(read_only):
+                async with self._admit():
+                    result = await self._get_result(args,
+                                                    kwargs,
+                                                    check,
+                                                    encoding=encoding,
+                                                    errors=errors)
+            if span is not None:
+                span.set(exit_status=result.exit_status)
 
         result.show_detail(show_detail_opt)
         result.check_raise()
 
         return result
 
+    async def run_many(self,
+                       cmds,
+                       *,
+                       check=True,
+                       encoding='utf-8',
+                       errors='strict',
+                       **kwargs):
+        if self._has_redirection(kwargs):
+            raise click.UsageError(
+                'run_many cannot redirect output, because it is parsed')
+        read_only = kwargs.pop('read_only', False)
+        log_level = 'CMD_READ' if read_only else 'CMD'
+
+        batch = pbatch.Batch(cmds)
+        logger.log(log_level, '{} run many: <{}>', str(self), batch.cmds)
+        with ptrace.span('run_many', connection=str(self), cmds=batch.cmds):
+            with self._prioritize(read_only):
+                async with self._admit():
+                    result = await self._get_result((batch.script, ), kwargs,
+                                                    False)
+        results = batch.split(result,
+                              kwargs,
+                              connection=self,
+                              check=check,
+                              encoding=encoding,
+                              errors=errors)
+        for res in results:
+            res.check_raise()
+
+        return results
+
+    @staticmethod
+    def _prioritize(read_only):
+        # a read-only command is a background poll, unless a priority is set
+        # by who runs it, like an action
+        return plimit.priority(plimit.current_priority(read_only))
+
+    def _admit(self):
+        if self.admission is None:
+            # because of no nullcontext for async
+            return contextlib.AsyncExitStack()
+        return self.admission.slot()
+
+    async def _get_result(self,
+                          args,
+                          kwargs,
+                          check,
+                          encoding='utf-8',
+                          errors='strict'):
+        metrics = self.metrics
+        with metrics.command(sent=self._sent_size(args, kwargs)):
+            result = await self._wait_result(args,
+                                             kwargs,
+                                             check,
+                                             encoding=encoding,
+                                             errors=errors)
+        metrics.bytes_in.observe(result.output_size)
+        if result.spilled:
+            self._spilled_results.add(result)
+        return result
+
+    @staticmethod
+    def _sent_size(args, kwargs):
+        size = sum(len(str(arg)) for arg in args)
+        stdin = kwargs.get('input')
+        if stdin is not None:
+            size += len(stdin)
+        return size
+
+    async def _wait_result(self, args, kwargs, check, **decode):
+        is_script = len(args) == 1 and isinstance(args[0], str)
+        if self._session is not None and is_script and not kwargs:
+            origin = await self._session.run(*args)
+            return pres.CmdRunResult(args,
+                                     kwargs,
+                                     origin,
+                                     connection=self,
+                                     check=check,
+                                     **decode)
+
+        origin = await self._run(*args, **kwargs)
+        result = self.result_cls(args,
+                                 kwargs,
+                                 origin,
+                                 connection=self,
+                                 check=check,
+                                 **decode)
+        await result.wait()
+        return result
+
     @abc.abstractmethod
     async def _run(self, *argv, **kwargs):
         pass
 
+    @contextlib.asynccontextmanager
+    async def stream(self,
+                     *args,
+                     check=True,
+                     encoding='utf-8',
+                     errors='strict',
+                     **kwargs):
+        self._change_option(kwargs)
+        log_level = 'CMD_READ' if kwargs.pop('read_only', False) else 'CMD'
+
+        logger.log(log_level, '{} stream: <{}>', str(self), args)
+        async with self._admit(), self._stream(*args,
+                                               **kwargs) as (stdout, stderr,
+                                                             wait, terminate):
+            async with pstream.RunStream(args,
+                                         stdout,
+                                         stderr,
+                                         wait,
+                                         terminate,
+                                         connection=self,
+                                         check=check,
+                                         encoding=encoding,
+                                         errors=errors) as stream:
+                yield stream
+
+    def _stream(self, *argv, **kwargs):
+        raise NotImplementedError(
+            f'{self.__class__.__name__} does not support stream')
+
+    def _open_shell(self):
+        raise NotImplementedError(
+            f'{self.__class__.__name__} does not support persistent shell')
+
+    @contextlib.asynccontextmanager
+    async def open_file(self,
+                        path,
+                        mode='r',
+                        *,
+                        encoding='utf-8',
+                        errors='strict',
+                        buffer_size=pfile._default_buffer_size):
+        logger.debug('{} open {} by mode {}', self, path, mode)
+        async with self._open_file(path, pfile.raw_mode(mode)) as raw:
+            f = pfile.AsyncFile(raw,
+                                mode,
+                                encoding=encoding,
+                                errors=errors,
+                                buffer_size=buffer_size)
+            if 'a' in mode:
+                await f.seek(0, io.SEEK_END)
+            try:
+                yield f
+            finally:
+                await f.flush()
+
+    def _open_file(self, path, mode):
+        raise NotImplementedError(
+            f'{self.__class__.__name__} does not support open file')
+
+    async def aclose(self):
+        for result in list(self._spilled_results):
+            result.close()
+        self._spilled_results.clear()
+        if self._session is not None:
+            await self._session.close()
+
 
 class RemoteConnection(Connection):
     def __init__(self,
@@ -62,6 +271,10 @@ class RemoteConnection(Connection):
         self._password = password
         self._port = port
 
+    @property
+    def metrics_host(self):
+        return self._host
+
     def __str__(self):
         return f'{self._username}@{self._host}:{self._port}'
 
@@ -78,3 +291,52 @@ class RemoteConnection(Connection):
         return self._port
 
     # TODO: scp
+
+
+class LazyConnection:
+    '''Stand-in of a connection, which is connected at the first use.'''
+    def __init__(self, connect, name=None):
+        self._connect = connect
+        self._name = name
+        self._conn = None
+        # created in the running loop, it may be made outside of any
+        self._lock = None
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self._name} connected={self.connected}>'
+
+    @property
+    def connected(self):
+        return self._conn is not None
+
+    @property
+    def is_alive(self):
+        return self._conn is None or self._conn.is_alive
+
+    async def get(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._conn is None or not self._conn.is_alive:
+                self._conn = await self._connect()
+            return self._conn
+
+    async def run(self, *args, **kwargs):
+        conn = await self.get()
+        return await conn.run(*args, **kwargs)
+
+    async def run_many(self, *args, **kwargs):
+        conn = await self.get()
+        return await conn.run_many(*args, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, *args, **kwargs):
+        conn = await self.get()
+        async with conn.stream(*args, **kwargs) as stream:
+            yield stream
+
+    @contextlib.asynccontextmanager
+    async def open_file(self, *args, **kwargs):
+        conn = await self.get()
+        async with conn.open_file(*args, **kwargs) as f:
+            yield f
@@ -1,22 +1,77 @@
 import abc
 
-from typing import (Optional)
+from typing import (Any, AsyncContextManager, Awaitable, Callable, Iterable,
+                    List, Optional)
 
 from . import interface as pit
 from . import result as pres
+from . import stream as pstream
+from . import file as pfile
+from . import metrics as pmetrics
+from . import limit as plimit
 
 
 class Connection(metaclass=abc.ABCMeta):
-    def __init__(self, parent_client: pit.ClientInterface = None) -> None:
+    admission: Optional[plimit.Admission]
+
+    def __init__(self,
+                 parent_client: pit.ClientInterface = None,
+                 persistent_shell: bool = ...,
+                 spill_threshold: int = ...) -> None:
+        ...
+
+    @property
+    def is_alive(self) -> bool:
+        ...
+
+    @property
+    def metrics_host(self) -> str:
+        ...
+
+    @property
+    def metrics(self) -> pmetrics.HostMetrics:
+        ...
+
+    async def run(self,
+                  *argv,
+                  show_detail_opt=None,
+                  encoding: Optional[str] = ...,
+                  errors: str = ...,
+                  **kwargs):
+        ...
+
+    async def run_many(self,
+                       cmds: Iterable[str],
+                       *,
+                       check: bool = ...,
+                       **kwargs) -> List[pres.CmdRunResult]:
         ...
 
-    async def run(self, *argv, show_detail_opt=None, **kwargs):
+    async def aclose(self) -> None:
         ...
 
     @abc.abstractmethod
     async def _run(self, *argv, **kwargs) -> pres.RunResult:
         ...
 
+    def open_file(
+            self,
+            path: str,
+            mode: str = ...,
+            *,
+            encoding: Optional[str] = ...,
+            errors: str = ...,
+            buffer_size: int = ...) -> AsyncContextManager[pfile.AsyncFile]:
+        ...
+
+    def stream(self,
+               *argv,
+               check: bool = ...,
+               encoding: Optional[str] = ...,
+               errors: str = ...,
+               **kwargs) -> AsyncContextManager[pstream.RunStream]:
+        ...
+
 
 class RemoteConnection(Connection, metaclass=abc.ABCMeta):
     def __init__(self,
@@ -38,3 +93,36 @@ class RemoteConnection(Connection, metaclass=abc.ABCMeta):
     @property
     def port(self) -> int:
         ...
+
+
+class LazyConnection:
+    def __init__(self,
+                 connect: Callable[[], Awaitable[Connection]],
+                 name: Any = None) -> None:
+        ...
+
+    @property
+    def connected(self) -> bool:
+        ...
+
+    @property
+    def is_alive(self) -> bool:
+        ...
+
+    async def get(self) -> Connection:
+        ...
+
+    async def run(self, *argv, **kwargs):
+        ...
+
+    async def run_many(self, cmds: Iterable[str],
+                       **kwargs) -> List[pres.CmdRunResult]:
+        ...
+
+    def stream(self, *argv,
+               **kwargs) -> AsyncContextManager[pstream.RunStream]:
+        ...
+
+    def open_file(self, path: str, *args,
+                  **kwargs) -> AsyncContextManager[pfile.AsyncFile]:
+        ...
@@ -1,6 +1,6 @@
 from __future__ import annotations
-import contextlib
 import asyncio
+import contextlib
 from loguru import logger
 from typing import (
     Generic,
@@ -14,6 +14,7 @@ from typing import (
 )
 
 from . import info as pinfo
+from . import connection as pconnection
 if TYPE_CHECKING:
     from . import agent as pagent
 
@@ -27,6 +28,9 @@ class Connector(contextlib.AsyncExitStack):
     def __init__(self) -> None:
         super().__init__()
         self._cached = {}
+        self._stacks = {}
+        # concurrent connects of one info share a connection
+        self._locks = {}
 
     @overload
     async def connect_by_agent(self,
@@ -80,17 +84,41 @@ class Connector(contextlib.AsyncExitStack):
         else:
             raise TypeError(f'Unknown {info} ({type(info)})')
 
-        if conn_info not in self._cached:
-            if not issubclass(agent, pagent.ConnectLocalAgent):
-                args = list(args)
-                args.insert(0, conn_info.enter_info)
-            cm = agent.connect(*args, connector=self, **kwargs)
-            self._cached[conn_info] = await self.enter_async_context(cm)
-        return self._cached[conn_info]
+        lock = self._locks.get(conn_info)
+        if lock is None:
+            lock = self._locks[conn_info] = asyncio.Lock()
+        async with lock:
+            conn = self._cached.get(conn_info)
+            if conn is not None and conn.is_alive is False:
+                logger.warning('{} of {} is dead, so reconnect it', conn,
+                               conn_info)
+                await self.close(conn_info)
+            if conn_info not in self._cached:
+                if not issubclass(agent, pagent.ConnectLocalAgent):
+                    args = list(args)
+                    args.insert(0, conn_info.enter_info)
+                cm = agent.connect(*args, connector=self, **kwargs)
+                # each connection has its own stack, so it can be closed alone
+                stack = contextlib.AsyncExitStack()
+                self._cached[conn_info] = await stack.enter_async_context(cm)
+                self._stacks[conn_info] = stack
+                self.push_async_exit(stack)
+            return self._cached[conn_info]
+
+    @property
+    def connected(self) -> bool:
+        return bool(self._cached)
+
+    async def close(self, conn_info: ConnectInfo):
+        self._cached.pop(conn_info, None)
+        stack = self._stacks.pop(conn_info, None)
+        if stack is not None:
+            await stack.aclose()
 
     async def close_all(self):
         await self.aclose()
         self._cached.clear()
+        self._stacks.clear()
 
 
 _Connector = TypeVar('_Connector', bound=Connector)
@@ -110,26 +138,17 @@ class ConnectorCachedPool(contextlib.AsyncExitStack, Generic[_Connector]):
                 self._connector_type(*args, **kwargs))
         return self._cached[identify]
 
-    async def get_lazy(self, connect_info):
-        pass
-        # TODO LazyConnection
-
-
-def retry(expection=Exception, retry_max=10, inteval=1):
-    def wrap(raw_func, connect_info):
-        async def func(*args, **kwargs):
-            retry_count = 0
-            while True:
-                try:
-                    async with raw_func(*args, **kwargs) as conn:
-                        yield conn
-                except expection as e:
-                    logger.warning('Happened connection lost at {} of {}',
-                                   retry_count, retry_max)
-                    if retry_count == retry_max:
-                        raise RuntimeError('Retry failed') from e
-                    await asyncio.sleep(inteval)
-
-        return func
-
-    return wrap
+    async def get_lazy(self, identify: Any, agent: Type[Agent], *args,
+                       **kwargs) -> pconnection.LazyConnection:
+        '''same as get(identify).connect_by_agent(agent, ...), but connect it at the first use'''
+        async def connect():
+            connector = await self.get(identify)
+            return await connector.connect_by_agent(agent, *args, **kwargs)
+
+        return pconnection.LazyConnection(connect, name=identify)
+
+
+def backoff(retry_max=5, interval=1, max_interval=30):
+    '''delays before each retry, doubled every time until max_interval'''
+    for i in range(retry_max):
+        yield min(interval * 2**i, max_interval)
@@ -1,62 +1,218 @@
-import os
+import asyncio
 import contextlib
-import asyncssh
+import hashlib
+import io
+import shlex
+import time
 import asyncclick as click
+from loguru import logger
+from typing import Dict
 
 from . import agent as pagent
+from . import info as pinfo
 from . import result as pres
 from . import connection as pconn
-from . import subprocess as pproc
-from . import asyncssh as pssh
-from pilot import utils
-
-_remote_expect_path: str = '/tmp/auto-ssh.exp'
-_local_expect_path: str = os.path.join(utils.root_dir, 'assh', 'auto-ssh.exp')
+from . import session as psession
+
+_expect_path: str = '/usr/bin/expect'
+_remote_expect_path: str = '/tmp/pilot-session.exp'
+_password_prompt = b'__pilot_expect_password\n'
+_ready = b'__pilot_expect_ready\n'
+# seconds which a checked environment of a tunnel is trusted for
+_env_ttl: float = 600
+
+# run by expect on the tunnel: <host> <username> <port>
+# the password is the first line of stdin, so it is not on any command line.
+# After login, stdin and stdout are bridged to /bin/sh of the host by a raw
+# pty, which neither echoes input nor rewrites newlines.
+_expect_script = r'''
+log_user 0
+set timeout 30
+lassign $argv host username port
+puts "__pilot_expect_password"
+flush stdout
+gets stdin password
+spawn -noecho ssh -T -p $port -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=no -o NumberOfPasswordPrompts=1 $username@$host {echo __pilot_expect_login; exec /bin/sh}
+expect {
+    -nocase "(yes/no" { send "yes\r"; exp_continue }
+    -nocase "password:" { send -- "$password\r"; exp_continue }
+    "__pilot_expect_login" {}
+    timeout { exit 2 }
+    eof { exit 1 }
+}
+expect "\n"
+stty raw -echo < $spawn_out(slave,name)
+puts "__pilot_expect_ready"
+flush stdout
+interact
+'''
+_expect_script_md5 = hashlib.md5(_expect_script.encode()).hexdigest()
+
+
+def _printf_arg(data: bytes) -> str:
+    '''data as an argument of printf %b, bytes out of printable ASCII are
+    escaped, so the script of the shell stays text'''
+    chars = (chr(b) if 32 <= b < 127 and b not in b"\\'" else f'\\0{b:03o}'
+             for b in data)
+    return f"'{''.join(chars)}'"
+
+
+def _with_options(cmd: str, input=None, env=None) -> str:
+    '''cmd with its stdin and environment, which run in a subshell'''
+    if env:
+        exports = ' '.join(shlex.quote(f'{k}={v}') for k, v in env.items())
+        cmd = f'( export {exports}; command eval {shlex.quote(cmd)} )'
+    if input is not None:
+        if isinstance(input, str):
+            input = input.encode()
+        cmd = f'printf %b {_printf_arg(input)} | {{ command eval {shlex.quote(cmd)}; }}'
+    return cmd
 
 
 class ExpectConnection(pconn.Connection):
+    '''Password login through expect on a tunnel, which is done only once.
+
+    Commands go through one persistent shell of the host, so each of them
+    costs a round trip instead of a login.
+    '''
     result_cls = pres.CmdRunResult
 
     def __init__(self, connect_info, tunnel_conn: pconn.Connection, **kwargs):
         super().__init__(**kwargs)
         self._client_info = connect_info
         self._conn = tunnel_conn
+        self._session = psession.MergedShellSession(self._open_shell)
 
-    async def _run(self, *cmds, **kwargs):
+    def __repr__(self):
         info = self._client_info
-        cmd = ' '.join([f'"{c}"' for c in cmds])
-        return await self._conn.run(
-            f'/usr/bin/expect {_remote_expect_path} "{info.host}" "{info.username}" "{info.password}" "{info.port}" {cmd}',
-            **kwargs)
+        return f'{self.__class__.__name__}({info.username}@{info.host}:{info.port})'
 
+    @property
+    def is_alive(self):
+        return self._conn.is_alive
 
-async def _check_expect_supported(tunnel_conn: pconn.Connection) -> None:
-    res = await tunnel_conn.run('which expect', check=False)
-    if res.exit_status != 0:
-        # TODO: add which host need to install expect
-        raise click.UsageError(f'Please install expect first')
+    @property
+    def metrics_host(self):
+        return self._client_info.host
 
+    @contextlib.asynccontextmanager
+    async def _open_shell(self):
+        async with self._conn._open_shell() as (stdin, stdout, stderr, wait):
+            with self.metrics.time('connect'):
+                await self._login(stdin, stdout, wait)
+            yield stdin, stdout, None, wait
 
-async def _check_expect_exist(tunnel_conn: pconn.Connection) -> bool:
-    res = await tunnel_conn.run(f'test -f {_remote_expect_path}', check=False)
-    return res.exit_status == 0
+    async def _login(self, stdin, stdout, wait):
+        info = self._client_info
+        args = shlex.join([str(info.host), str(info.username), str(info.port)])
+        stdin.write(
+            f'exec {_expect_path} -f {_remote_expect_path} {args}\n'.encode())
+        await stdin.drain()
+        _, found = await psession._read_until(stdout, _password_prompt)
+        if found:
+            stdin.write(f'{info.password}\n'.encode())
+            await stdin.drain()
+            _, found = await psession._read_until(stdout, _ready)
+        if not found:
+            raise ConnectionError(
+                f'{self} failed to log in, expect exited with {await wait()}')
+
+    @staticmethod
+    def _redirect(target, data: bytes):
+        if target is None:
+            return data
+        if isinstance(target, io.TextIOBase):
+            target.write(data.decode('utf-8', 'replace'))
+        else:
+            target.write(data)
+        target.flush()
+        return None
+
+    async def _run(self,
+                   *argv,
+                   stdout=None,
+                   stderr=None,
+                   input=None,
+                   env=None,
+                   **kwargs):
+        if kwargs:
+            # the shell of the host is shared, it has no channel to apply
+            # options of the tunnel to
+            raise click.UsageError(
+                f'{self} cannot run with {", ".join(kwargs)} through expect')
+        if len(argv) == 1 and isinstance(argv[0], (list, tuple)):
+            cmd = shlex.join(argv[0])
+        else:
+            cmd = ' '.join(argv)
+        origin = await self._session.run(_with_options(cmd, input, env))
+        return pres.CompletedOrigin(
+            stdout=self._redirect(stdout, origin.stdout),
+            stderr=self._redirect(stderr, origin.stderr),
+            exit_status=origin.exit_status)
+
+
+async def _probe_expect_env(tunnel_conn: pconn.Connection) -> bool:
+    '''whether the deployed script is the current one'''
+    path = shlex.quote(_remote_expect_path)
+    cmds = [
+        f'test -x {_expect_path}',
+        f'md5sum {path} 2>/dev/null || md5 -q {path}',
+    ]
+    supported, digest = await tunnel_conn.run_many(cmds, check=False)
+    if supported.exit_status != 0:
+        # TODO: add which host need to install expect
+        raise click.UsageError(f'Please install expect first')
+    return digest.success and digest.stdout.split()[:1] == [_expect_script_md5]
 
 
 async def _prepare_expect_env(tunnel_conn: pconn.Connection) -> bool:
-    if isinstance(tunnel_conn, pproc.SubprocessConnection):
-        await tunnel_conn.run(
-            f'/bin/cp {_local_expect_path} {_remote_expect_path}')
-    elif isinstance(tunnel_conn, pssh.AsyncsshConnection):
-        # TODO Fix SFTPConnectionLost error
-        await asyncssh.scp(_local_expect_path,
-                           (tunnel_conn.origin, _remote_expect_path))
-    else:
-        raise NotImplementedError
+    # replaced at once, another process may be running the old one
+    tmp_path = f'{_remote_expect_path}.pilot-part'
+    async with tunnel_conn.open_file(tmp_path, 'w') as f:
+        await f.write(_expect_script)
+    await tunnel_conn.run(['mv', '-f', tmp_path, _remote_expect_path])
     return True
 
 
-class ExpectAgent(pagent.ConnectAgent):
+class _ExpectEnv:
+    '''expect and the script on a tunnel, which are checked once per ttl
+
+    Connects through one tunnel share the check, so many hosts behind one
+    bastion cost one probe.
+    '''
+    def __init__(self) -> None:
+        self._lock = asyncio.Lock()
+        self._checked_at = None
+
+    @property
+    def fresh(self) -> bool:
+        return self._checked_at is not None and time.monotonic(
+        ) - self._checked_at < _env_ttl
+
+    async def ensure(self, tunnel_conn: pconn.Connection) -> None:
+        async with self._lock:
+            if self.fresh:
+                return
+            if not await _probe_expect_env(tunnel_conn):
+                logger.debug('{} deploys {}', tunnel_conn, _remote_expect_path)
+                await _prepare_expect_env(tunnel_conn)
+            self._checked_at = time.monotonic()
+
+
+# by the host of tunnel, which connections of clients share
+_expect_envs: Dict[str, _ExpectEnv] = {}
+
+
+async def _ensure_expect_env(tunnel_conn: pconn.Connection) -> None:
+    env = _expect_envs.get(str(tunnel_conn))
+    if env is None:
+        env = _expect_envs[str(tunnel_conn)] = _ExpectEnv()
+    await env.ensure(tunnel_conn)
+
+
+class ExpectAgent(pagent.ConnectRemoteAgent):
     connection_cls = ExpectConnection
+    required_enter_info_type = pinfo.LoginSSHInfo
 
     @classmethod
     @contextlib.asynccontextmanager
@@ -64,8 +220,10 @@ class ExpectAgent(pagent.ConnectAgent):
         if tunnel is None:
             raise AttributeError(f'Request tunnel to run expect')
 
-        await _check_expect_supported(tunnel)
-        if await _check_expect_exist(tunnel) == False:
-            await _prepare_expect_env(tunnel)
+        await _ensure_expect_env(tunnel)
 
-        yield ExpectConnection(connect_info, tunnel, **kwargs)
+        conn = ExpectConnection(connect_info, tunnel, **kwargs)
+        try:
+            yield conn
+        finally:
+            await conn.aclose()
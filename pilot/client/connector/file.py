@@ -0,0 +1,165 @@
+import codecs
+import os
+from typing import (
+    AsyncIterator,
+    Optional,
+    Union,
+)
+
+_default_buffer_size = 256 * 1024
+
+
+def raw_mode(mode: str) -> str:
+    '''binary mode of the file under mode, like r+ to r+b'''
+    base = mode.replace('b', '').replace('t', '')
+    if not base or base[0] not in 'rwax' or base.strip('+')[1:]:
+        raise ValueError(f'invalid mode: {mode!r}')
+    return base[0] + ('+' if '+' in base else '') + 'b'
+
+
+class AsyncFile:
+    '''File object over a file which is read and written at offsets.
+
+    At most buffer_size bytes are buffered for sequential reads or writes,
+    a larger read or write goes to the file directly. Offsets of seek and
+    tell, and size of read are in bytes even in text mode.
+    '''
+    def __init__(self,
+                 raw,
+                 mode: str = 'r',
+                 encoding: Optional[str] = 'utf-8',
+                 errors: str = 'strict',
+                 buffer_size: int = _default_buffer_size) -> None:
+        self._raw = raw
+        self._mode = mode
+        self._decoder = None if 'b' in mode else codecs.getincrementaldecoder(
+            encoding)(errors)
+        self._encoding = encoding
+        self._errors = errors
+        self._buffer_size = buffer_size
+        self._pos = 0
+        # unread data of read buffer starts at _roff, which is at _pos
+        self._rbuf = b''
+        self._roff = 0
+        self._eof = False
+        # write buffer starts at _wpos
+        self._wbuf = bytearray()
+        self._wpos = 0
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self._raw} mode={self._mode}>'
+
+    @property
+    def readable(self) -> bool:
+        return 'r' in self._mode or '+' in self._mode
+
+    @property
+    def writable(self) -> bool:
+        return any(c in self._mode for c in 'wax+')
+
+    def tell(self) -> int:
+        return self._pos
+
+    async def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        await self.flush()
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += await self._raw.size()
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        self._drop_read_buffer()
+        if self._decoder is not None:
+            self._decoder.reset()
+        return offset
+
+    def _decode(self, data: bytes, final: bool = False) -> Union[str, bytes]:
+        if self._decoder is None:
+            return data
+        return self._decoder.decode(data, final)
+
+    @property
+    def _buffered(self) -> int:
+        return len(self._rbuf) - self._roff
+
+    def _drop_read_buffer(self) -> None:
+        self._rbuf = b''
+        self._roff = 0
+        self._eof = False
+
+    async def _fill(self, size: int) -> None:
+        '''make read buffer have size unread bytes unless eof'''
+        while self._buffered < size and not self._eof:
+            want = max(size - self._buffered, self._buffer_size)
+            data = await self._raw.read(want, self._pos + self._buffered)
+            if not data:
+                self._eof = True
+            self._rbuf = self._rbuf[self._roff:] + data
+            self._roff = 0
+
+    def _take(self, size: int) -> bytes:
+        data = self._rbuf[self._roff:self._roff + size]
+        self._roff += len(data)
+        self._pos += len(data)
+        return data
+
+    async def read(self, size: int = -1) -> Union[str, bytes]:
+        if not self.readable:
+            raise OSError(f'{self} is not readable')
+        await self.flush()
+        if size < 0:
+            chunks = [self._take(self._buffered)]
+            while not self._eof:
+                await self._fill(self._buffer_size)
+                chunks.append(self._take(self._buffered))
+            return self._decode(b''.join(chunks), final=True)
+        await self._fill(size)
+        return self._decode(self._take(size),
+                            final=self._eof and not self._buffered)
+
+    async def readline(self) -> Union[str, bytes]:
+        if not self.readable:
+            raise OSError(f'{self} is not readable')
+        await self.flush()
+        searched = 0
+        while True:
+            end = self._rbuf.find(b'\n', self._roff + searched)
+            if end != -1:
+                return self._decode(self._take(end + 1 - self._roff))
+            if self._eof:
+                return self._decode(self._take(self._buffered), final=True)
+            searched = self._buffered
+            await self._fill(self._buffered + self._buffer_size)
+
+    def __aiter__(self) -> AsyncIterator[Union[str, bytes]]:
+        return self
+
+    async def __anext__(self) -> Union[str, bytes]:
+        line = await self.readline()
+        if not line:
+            raise StopAsyncIteration
+        return line
+
+    async def write(self, data: Union[str, bytes]) -> int:
+        if not self.writable:
+            raise OSError(f'{self} is not writable')
+        if isinstance(data, str):
+            if self._decoder is None:
+                raise TypeError(
+                    'a bytes-like object is required in binary mode')
+            data = data.encode(self._encoding, self._errors)
+        # read-ahead data is going to be stale
+        self._drop_read_buffer()
+        if not self._wbuf:
+            self._wpos = self._pos
+        self._wbuf += data
+        self._pos += len(data)
+        if len(self._wbuf) >= self._buffer_size:
+            await self.flush()
+        return len(data)
+
+    async def flush(self) -> None:
+        if self._wbuf:
+            data, self._wbuf = bytes(self._wbuf), bytearray()
+            await self._raw.write(data, self._wpos)
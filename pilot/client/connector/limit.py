@@ -0,0 +1,228 @@
+import asyncio
+import contextlib
+import contextvars
+import enum
+import heapq
+import itertools
+import time
+from typing import (
+    Any,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from pilot import trace as ptrace
+from . import metrics as pmetrics
+
+
+class Priority(enum.IntEnum):
+    '''class of a waiter, a smaller one is woken first'''
+    INTERACTIVE = 0
+    ACTION = 1
+    BACKGROUND = 2
+
+
+# None is unset, so read-only commands fall to BACKGROUND
+_priority: contextvars.ContextVar[Optional[Priority]] = contextvars.ContextVar(
+    'pilot_priority', default=None)
+
+
+def current_priority(read_only: bool = False) -> Priority:
+    value = _priority.get()
+    if value is not None:
+        return value
+    return Priority.BACKGROUND if read_only else Priority.INTERACTIVE
+
+
+@contextlib.contextmanager
+def priority(value: Priority) -> Iterator[None]:
+    '''wait in queues by value in the block, and tasks created in it'''
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class WaitQueue:
+    '''waiters by priority then FIFO, a woken one receives the value handed to it
+
+    The priority of a waiter is current_priority() when it starts to wait,
+    unless fifo is set, then waiters are woken only in the order they came.
+    '''
+    def __init__(self, fifo: bool = False) -> None:
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._fifo = fifo
+
+    def __len__(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    def __bool__(self) -> bool:
+        return len(self) != 0
+
+    async def wait(self, on_abandon: Callable[[Any], None]) -> Any:
+        fut = asyncio.get_running_loop().create_future()
+        prio = 0 if self._fifo else current_priority()
+        heapq.heappush(self._waiters, (prio, next(self._seq), fut))
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # woken and cancelled at the same time, so give it back
+                on_abandon(fut.result())
+            raise
+
+    def wake_next(self, value: Any = None) -> bool:
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(value)
+                return True
+        return False
+
+    def fail_all(self, error: BaseException) -> None:
+        waiters, self._waiters = self._waiters, []
+        for _, _, fut in waiters:
+            if not fut.done():
+                fut.set_exception(error)
+
+
+class Limiter:
+    '''at most limit holders at once, waiters are queued as in WaitQueue'''
+    def __init__(self, limit: Optional[int], fifo: bool = False) -> None:
+        self._limit = limit
+        self._in_flight = 0
+        self._queue = WaitQueue(fifo)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self._in_flight}/{self._limit} waiting={self.waiting}>'
+
+    @property
+    def limit(self) -> Optional[int]:
+        return self._limit
+
+    @limit.setter
+    def limit(self, limit: Optional[int]) -> None:
+        self._limit = limit
+        # a raised limit has room for waiters
+        while (limit is None
+               or self._in_flight < limit) and self._queue.wake_next():
+            self._in_flight += 1
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return len(self._queue)
+
+    async def acquire(self) -> None:
+        if self._limit is None or (self._in_flight < self._limit
+                                   and not self._queue):
+            self._in_flight += 1
+            return
+        # the slot is handed over by release, so in_flight is unchanged
+        await self._queue.wait(on_abandon=lambda _: self.release())
+
+    def release(self) -> None:
+        # a lowered limit has no room to hand the slot over
+        over = self._limit is not None and self._in_flight > self._limit
+        if over or not self._queue.wake_next():
+            self._in_flight -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class TokenBucket:
+    '''rate tokens per second, at most burst of them are saved
+
+    A token is reserved at once, so waiters are served in FIFO order.
+    '''
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError(
+                f'rate({rate}) and burst({burst}) must be positive')
+        self._rate = rate
+        self._burst = burst
+        self._tokens: float = burst
+        self._updated = time.monotonic()
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self._rate}/s burst={self._burst}>'
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        self._refill()
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return
+        try:
+            await asyncio.sleep(-self._tokens / self._rate)
+        except asyncio.CancelledError:
+            self._tokens += 1
+            raise
+
+
+class Admission:
+    '''Sessions to a host, which are connects and commands.
+
+    At most max_in_flight of them run at once, and they start at most rate
+    per second. Queued sessions are admitted by priority class, then in
+    FIFO order. Time queued for admission is observed as admission_wait of
+    metrics.
+    '''
+    def __init__(self,
+                 rate: Optional[float] = None,
+                 burst: int = 1,
+                 max_in_flight: Optional[int] = None,
+                 metrics: Optional[pmetrics.HostMetrics] = None) -> None:
+        self._limiter = Limiter(max_in_flight)
+        self._bucket = None if rate is None else TokenBucket(rate, burst)
+        self._metrics = metrics
+        # seconds which admitted sessions were queued
+        self.waited: float = 0
+        self.admitted = 0
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self._limiter} {self._bucket}>'
+
+    @property
+    def in_flight(self) -> int:
+        return self._limiter.in_flight
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        start = time.perf_counter()
+        with ptrace.span('admission'):
+            await self._limiter.acquire()
+            try:
+                if self._bucket is not None:
+                    await self._bucket.acquire()
+            except BaseException:
+                self._limiter.release()
+                raise
+        waited = time.perf_counter() - start
+        self.waited += waited
+        self.admitted += 1
+        if self._metrics is not None:
+            self._metrics.observe('admission_wait', waited)
+        try:
+            yield
+        finally:
+            self._limiter.release()
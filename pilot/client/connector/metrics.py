@@ -0,0 +1,221 @@
+import bisect
+import contextlib
+import json
+import math
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+# upper bounds of buckets, the last bucket is +Inf
+seconds_buckets: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                                      1, 2.5, 5, 10, 30, 60)
+bytes_buckets: Tuple[float, ...] = tuple(float(4**i) for i in range(3, 14))
+
+
+class Histogram:
+    '''Counts of observations by buckets, like a histogram of Prometheus.'''
+    def __init__(self, buckets: Sequence[float] = seconds_buckets) -> None:
+        self._bounds = tuple(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.sum: float = 0
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} count={self.count} mean={self.mean:.3f}>'
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        '''cumulative counts by upper bounds, which ends with +Inf'''
+        res = []
+        total = 0
+        for bound, count in zip(self._bounds + (math.inf, ), self._counts):
+            total += count
+            res.append((bound, total))
+        return res
+
+    def quantile(self, q: float) -> float:
+        '''upper bound of the bucket which the q quantile falls in'''
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        for bound, total in self.buckets():
+            if total >= rank:
+                return bound
+        return math.inf
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': [[_format_bound(b), c] for b, c in self.buckets()],
+        }
+
+
+class HostMetrics:
+    '''Metrics of connections to one host.
+
+    connect is the time to open a transport or log in, channel_open is the
+    time to open a channel or spawn a process after a free one is got, and
+    channel_wait is the time waiting for a free one. admission_wait is the
+    time queued by the admission of the host.
+    '''
+    histogram_names = ('connect', 'admission_wait', 'channel_wait',
+                       'channel_open', 'command')
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.histograms: Dict[str, Histogram] = {
+            name: Histogram()
+            for name in self.histogram_names
+        }
+        # received from and sent to the host
+        self.bytes_in = Histogram(bytes_buckets)
+        self.bytes_out = Histogram(bytes_buckets)
+        self.in_flight = 0
+        self.errors: Dict[str, int] = {}
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.host} in_flight={self.in_flight}>'
+
+    def observe(self, name: str, seconds: float) -> None:
+        self.histograms[name].observe(seconds)
+
+    def count_error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    @contextlib.contextmanager
+    def time(self, name: str, error_kind: Optional[str] = None) -> Iterator:
+        '''observe the time of the block, and count it as error_kind when it fails'''
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count_error(error_kind or name)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def command(self, sent: int = 0) -> Iterator:
+        self.in_flight += 1
+        self.bytes_out.observe(sent)
+        try:
+            with self.time('command'):
+                yield
+        finally:
+            self.in_flight -= 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        histograms = {
+            name: hist.to_dict()
+            for name, hist in self.histograms.items()
+        }
+        histograms['bytes_in'] = self.bytes_in.to_dict()
+        histograms['bytes_out'] = self.bytes_out.to_dict()
+        return {
+            'histograms': histograms,
+            'in_flight': self.in_flight,
+            'errors': dict(self.errors),
+        }
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == math.inf else f'{bound:g}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry:
+    '''HostMetrics of all hosts, which is dumped as Prometheus text or JSON.'''
+    prefix = 'pilot_'
+
+    def __init__(self) -> None:
+        self._hosts: Dict[str, HostMetrics] = {}
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} hosts={len(self._hosts)}>'
+
+    def __len__(self) -> int:
+        return len(self._hosts)
+
+    def host(self, host: str) -> HostMetrics:
+        metrics = self._hosts.get(host)
+        if metrics is None:
+            metrics = self._hosts[host] = HostMetrics(host)
+        return metrics
+
+    def hosts(self) -> List[HostMetrics]:
+        return list(self._hosts.values())
+
+    def clear(self) -> None:
+        self._hosts.clear()
+
+    def slowest(self,
+                name: str = 'command',
+                n: int = 10,
+                q: float = 0.9) -> List[Tuple[str, float]]:
+        '''hosts of the largest q quantile of histogram name'''
+        res = [(m.host, m.histograms[name].quantile(q))
+               for m in self._hosts.values() if m.histograms[name].count]
+        return sorted(res, key=lambda r: r[1], reverse=True)[:n]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {host: m.to_dict() for host, m in self._hosts.items()}
+
+    def dump_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def dump_prometheus(self) -> str:
+        lines = []
+        histograms = [(f'{name}_seconds',
+                       lambda m, name=name: m.histograms[name])
+                      for name in HostMetrics.histogram_names]
+        histograms += [('bytes_in', lambda m: m.bytes_in),
+                       ('bytes_out', lambda m: m.bytes_out)]
+        for name, get in histograms:
+            metric = f'{self.prefix}{name}'
+            lines.append(f'# TYPE {metric} histogram')
+            for m in self._hosts.values():
+                hist = get(m)
+                host = _escape(m.host)
+                for bound, count in hist.buckets():
+                    lines.append(
+                        f'{metric}_bucket{{host="{host}",le="{_format_bound(bound)}"}} {count}'
+                    )
+                lines.append(f'{metric}_sum{{host="{host}"}} {hist.sum:g}')
+                lines.append(f'{metric}_count{{host="{host}"}} {hist.count}')
+
+        metric = f'{self.prefix}in_flight'
+        lines.append(f'# TYPE {metric} gauge')
+        for m in self._hosts.values():
+            lines.append(f'{metric}{{host="{_escape(m.host)}"}} {m.in_flight}')
+
+        metric = f'{self.prefix}errors_total'
+        lines.append(f'# TYPE {metric} counter')
+        for m in self._hosts.values():
+            for kind, count in m.errors.items():
+                lines.append(
+                    f'{metric}{{host="{_escape(m.host)}",kind="{kind}"}} {count}'
+                )
+        return '\n'.join(lines) + '\n'
+
+
+# shared by all connections
+registry = MetricsRegistry()
@@ -1,6 +1,11 @@
 import asyncclick as click
 from loguru import logger
 from abc import (ABC, abstractmethod)
+from typing import (NamedTuple, Optional, Union)
+
+from . import buffer as pbuffer
+
+Output = Union[str, bytes, pbuffer.SpillBuffer, None]
 
 
 class ExitStatusNotSuccess(Exception):
@@ -13,8 +18,21 @@ class ExitStatusNotSuccess(Exception):
         return self._result
 
 
+class CompletedOrigin(NamedTuple):
+    stdout: Output
+    stderr: Output
+    exit_status: Optional[int]
+
+
 class RunResult(ABC):
-    def __init__(self, args, kwargs, origin, connection=None, check=True):
+    def __init__(self,
+                 args,
+                 kwargs,
+                 origin,
+                 connection=None,
+                 check=True,
+                 encoding='utf-8',
+                 errors='strict'):
         if origin is None:
             click.UsageError('Must pass result')
         self._args = args
@@ -22,6 +40,9 @@ class RunResult(ABC):
         self._origin = origin
         self._check = check
         self._connection = connection
+        # stdout and stderr are bytes when encoding is None
+        self._encoding = encoding
+        self._errors = errors
 
     @property
     def origin(self):
@@ -44,6 +65,18 @@ class RunResult(ABC):
     async def wait(self):
         pass
 
+    @property
+    def output_size(self) -> int:
+        return 0
+
+    @property
+    def spilled(self) -> bool:
+        '''whether any output is kept in a temp file'''
+        return False
+
+    def close(self) -> None:
+        pass
+
     def check_raise(self):
         if self._check is True and not self.success:
             raise ExitStatusNotSuccess(
@@ -75,19 +108,97 @@ class RunResult(ABC):
             click.secho(self.stderr)
 
 
+def _decode(output: Output, encoding: Optional[str],
+            errors: str) -> Union[str, bytes, None]:
+    if output is None:
+        return None
+    data = _view(output)
+    if encoding is None:
+        return bytes(data)
+    return str(data, encoding, errors)
+
+
+def _size(output: Output) -> int:
+    if isinstance(output, str):
+        return len(output.encode('utf-8', 'surrogateescape'))
+    # a SpillBuffer knows its size, without viewing a temp file
+    return len(output)
+
+
+def _view(output: Output):
+    if isinstance(output, pbuffer.SpillBuffer):
+        return output.view
+    if isinstance(output, str):
+        # the output is decoded already, like that of a broker
+        return output.encode('utf-8', 'surrogateescape')
+    return output
+
+
 class CmdRunResult(RunResult):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._decoded = {}
+
     @property
     def command(self):
         return self._args[0]
 
     @property
-    def stdout(self):
+    def _stdout_output(self) -> Output:
         return self._origin.stdout
 
     @property
-    def stderr(self):
+    def _stderr_output(self) -> Output:
         return self._origin.stderr
 
+    def _text(self, name: str, output: Output):
+        # decoded at the first access, a caller checking exit_status only
+        # never pays for it
+        if name not in self._decoded:
+            self._decoded[name] = _decode(output, self._encoding, self._errors)
+        return self._decoded[name]
+
+    @property
+    def stdout(self):
+        return self._text('stdout', self._stdout_output)
+
+    @property
+    def stderr(self):
+        return self._text('stderr', self._stderr_output)
+
+    @property
+    def stdout_view(self):
+        '''bytes-like stdout, which is an mmap when it is spilled to disk'''
+        return _view(self._stdout_output)
+
+    @property
+    def stderr_view(self):
+        return _view(self._stderr_output)
+
+    @property
+    def _outputs(self):
+        return [
+            output for output in (self._stdout_output, self._stderr_output)
+            if output is not None
+        ]
+
+    @property
+    def output_size(self) -> int:
+        '''bytes of stdout and stderr, which are not redirected'''
+        return sum(_size(output) for output in self._outputs)
+
+    @property
+    def spilled(self) -> bool:
+        return any(
+            isinstance(output, pbuffer.SpillBuffer) and output.spilled
+            for output in self._outputs)
+
+    def close(self) -> None:
+        '''release temp files of spilled output, decoded text is kept'''
+        for output in self._outputs:
+            if isinstance(output, pbuffer.SpillBuffer):
+                output.close()
+
     @property
     def info(self):
         return self.command
@@ -50,6 +50,17 @@ class RunResult(Generic[T]):
     async def wait(self) -> None:
         ...
 
+    @property
+    def output_size(self) -> int:
+        ...
+
+    @property
+    def spilled(self) -> bool:
+        ...
+
+    def close(self) -> None:
+        ...
+
     def check_raise(self) -> None:
         ...
 
@@ -0,0 +1,184 @@
+import asyncio
+import contextlib
+import shlex
+import uuid
+from loguru import logger
+from typing import (
+    AsyncContextManager,
+    Callable,
+    Optional,
+    Tuple,
+)
+
+from . import limit as plimit
+from . import result as pres
+
+_chunk_size = 65536
+
+
+async def _read_until(reader, sep: bytes) -> Tuple[bytes, bool]:
+    '''read until sep, return data before sep and whether sep was found'''
+    buf = bytearray()
+    while True:
+        begin = max(0, len(buf) - len(sep) + 1)
+        chunk = await reader.read(_chunk_size)
+        if not chunk:
+            return bytes(buf), False
+        buf += chunk
+        pos = buf.find(sep, begin)
+        if pos != -1:
+            if pos + len(sep) != len(buf):
+                logger.warning('Drop unexpected output after {}: {}', sep,
+                               bytes(buf[pos + len(sep):]))
+            return bytes(buf[:pos]), True
+
+
+def _eval(cmd: str) -> str:
+    '''cmd as one argument of eval, so a cmd which does not parse fails
+    instead of leaving the shell waiting for the rest of it
+
+    command keeps a syntax error of eval from exiting the shell.
+    '''
+    return f'command eval {shlex.quote(cmd)}'
+
+
+class ShellSession:
+    '''One long-lived shell, commands are written to its stdin in turn.
+
+    Commands run in the shell itself, so cd or export is kept for the next
+    command. Every command is followed by its exit status and a marker on
+    stdout and a marker on stderr, which tell where its output ends.
+    '''
+    def __init__(self, open_shell: Callable[[], AsyncContextManager]) -> None:
+        self._open_shell = open_shell
+        self._stack: Optional[contextlib.AsyncExitStack] = None
+        self._shell = None
+        # commands are run in the order they came, whatever their priority
+        self._limiter = plimit.Limiter(1, fifo=True)
+        self._marker = f'__pilot_session_{uuid.uuid4().hex}'
+        self._seq = 0
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} opened={self.opened}>'
+
+    @property
+    def opened(self) -> bool:
+        return self._shell is not None
+
+    async def _open(self):
+        stack = contextlib.AsyncExitStack()
+        self._shell = await stack.enter_async_context(self._open_shell())
+        self._stack = stack
+        logger.debug('{} started shell', self)
+        return self._shell
+
+    async def close(self) -> None:
+        stack, self._stack, self._shell = self._stack, None, None
+        if stack is not None:
+            await stack.aclose()
+
+    async def run(self, cmd: str) -> pres.CompletedOrigin:
+        async with self._limiter.slot():
+            shell = self._shell or await self._open()
+            try:
+                return await self._run(shell, cmd)
+            except BaseException:
+                # the shell is in unknown state, so drop it
+                await self.close()
+                raise
+
+    async def _run(self, shell, cmd: str) -> pres.CompletedOrigin:
+        stdin, stdout, stderr, wait = shell
+        self._seq += 1
+        marker = f'{self._marker}_{self._seq}'
+        # stdin of cmd is /dev/null, otherwise it may eat next commands
+        script = (f'{_eval(cmd)} </dev/null\n'
+                  f"printf '\\n%d {marker}\\n' $?\n"
+                  f"printf '\\n{marker}\\n' >&2\n")
+        stdin.write(script.encode())
+        await stdin.drain()
+
+        (out, out_found), (err, err_found) = await asyncio.gather(
+            _read_until(stdout, f' {marker}\n'.encode()),
+            _read_until(stderr, f'\n{marker}\n'.encode()))
+        if out_found and err_found:
+            out, _, status = out.rpartition(b'\n')
+            exit_status = int(status)
+        else:
+            # cmd exited the shell, the next command reopens it
+            exit_status = await wait()
+            await self.close()
+        return pres.CompletedOrigin(stdout=out,
+                                    stderr=err,
+                                    exit_status=exit_status)
+
+
+async def _read_until_buffered(reader, pending: bytearray,
+                               sep: bytes) -> Optional[bytes]:
+    '''read until sep, data after sep is kept in pending for next read
+
+    None is returned when reader reaches eof before sep.
+    '''
+    begin = 0
+    while True:
+        pos = pending.find(sep, begin)
+        if pos != -1:
+            data = bytes(pending[:pos])
+            del pending[:pos + len(sep)]
+            return data
+        begin = max(0, len(pending) - len(sep) + 1)
+        chunk = await reader.read(_chunk_size)
+        if not chunk:
+            return None
+        pending += chunk
+
+
+class MergedShellSession(ShellSession):
+    '''ShellSession over a shell whose stderr is merged into stdout.
+
+    It is the case of a shell behind a pty. stderr of every command is kept
+    in a temp file of the shell, and printed after its exit status.
+    '''
+    _err_var = '__pilot_err'
+
+    def __init__(self, open_shell: Callable[[], AsyncContextManager]) -> None:
+        super().__init__(open_shell)
+        self._pending = bytearray()
+
+    async def _open(self):
+        shell = await super()._open()
+        self._pending = bytearray()
+        stdin = shell[0]
+        v = self._err_var
+        stdin.write(f'{v}=$(mktemp); trap \'rm -f "${v}"\' EXIT\n'.encode())
+        await stdin.drain()
+        return shell
+
+    async def _run(self, shell, cmd: str) -> pres.CompletedOrigin:
+        stdin, stdout, _, wait = shell
+        self._seq += 1
+        marker = f'{self._marker}_{self._seq}'
+        v = self._err_var
+        script = (f'{_eval(cmd)} </dev/null 2>"${v}"\n'
+                  f"printf '\\n%d {marker}\\n' $?\n"
+                  f'cat "${v}"\n'
+                  f"printf '\\n{marker}\\n'\n")
+        stdin.write(script.encode())
+        await stdin.drain()
+
+        out = await _read_until_buffered(stdout, self._pending,
+                                         f' {marker}\n'.encode())
+        if out is None:
+            # cmd exited the shell
+            out = bytes(self._pending)
+            exit_status = await wait()
+            await self.close()
+            return pres.CompletedOrigin(stdout=out,
+                                        stderr=b'',
+                                        exit_status=exit_status)
+        out, _, status = out.rpartition(b'\n')
+        err = await _read_until_buffered(stdout, self._pending,
+                                         f'\n{marker}\n'.encode())
+        return pres.CompletedOrigin(stdout=out,
+                                    stderr=err or b'',
+                                    exit_status=int(status))
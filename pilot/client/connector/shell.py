@@ -3,25 +3,21 @@ import contextlib
 from . import agent as pagent
 from . import subprocess as pproc
 from . import asyncssh as pssh
+from . import address as paddr
 
 
-class AutoShellAgent(pagent.ConnectAgent):
+class AutoShellAgent(pagent.ConnectRemoteAgent):
+    '''run on localhost when the host is one of local addresses, otherwise by ssh'''
+    pass_connector = True
+
     @classmethod
     @contextlib.asynccontextmanager
-    async def _connect(cls, enter_info):
-        import ifcfg
-
-        def is_local_ip(ip):
-            for interface in ifcfg.interfaces().values():
-                if ip in interface['inet4']:
-                    return True
-            return False
-
-        if is_local_ip(enter_info.host):
-            connect_cls = pproc.SubprocessAgent
-            args = ()
+    async def _connect(cls, enter_info, connector, **kwargs):
+        if await paddr.local_addresses.is_local(enter_info.host):
+            cm = pproc.SubprocessAgent.connect()
         else:
-            connect_cls = pssh.AsyncsshRootAgent
-            args = enter_info
-        async with connect_cls.connect(*args) as conn:
-            yield conn
\ No newline at end of file
+            cm = pssh.AsyncsshRootAgent.connect(enter_info,
+                                                connector=connector,
+                                                **kwargs)
+        async with cm as conn:
+            yield conn
@@ -0,0 +1,148 @@
+import asyncio
+import codecs
+import contextlib
+from loguru import logger
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from . import result as pres
+
+
+class RunStream:
+    '''Output of a running command, read it while the command is running.
+
+    stdout is not buffered by the stream, so the command is paused by the
+    transport when the reader is slower than it. stderr is drained in
+    background to avoid blocking the command on a full pipe.
+    '''
+    def __init__(self,
+                 args: Tuple[Any, ...],
+                 stdout,
+                 stderr,
+                 wait: Callable[[], Awaitable[Optional[int]]],
+                 terminate: Callable[[], None],
+                 connection=None,
+                 check: bool = True,
+                 encoding: Optional[str] = 'utf-8',
+                 errors: str = 'strict'):
+        self._args = args
+        self._stdout = stdout
+        self._stderr = stderr
+        self._wait = wait
+        self._terminate = terminate
+        self._connection = connection
+        self._check = check
+        self._encoding = encoding
+        self._errors = errors
+        self._stderr_chunks: List[bytes] = []
+        self._stderr_task: Optional[asyncio.Task] = None
+        self._exit_status: Optional[int] = None
+        self._is_finished = False
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.info}>'
+
+    @property
+    def command(self):
+        return self._args[0]
+
+    @property
+    def info(self):
+        return self.command
+
+    @property
+    def stdout(self):
+        '''raw reader of stdout'''
+        return self._stdout
+
+    @property
+    def stderr(self) -> Union[str, bytes, None]:
+        if not self._is_finished:
+            raise RuntimeError(f'{self} is not finished.')
+        if self._stderr is None:
+            return None
+        return self._decode(b''.join(self._stderr_chunks))
+
+    @property
+    def exit_status(self) -> Optional[int]:
+        if not self._is_finished:
+            raise RuntimeError(f'{self} is not finished.')
+        return self._exit_status
+
+    @property
+    def success(self) -> bool:
+        return self.exit_status == 0
+
+    def _decode(self, data: bytes) -> Union[str, bytes]:
+        if self._encoding is None:
+            return data
+        return data.decode(self._encoding, self._errors)
+
+    async def __aenter__(self) -> 'RunStream':
+        if self._stderr is not None:
+            self._stderr_task = asyncio.create_task(self._drain_stderr())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb) -> None:
+        reached_eof = self._stdout is None or self._stdout.at_eof()
+        if exc_type is not None or not reached_eof:
+            logger.debug('Terminate {} before it ends', self)
+            with contextlib.suppress(ProcessLookupError, OSError):
+                self._terminate()
+            if self._stdout is not None:
+                # the pipe is only closed after it is read out
+                while await self._stdout.read(65536):
+                    pass
+        await self.wait()
+        if exc_type is None and reached_eof:
+            self.check_raise()
+
+    async def _drain_stderr(self) -> None:
+        while True:
+            chunk = await self._stderr.read(65536)
+            if not chunk:
+                break
+            self._stderr_chunks.append(chunk)
+
+    async def iter_lines(self, keepends: bool = False) -> AsyncIterator:
+        async for line in self._stdout:
+            # asyncssh's reader yields an empty line at EOF
+            if not line:
+                break
+            if not keepends:
+                line = line.rstrip(b'\r\n')
+            yield self._decode(line)
+
+    async def iter_chunks(self, size: int = 65536) -> AsyncIterator:
+        decoder = None if self._encoding is None else codecs.getincrementaldecoder(
+            self._encoding)(self._errors)
+        while True:
+            chunk = await self._stdout.read(size)
+            if not chunk:
+                break
+            yield chunk if decoder is None else decoder.decode(chunk)
+        if decoder is not None:
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+
+    async def wait(self) -> Optional[int]:
+        if not self._is_finished:
+            if self._stderr_task is not None:
+                await self._stderr_task
+            self._exit_status = await self._wait()
+            self._is_finished = True
+        return self._exit_status
+
+    def check_raise(self) -> None:
+        if self._check is True and not self.success:
+            raise pres.ExitStatusNotSuccess(
+                f'Exit status of <{self.info}> is {self.exit_status}', self)
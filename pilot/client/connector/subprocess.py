@@ -1,9 +1,14 @@
+import os
+import signal
 import asyncio
 import contextlib
 
 from . import agent as pagent
 from . import connection as pconn
 from . import result as pres
+from . import transfer as ptrans
+from . import limit as plimit
+from . import buffer as pbuffer
 
 
 class SubprocessRunResult(pres.CmdRunResult):
@@ -14,18 +19,25 @@ class SubprocessRunResult(pres.CmdRunResult):
         self._stdout = None
         self._stderr = None
 
+    async def _read_output(self, reader):
+        if reader is None:
+            return None
+        threshold = pbuffer.default_spill_threshold if self._connection is None else self._connection.spill_threshold
+        return await pbuffer.read_into(reader, threshold)
+
     async def wait(self):
-        self._stdout, self._stderr = tuple([
-            std if std is None else std.decode('utf-8')
-            for std in await self.origin.communicate()
-        ])
+        process = self.origin
+        self._stdout, self._stderr = await asyncio.gather(
+            self._read_output(process.stdout),
+            self._read_output(process.stderr))
+        await process.wait()
 
     @property
-    def stdout(self):
+    def _stdout_output(self):
         return self._stdout
 
     @property
-    def stderr(self):
+    def _stderr_output(self):
         return self._stderr
 
     @property
@@ -33,13 +45,63 @@ class SubprocessRunResult(pres.CmdRunResult):
         return self._origin.returncode
 
 
+def _create_subprocess(cmd, *args, **kwargs):
+    # a list is argv, which is executed without /bin/sh
+    if isinstance(cmd, (list, tuple)):
+        return asyncio.create_subprocess_exec(*cmd, *args, **kwargs)
+    return asyncio.create_subprocess_shell(cmd, *args, **kwargs)
+
+
 class SubprocessConnection(pconn.Connection):
     result_cls = SubprocessRunResult
+    # shared by all local connections, set its limit to change the cap
+    spawn_limiter = plimit.Limiter(max(32, 4 * (os.cpu_count() or 1)))
+
+    async def _get_result(self, args, kwargs, check, **decode):
+        # the slot is kept until the process exits
+        async with self.spawn_limiter.slot():
+            return await super()._get_result(args, kwargs, check, **decode)
 
     async def _run(self, *args, **kwargs):
         kwargs['stdout'] = kwargs.get('stdout', asyncio.subprocess.PIPE)
         kwargs['stderr'] = kwargs.get('stderr', asyncio.subprocess.PIPE)
-        return await asyncio.create_subprocess_shell(*args, **kwargs)
+        # spawning a process stands for opening a channel
+        with self.metrics.time('channel_open'):
+            return await _create_subprocess(*args, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def _stream(self, *args, **kwargs):
+        kwargs['stdout'] = kwargs.get('stdout', asyncio.subprocess.PIPE)
+        kwargs['stderr'] = kwargs.get('stderr', asyncio.subprocess.PIPE)
+        async with self.spawn_limiter.slot():
+            # own process group, so children of the shell are terminated too
+            process = await _create_subprocess(*args,
+                                               start_new_session=True,
+                                               **kwargs)
+
+            def terminate():
+                os.killpg(process.pid, signal.SIGTERM)
+
+            yield process.stdout, process.stderr, process.wait, terminate
+
+    @contextlib.asynccontextmanager
+    async def _open_shell(self):
+        process = await asyncio.create_subprocess_exec(
+            '/bin/sh',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True)
+        try:
+            yield process.stdin, process.stdout, process.stderr, process.wait
+        finally:
+            if process.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(process.pid, signal.SIGTERM)
+                await process.wait()
+
+    def _open_file(self, path, mode):
+        return ptrans.LocalFileSystem().open(path, mode)
 
 
 class SubprocessAgent(pagent.ConnectLocalAgent):
@@ -47,4 +109,8 @@ class SubprocessAgent(pagent.ConnectLocalAgent):
 
     @contextlib.asynccontextmanager
     async def _connect(enter_info, **kwargs):
-        yield SubprocessConnection(**kwargs)
+        conn = SubprocessConnection(**kwargs)
+        try:
+            yield conn
+        finally:
+            await conn.aclose()
@@ -0,0 +1,530 @@
+import asyncio
+import contextlib
+import dataclasses
+import errno
+import os
+import posixpath
+import stat as pstat
+import time
+import asyncssh
+from loguru import logger
+from typing import (
+    Callable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from . import limit as plimit
+
+_part_suffix = '.pilot-part'
+# size and mtime of the source, which the partial file is copied from
+_source_suffix = '.src'
+# symlinks followed to resolve a destination, the same as SYMLOOP_MAX
+_max_links = 40
+
+
+class FileStat(NamedTuple):
+    size: int
+    mode: int
+    atime: float = 0
+    mtime: float = 0
+    # file type bits of st_mode
+    kind: int = pstat.S_IFREG
+    uid: Optional[int] = None
+    gid: Optional[int] = None
+    # 1 if unknown, as sftp of version 3 has no link count
+    nlink: int = 1
+
+    @property
+    def is_dir(self) -> bool:
+        return pstat.S_ISDIR(self.kind)
+
+    @property
+    def is_link(self) -> bool:
+        return pstat.S_ISLNK(self.kind)
+
+
+def _source_tag(st: FileStat) -> bytes:
+    return f'{st.size} {st.mtime!r}'.encode()
+
+
+@dataclasses.dataclass
+class TransferStat:
+    files: int = 0
+    bytes: int = 0
+    resumed_bytes: int = 0
+    elapsed: float = 0
+
+    def __str__(self) -> str:
+        return f'{self.files} files, {self.bytes} bytes in {self.elapsed:.2f}s ({self.throughput / 2**20:.2f} MiB/s, {self.resumed_bytes} bytes resumed)'
+
+    @property
+    def throughput(self) -> float:
+        '''transferred bytes per second'''
+        if self.elapsed == 0:
+            return 0
+        return self.bytes / self.elapsed
+
+
+class _LocalFile:
+    '''blocks are read and written in threads, which would stall the loop'''
+    def __init__(self, fd: int, path: str) -> None:
+        self._fd = fd
+        self._path = path
+        self._pending: Set[asyncio.Future] = set()
+
+    def __repr__(self) -> str:
+        return self._path
+
+    async def size(self) -> int:
+        return os.fstat(self._fd).st_size
+
+    def _in_thread(self, func, *args) -> asyncio.Future:
+        fut = asyncio.get_running_loop().run_in_executor(None, func, *args)
+        self._pending.add(fut)
+        fut.add_done_callback(self._pending.discard)
+        return fut
+
+    async def read(self, size: int, offset: int) -> bytes:
+        return await self._in_thread(os.pread, self._fd, size, offset)
+
+    async def write(self, data: bytes, offset: int) -> None:
+        await self._in_thread(os.pwrite, self._fd, data, offset)
+
+    async def wait_pending(self) -> None:
+        '''wait for threads still using fd, whose callers may be cancelled'''
+        await asyncio.gather(*self._pending, return_exceptions=True)
+
+
+class _SFTPFile:
+    def __init__(self, f: asyncssh.SFTPClientFile, name: str) -> None:
+        self._f = f
+        self._name = name
+
+    def __repr__(self) -> str:
+        return self._name
+
+    async def size(self) -> int:
+        attrs = await self._f.stat()
+        return attrs.size
+
+    async def read(self, size: int, offset: int) -> bytes:
+        return await self._f.read(size, offset)
+
+    async def write(self, data: bytes, offset: int) -> None:
+        await self._f.write(data, offset)
+
+
+class LocalFileSystem:
+    _flags = {
+        'rb': os.O_RDONLY,
+        'r+b': os.O_RDWR,
+        'wb': os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        'w+b': os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+        'ab': os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+        'a+b': os.O_RDWR | os.O_CREAT | os.O_APPEND,
+        'xb': os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+        'x+b': os.O_RDWR | os.O_CREAT | os.O_EXCL,
+    }
+
+    def __repr__(self) -> str:
+        return 'localhost'
+
+    @staticmethod
+    def _stat(stat_func, path: str) -> Optional[FileStat]:
+        try:
+            st = stat_func(path)
+        except FileNotFoundError:
+            return None
+        return FileStat(size=st.st_size,
+                        mode=pstat.S_IMODE(st.st_mode),
+                        atime=st.st_atime,
+                        mtime=st.st_mtime,
+                        kind=pstat.S_IFMT(st.st_mode),
+                        uid=st.st_uid,
+                        gid=st.st_gid,
+                        nlink=st.st_nlink)
+
+    async def stat(self, path: str) -> Optional[FileStat]:
+        return self._stat(os.stat, path)
+
+    async def lstat(self, path: str) -> Optional[FileStat]:
+        return self._stat(os.lstat, path)
+
+    async def readlink(self, path: str) -> str:
+        return os.readlink(path)
+
+    async def symlink(self, target: str, path: str) -> None:
+        os.symlink(target, path)
+
+    async def isdir(self, path: str) -> bool:
+        return os.path.isdir(path)
+
+    async def listdir(self, path: str):
+        return os.listdir(path)
+
+    async def makedirs(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+
+    async def chmod(self, path: str, mode: int) -> None:
+        os.chmod(path, mode)
+
+    async def chown(self, path: str, uid: int, gid: int) -> None:
+        os.chown(path, uid, gid)
+
+    async def utime(self, path: str, atime: float, mtime: float) -> None:
+        os.utime(path, (atime, mtime))
+
+    async def replace(self, src: str, dst: str) -> None:
+        os.replace(src, dst)
+
+    async def remove(self, path: str) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+    @contextlib.asynccontextmanager
+    async def open(self, path: str, mode: str):
+        fd = os.open(path, self._flags[mode], 0o644)
+        f = _LocalFile(fd, path)
+        try:
+            yield f
+        finally:
+            try:
+                await f.wait_pending()
+            finally:
+                os.close(fd)
+
+
+class SFTPFileSystem:
+    def __init__(self, sftp: asyncssh.SFTPClient, name: str = 'sftp') -> None:
+        self._sftp = sftp
+        self._name = name
+
+    def __repr__(self) -> str:
+        return self._name
+
+    @staticmethod
+    async def _stat(stat_func, path: str) -> Optional[FileStat]:
+        try:
+            attrs = await stat_func(path)
+        except asyncssh.SFTPNoSuchFile:
+            return None
+        return FileStat(size=attrs.size,
+                        mode=pstat.S_IMODE(attrs.permissions),
+                        atime=attrs.atime or 0,
+                        mtime=attrs.mtime or 0,
+                        kind=pstat.S_IFMT(attrs.permissions),
+                        uid=attrs.uid,
+                        gid=attrs.gid,
+                        nlink=attrs.nlink or 1)
+
+    async def stat(self, path: str) -> Optional[FileStat]:
+        return await self._stat(self._sftp.stat, path)
+
+    async def lstat(self, path: str) -> Optional[FileStat]:
+        return await self._stat(self._sftp.lstat, path)
+
+    async def readlink(self, path: str) -> str:
+        return await self._sftp.readlink(path)
+
+    async def symlink(self, target: str, path: str) -> None:
+        await self._sftp.symlink(target, path)
+
+    async def isdir(self, path: str) -> bool:
+        return await self._sftp.isdir(path)
+
+    async def listdir(self, path: str):
+        return [
+            name for name in await self._sftp.listdir(path)
+            if name not in ('.', '..')
+        ]
+
+    async def makedirs(self, path: str) -> None:
+        await self._sftp.makedirs(path, exist_ok=True)
+
+    async def chmod(self, path: str, mode: int) -> None:
+        await self._sftp.chmod(path, mode)
+
+    async def chown(self, path: str, uid: int, gid: int) -> None:
+        await self._sftp.chown(path, uid, gid)
+
+    async def utime(self, path: str, atime: float, mtime: float) -> None:
+        await self._sftp.utime(path, (atime, mtime))
+
+    async def replace(self, src: str, dst: str) -> None:
+        try:
+            await self._sftp.posix_rename(src, dst)
+        except asyncssh.SFTPOpUnsupported:
+            if await self.stat(dst) is not None:
+                await self._sftp.remove(dst)
+            await self._sftp.rename(src, dst)
+
+    async def remove(self, path: str) -> None:
+        with contextlib.suppress(asyncssh.SFTPNoSuchFile):
+            await self._sftp.remove(path)
+
+    @contextlib.asynccontextmanager
+    async def open(self, path: str, mode: str):
+        async with self._sftp.open(path, mode, encoding=None) as f:
+            yield _SFTPFile(f, f'{self._name}:{path}')
+
+
+class Transfer:
+    '''Copy files or directories from src_fs to dst_fs.
+
+    A file is copied by windows of max_requests blocks, which are read and
+    written at once, and max_files files are copied at once. A directory is
+    walked without following symlinks, which are copied as symlinks, and its
+    files are handed to the copying tasks by a bounded queue. A file is
+    written to a partial file first, and renamed when finished. The partial
+    file of an interrupted copy is resumed from its last complete window.
+    A destination is written through its symlinks like scp does, and one
+    which is not a plain file or whose owner cannot be kept is written in
+    place, so its links and owner are kept.
+
+    preserve, recurse, progress_handler and error_handler are the same as
+    those of asyncssh.scp, so callers of it keep working, except that
+    recurse is on by default.
+    '''
+    def __init__(
+        self,
+        src_fs,
+        dst_fs,
+        *,
+        block_size: int = 256 * 1024,
+        max_requests: int = 16,
+        max_files: int = 4,
+        resume: bool = True,
+        preserve: bool = False,
+        recurse: bool = True,
+        progress_handler: Optional[Callable[[bytes, bytes, int, int],
+                                            None]] = None,
+        error_handler: Union[None, bool, Callable[[Exception], None]] = None
+    ) -> None:
+        self._src = src_fs
+        self._dst = dst_fs
+        self._block_size = block_size
+        self._max_requests = max_requests
+        self._max_files = max_files
+        self._file_limiter = plimit.Limiter(max_files, fifo=True)
+        self._resume = resume
+        self._preserve = preserve
+        self._recurse = recurse
+        self._progress_handler = progress_handler
+        self._error_handler = error_handler
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self._src} -> {self._dst}>'
+
+    async def copy(self, src: str, dst: str) -> TransferStat:
+        stat = TransferStat()
+        start = time.monotonic()
+        if await self._dst.isdir(dst):
+            dst = posixpath.join(dst, posixpath.basename(src.rstrip('/')))
+        if await self._src.isdir(src):
+            if not self._recurse:
+                raise IsADirectoryError(f'{src} is a directory on {self._src}')
+            await self._copy_dir(src, dst, stat)
+        else:
+            await self._copy_file(src, dst, stat)
+        stat.elapsed = time.monotonic() - start
+        logger.debug('{} copied {} to {}: {}', self, src, dst, stat)
+        return stat
+
+    async def _copy_dir(self, src: str, dst: str, stat: TransferStat) -> None:
+        queue: asyncio.Queue = asyncio.Queue(self._max_files)
+        tasks = [asyncio.create_task(self._walk(src, dst, queue, stat))]
+        tasks += [
+            asyncio.create_task(self._copy_queued(queue, stat))
+            for _ in range(self._max_files)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # the walk waits for room of the queue forever if copies fail
+            for task in tasks:
+                task.cancel()
+
+    async def _walk(self, src: str, dst: str, queue: asyncio.Queue,
+                    stat: TransferStat) -> None:
+        dirs = [(src, dst)]
+        while dirs:
+            src_dir, dst_dir = dirs.pop()
+            await self._dst.makedirs(dst_dir)
+            for name in await self._src.listdir(src_dir):
+                s = posixpath.join(src_dir, name)
+                d = posixpath.join(dst_dir, name)
+                st = await self._src.lstat(s)
+                if st is None:
+                    # removed in the meantime
+                    continue
+                if st.is_link:
+                    await self._copy_link(s, d, stat)
+                elif st.is_dir:
+                    dirs.append((s, d))
+                else:
+                    await queue.put((s, d))
+        for _ in range(self._max_files):
+            await queue.put(None)
+
+    async def _copy_queued(self, queue: asyncio.Queue,
+                           stat: TransferStat) -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            await self._copy_file(*item, stat)
+
+    @contextlib.contextmanager
+    def _handle_error(self, src: str) -> Iterator[None]:
+        try:
+            yield
+        except (OSError, asyncssh.Error) as e:
+            # the same as asyncssh.scp: None raises, False ignores
+            if self._error_handler is None:
+                raise
+            logger.warning('{} failed to copy {}, due to {}', self, src, e)
+            if self._error_handler:
+                self._error_handler(e)
+
+    async def _copy_link(self, src: str, dst: str, stat: TransferStat) -> None:
+        with self._handle_error(src):
+            target = await self._src.readlink(src)
+            await self._dst.remove(dst)
+            await self._dst.symlink(target, dst)
+            stat.files += 1
+
+    @property
+    def _window_size(self) -> int:
+        return self._block_size * self._max_requests
+
+    def _resume_offset(self, part_size: Optional[int], size: int) -> int:
+        if not self._resume or part_size is None or part_size > size:
+            return 0
+        # blocks of the last window may be written out of order
+        return max(0, part_size -
+                   self._window_size) // self._block_size * self._block_size
+
+    async def _read_source_tag(self, path: str) -> Optional[bytes]:
+        tag_stat = await self._dst.stat(path)
+        if tag_stat is None:
+            return None
+        async with self._dst.open(path, 'rb') as f:
+            return await f.read(tag_stat.size, 0)
+
+    async def _write_source_tag(self, path: str, tag: bytes) -> None:
+        async with self._dst.open(path, 'wb') as f:
+            await f.write(tag, 0)
+
+    async def _part_offset(self, part: str, tag_path: str,
+                           src_stat: FileStat) -> int:
+        '''offset to resume the partial file from, which is 0 if it is
+        copied from another version of the source'''
+        if not self._resume:
+            return 0
+        part_stat = await self._dst.stat(part)
+        if part_stat is None:
+            return 0
+        if await self._read_source_tag(tag_path) != _source_tag(src_stat):
+            logger.debug('{} copy {} over, its source is changed', self, part)
+            return 0
+        return self._resume_offset(part_stat.size, src_stat.size)
+
+    async def _copy_file(self, src: str, dst: str, stat: TransferStat) -> None:
+        with self._handle_error(src):
+            await self._copy_file_data(src, dst, stat)
+
+    async def _resolve(self, dst: str) -> Tuple[str, Optional[FileStat]]:
+        '''dst with its symlinks followed, and its stat'''
+        for _ in range(_max_links):
+            st = await self._dst.lstat(dst)
+            if st is None or not st.is_link:
+                return dst, st
+            target = await self._dst.readlink(dst)
+            dst = posixpath.join(posixpath.dirname(dst), target)
+        raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), dst)
+
+    async def _take_over(self, part: str, dst_stat: FileStat) -> bool:
+        '''whether the existing destination can be replaced by part, which
+        is given the owner of the destination'''
+        if dst_stat.kind != pstat.S_IFREG or dst_stat.nlink > 1:
+            return False
+        if dst_stat.uid is None or dst_stat.gid is None:
+            return True
+        if await self._dst.stat(part) is None:
+            async with self._dst.open(part, 'wb'):
+                pass
+        try:
+            await self._dst.chown(part, dst_stat.uid, dst_stat.gid)
+        except (PermissionError, asyncssh.SFTPPermissionDenied):
+            await self._dst.remove(part)
+            return False
+        return True
+
+    async def _copy_file_data(self, src: str, dst: str,
+                              stat: TransferStat) -> None:
+        async with self._file_limiter.slot():
+            src_stat = await self._src.stat(src)
+            if src_stat is None:
+                raise FileNotFoundError(f'{src} is not found on {self._src}')
+            dst, dst_stat = await self._resolve(dst)
+            part = dst + _part_suffix
+            if dst_stat is not None and not await self._take_over(
+                    part, dst_stat):
+                logger.debug('{} write {} in place', self, dst)
+                await self._write_file(src, dst, dst, src_stat, 0, stat)
+                if self._preserve:
+                    await self._set_attrs(dst, src_stat)
+                stat.files += 1
+                return
+            tag_path = part + _source_suffix
+            offset = await self._part_offset(part, tag_path, src_stat)
+            # a file of one window is never resumed, so it needs no tag
+            tagged = src_stat.size > self._window_size
+            if offset:
+                logger.debug('{} resume {} from {}', self, part, offset)
+            elif tagged:
+                await self._write_source_tag(tag_path, _source_tag(src_stat))
+            await self._write_file(src, part, dst, src_stat, offset, stat)
+            if dst_stat is None or self._preserve:
+                await self._set_attrs(part, src_stat)
+            else:
+                # the same as writing to the existing one
+                await self._dst.chmod(part, dst_stat.mode)
+            await self._dst.replace(part, dst)
+            if tagged:
+                await self._dst.remove(tag_path)
+            stat.files += 1
+
+    async def _set_attrs(self, path: str, src_stat: FileStat) -> None:
+        await self._dst.chmod(path, src_stat.mode)
+        if self._preserve:
+            await self._dst.utime(path, src_stat.atime, src_stat.mtime)
+
+    async def _write_file(self, src: str, path: str, dst: str,
+                          src_stat: FileStat, offset: int,
+                          stat: TransferStat) -> None:
+        '''write src to path from offset, which is reported as dst'''
+        size = src_stat.size
+        async with self._src.open(src, 'rb') as fsrc, self._dst.open(
+                path, 'r+b' if offset else 'wb') as fdst:
+            stat.resumed_bytes += offset
+            while offset < size:
+                window = range(offset, min(size, offset + self._window_size),
+                               self._block_size)
+                written = await asyncio.gather(
+                    *[self._copy_block(fsrc, fdst, o) for o in window])
+                stat.bytes += sum(written)
+                offset = window.stop
+                if self._progress_handler is not None:
+                    self._progress_handler(src.encode(), dst.encode(), offset,
+                                           size)
+
+    async def _copy_block(self, fsrc, fdst, offset: int) -> int:
+        data = await fsrc.read(self._block_size, offset)
+        await fdst.write(data, offset)
+        return len(data)
@@ -1,6 +1,7 @@
 from __future__ import annotations
 import os
 import contextlib
+import shlex
 import async_property
 import tempfile
 import asyncclick as click
@@ -13,11 +14,16 @@ from typing import (
     Union,
     Tuple,
     Dict,
+    Iterable,
+    List,
+    Set,
     Type,
     overload,
     Final,
 )
 
+from pilot import loop as ploop
+from . import delta as pdelta
 from . import spec as pspec
 from . import connector as pconn
 from . import obj as pobj
@@ -29,9 +35,56 @@ SubID = TypeVar('SubID', str, int)
 
 
 class _PerClientConnector(pconn.Connector):
-    def __init__(self, spec: Spec):
+    def __init__(self,
+                 spec: Spec,
+                 jump_connector: Optional[pconn.Connector] = None):
         super().__init__()
         self._spec = spec
+        # connections to bastions, which are shared by clients behind them
+        self._jump_connector = jump_connector or self
+        self._admissions: Dict[Tuple[str, str], pconn.Admission] = {}
+
+    def _admission_host(self, setting: pspec.ConnectSetting) -> str:
+        if issubclass(setting.connect_agent, pconn.ConnectLocalAgent):
+            return 'localhost'
+        enter_info, _, _ = self._spec.get_enter_info(setting)
+        return getattr(enter_info, 'host', 'localhost')
+
+    def admission(self,
+                  setting: pspec.ConnectSetting) -> Optional[pconn.Admission]:
+        '''admission of setting, or that of the spec shared by its host'''
+        host = self._admission_host(setting)
+        admission_setting = setting.admission
+        key = ('setting', setting.name)
+        if admission_setting is None:
+            admission_setting = self._spec.admission
+            key = ('host', host)
+        if admission_setting is None:
+            return None
+        admission = self._admissions.get(key)
+        if admission is None:
+            admission = self._admissions[key] = pconn.Admission(
+                rate=admission_setting.rate,
+                burst=admission_setting.burst,
+                max_in_flight=admission_setting.max_in_flight,
+                metrics=pconn.metrics_registry.host(host))
+        return admission
+
+    def jump(self,
+             setting: pspec.ConnectSetting) -> Optional[pconn.LazyConnection]:
+        '''connection to the jump host of setting, connected at the first use'''
+        if setting.jump_host is None:
+            return None
+        info = setting.jump_host
+
+        async def connect():
+            return await self._jump_connector.connect_by_agent(
+                pconn.AsyncsshAgent,
+                info=info,
+                conn_id=f'jump:{info.info_str}',
+                **setting.jump_kwargs)
+
+        return pconn.LazyConnection(connect, name=info.info_str)
 
     @overload
     async def connect(self, conn_agent: Type[Agent],
@@ -47,6 +100,12 @@ class _PerClientConnector(pconn.Connector):
         setting = self._spec.get_connect_setting(conn)
         agent = setting.connect_agent
         enter_info, args, kwargs = self._spec.get_enter_info(setting)
+        tunnel = self.jump(setting)
+        if tunnel is not None:
+            kwargs = dict(kwargs, tunnel=tunnel)
+        admission = self.admission(setting)
+        if admission is not None:
+            kwargs = dict(kwargs, admission=admission)
         return await self.connect_by_agent(
             agent,
             *args,
@@ -88,7 +147,7 @@ class Client(pobj.ObjOwner):
         return await self._connector.connect(conn, sub_id)
 
     async def close_all(self) -> None:
-        self._connector.close_all()
+        await self._connector.close_all()
 
 
 _Client = TypeVar('_Client', bound=Client)
@@ -106,35 +165,91 @@ class ShellClient(Client, Generic[Agent]):
             del self.shell
         await super().close_all()
 
-    async def run(self, *args, **kwargs) -> pconn.RunResult:
+    async def _get_shell(self) -> Agent.connection_cls:
         shell = await self.shell
+        if not shell.is_alive:
+            # the connector reconnects the dead one
+            del self.shell
+            shell = await self.shell
+        return shell
+
+    async def run(self, *args, **kwargs) -> pconn.RunResult:
+        shell = await self._get_shell()
         return await shell.run(*args, **kwargs)
 
+    async def run_many(self, *args, **kwargs) -> List[pconn.CmdRunResult]:
+        shell = await self._get_shell()
+        return await shell.run_many(*args, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, *args, **kwargs):
+        shell = await self._get_shell()
+        async with shell.stream(*args, **kwargs) as stream:
+            yield stream
+
     @staticmethod
     async def scp(source: Union[str, Tuple[ShellClient, str]],
                   destination: Union[str, Tuple[ShellClient,
                                                 str]], **kwargs) -> None:
         async def t(target):
             if isinstance(target, tuple):
-                target = (await target[0].shell, target[1])
+                target = (await target[0]._get_shell(), target[1])
             return target
 
         return await pconn.scp(await t(source), await t(destination), **kwargs)
 
     @contextlib.asynccontextmanager
-    async def use_file(self, file: str, write_mode: bool = False) -> str:
+    async def use_file(self,
+                       file: str,
+                       write_mode: bool = False,
+                       delta: bool = True) -> str:
         tmp_path = tempfile.mktemp(suffix='ssstool_open_')
         await self.scp((self, file), tmp_path)
+        signature = pdelta.Signature.from_file(
+            tmp_path) if write_mode is True and delta is True else None
         yield tmp_path
         if write_mode is True:
-            await self.scp(tmp_path, (self, file))
+            if signature is None or not await self._put_delta(
+                    tmp_path, file, signature):
+                await self.scp(tmp_path, (self, file))
         os.remove(tmp_path)
 
+    async def _put_delta(self, local_path: str, file: str,
+                         signature: pdelta.Signature) -> bool:
+        if pdelta.file_md5(local_path) == signature.md5:
+            logger.debug('{} is not changed', file)
+            return True
+
+        delta_path = tempfile.mktemp(suffix='ssstool_delta_')
+        remote_delta_path = f'{file}.pilot-delta'
+        try:
+            with open(delta_path, 'wb') as f:
+                if not signature.delta_file(
+                        local_path,
+                        f,
+                        max_literal=os.path.getsize(local_path) // 2):
+                    return False
+            delta_size = os.path.getsize(delta_path)
+            await self.scp(delta_path, (self, remote_delta_path))
+        finally:
+            os.remove(delta_path)
+        res = await self.run(
+            f'python3 -c {shlex.quote(pdelta.apply_script)} {shlex.quote(remote_delta_path)} {shlex.quote(file)} {signature.block_size} {signature.md5}',
+            check=False)
+        if res.exit_status != 0:
+            logger.warning(
+                'Failed to apply delta to {} (exit status {}), so copy whole file',
+                file, res.exit_status)
+            await self.run(f'/bin/rm -f {shlex.quote(remote_delta_path)}')
+            return False
+        logger.debug('{} is updated by delta of {} bytes', file, delta_size)
+        return True
+
     @contextlib.asynccontextmanager
-    async def open(self, file: str, mode: str, *args, **kwargs):
-        async with self.use_file(file, write_mode='w' in mode) as fpath:
-            with open(fpath, mode, *args, **kwargs) as f:
-                yield f
+    async def open(self, file: str, mode: str = 'r', **kwargs):
+        shell = await self._get_shell()
+        async with shell.open_file(file, mode, **kwargs) as f:
+            yield f
 
 
 class SubprocessClient(ShellClient):
@@ -168,13 +283,28 @@ class ClientCachedPool(contextlib.AsyncExitStack):
     def __init__(self, client_info_map: Dict[str, Spec]):
         super().__init__()
         self._client_specs: Dict[str, Spec] = client_info_map
+        self._client_limiters: Dict[str, pconn.Limiter] = {}
+        # run_on calls in flight by client, and clients whose connections
+        # are closed after the last of them
+        self._client_runs: Dict[str, int] = {}
+        self._close_after_runs: Set[str] = set()
+        self._jump_connector: Optional[pconn.Connector] = None
 
     @async_property.async_cached_property
     async def connector_pool(
             self) -> pconn.ConnectorCachedPool[_PerClientConnector]:
+        # entered first, so bastions are closed after hosts behind them
+        self._jump_connector = await self.enter_async_context(
+            pconn.Connector())
         return await self.enter_async_context(
             pconn.ConnectorCachedPool(connector_type=_PerClientConnector))
 
+    async def _get_connector(self, client_name: str,
+                             spec: Spec) -> _PerClientConnector:
+        connector_pool = await self.connector_pool
+        return await connector_pool.get(client_name, spec,
+                                        self._jump_connector)
+
     def get_client_spec(self, client_name) -> Spec:
         # TODO: fix localhost
         client_spec = self._client_specs.get(client_name)
@@ -184,13 +314,134 @@ class ClientCachedPool(contextlib.AsyncExitStack):
 
     async def get_client(self, client_name: str, *args, **kwargs) -> _Client:
         spec = self.get_client_spec(client_name)
-        connector_pool = await self.connector_pool
-        connector = await connector_pool.get(client_name, spec)
+        connector = await self._get_connector(client_name, spec)
         return spec.gen_client(*args,
                                connector=connector,
                                name=client_name,
                                **kwargs)
 
+    def _get_client_limiter(self, client_name: str,
+                            per_client: int) -> pconn.Limiter:
+        '''one limiter of a client shared by run_on calls, whose limit is
+        per_client of the latest call'''
+        limiter = self._client_limiters.get(client_name)
+        if limiter is None:
+            limiter = self._client_limiters[client_name] = pconn.Limiter(
+                per_client)
+        elif limiter.limit != per_client:
+            limiter.limit = per_client
+        return limiter
+
+    def run_on(self,
+               client_names: Iterable[str],
+               *args,
+               concurrency: int = 64,
+               per_client: int = 4,
+               keep_connection: bool = True,
+               **kwargs) -> ploop.FanOut[str, pconn.RunResult]:
+        async def run(client_name):
+            client = await self.get_client(client_name)
+            limiter = self._get_client_limiter(client_name, per_client)
+            opened = not client._connector.connected
+            self._client_runs[client_name] = self._client_runs.get(
+                client_name, 0) + 1
+            try:
+                async with limiter.slot():
+                    return await client.run(*args, **kwargs)
+            finally:
+                if keep_connection is False and opened:
+                    self._close_after_runs.add(client_name)
+                self._client_runs[client_name] -= 1
+                # other calls may be running on what this one opened
+                if self._client_runs[client_name] == 0:
+                    del self._client_runs[client_name]
+                    if client_name in self._close_after_runs:
+                        self._close_after_runs.discard(client_name)
+                        await client.close_all()
+
+        return ploop.FanOut(client_names, run, concurrency=concurrency)
+
+    async def prewarm(
+        self,
+        client_names: Iterable[str],
+        agents: Optional[Iterable[Union[str, Type[Agent]]]] = None,
+        concurrency: int = 32,
+    ) -> List[ploop.FanOutResult[str, None]]:
+        '''connect clients at once, so their first commands need not wait'''
+        agents = None if agents is None else list(agents)
+
+        async def connect(client_name):
+            client = await self.get_client(client_name)
+            if agents is not None:
+                for agent in agents:
+                    await client.connect(agent)
+            elif isinstance(client, ShellClient):
+                await client._get_shell()
+            else:
+                for name in self.get_client_spec(client_name).connect_names:
+                    await client.connect(name)
+
+        results = await ploop.FanOut(client_names,
+                                     connect,
+                                     concurrency=concurrency).collect()
+        for res in results:
+            if res.success:
+                logger.debug('Prewarmed {} in {:.3f}s', res.key, res.elapsed)
+            else:
+                logger.warning('Failed to prewarm {} in {:.3f}s, due to {}',
+                               res.key, res.elapsed, res.error)
+        if results:
+            slowest = max(results, key=lambda res: res.elapsed)
+            logger.info('Prewarmed {}/{} clients, the slowest is {} ({:.3f}s)',
+                        sum(res.success for res in results), len(results),
+                        slowest.key, slowest.elapsed)
+        return results
+
+    async def provision_keys(
+        self,
+        client_names: Iterable[str],
+        pub_key_path: Optional[str] = None,
+        concurrency: int = 32,
+    ) -> List[ploop.FanOutResult[str, bool]]:
+        '''authorize the local public key on clients by their passwords
+
+        Each result tells whether the key is added, it is False when the key
+        was there already.
+        '''
+        pub_key = pconn.load_pub_key(pub_key_path)
+
+        async def provision(client_name):
+            spec = self.get_client_spec(client_name)
+            setting = next(
+                (s for s in spec.connect_settings
+                 if issubclass(s.connect_agent, pconn.ConnectRemoteAgent)),
+                None)
+            if setting is None:
+                raise click.UsageError(
+                    f'{client_name} has no remote connect setting')
+            enter_info, _, kwargs = spec.get_enter_info(setting)
+            connector = await self._get_connector(client_name, spec)
+            # expect runs on the bastion of a jump host
+            tunnel = connector.jump(setting)
+            tunnel = kwargs.get(
+                'tunnel') if tunnel is None else await tunnel.get()
+            return await pconn.provision_key(connector,
+                                             enter_info,
+                                             pub_key,
+                                             tunnel=tunnel)
+
+        results = await ploop.FanOut(client_names,
+                                     provision,
+                                     concurrency=concurrency).collect()
+        for res in results:
+            if not res.success:
+                logger.warning('Failed to provision key on {}, due to {}',
+                               res.key, res.error)
+        logger.info('Provisioned key on {}/{} clients, {} added',
+                    sum(res.success for res in results), len(results),
+                    sum(bool(res.value) for res in results))
+        return results
+
     async def get_client_obj_getter(
         self,
         client,
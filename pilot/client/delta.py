@@ -0,0 +1,189 @@
+import hashlib
+import math
+import os
+import struct
+import zlib
+from typing import (
+    BinaryIO,
+    Dict,
+    Optional,
+)
+
+# adler32 of zlib is the weak checksum, whose sums are modulo this
+_mod = 65521
+# files are read by this, and literal data is sent by at most this
+_chunk_size = 1 << 20
+_copy = b'C'
+_data = b'D'
+_head = struct.Struct('>cII')
+
+# run by python3 on the remote host: <delta> <target> <block size> <md5 of target>
+# exit 3 when the target is not the file which the delta is based on.
+# The target is written through its symlinks, and the new file is given its
+# owner and mode, or written over it in place if that cannot be done.
+apply_script = '''
+import hashlib, os, shutil, struct, sys
+delta, target, block_size, md5 = sys.argv[1:]
+target = os.path.realpath(target)
+block_size = int(block_size)
+head = struct.Struct('>cII')
+h = hashlib.md5()
+with open(target, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+if h.hexdigest() != md5:
+    sys.exit(3)
+tmp = target + '.pilot-new'
+with open(target, 'rb') as old, open(delta, 'rb') as d, open(tmp, 'wb') as out:
+    while True:
+        raw = d.read(head.size)
+        if not raw:
+            break
+        op, a, b = head.unpack(raw)
+        if op == b'C':
+            old.seek(a * block_size)
+            out.write(old.read(b * block_size))
+        else:
+            out.write(d.read(a))
+st = os.stat(target)
+try:
+    os.chown(tmp, st.st_uid, st.st_gid)
+    replace = st.st_nlink == 1
+except PermissionError:
+    replace = False
+if replace:
+    os.chmod(tmp, st.st_mode & 0o7777)
+    os.replace(tmp, target)
+else:
+    with open(tmp, 'rb') as new, open(target, 'wb') as out:
+        shutil.copyfileobj(new, out, 1 << 20)
+    os.remove(tmp)
+os.remove(delta)
+'''
+
+
+def file_md5(path: str) -> str:
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Signature:
+    '''Block checksums of a file, which a new version is compared against.
+
+    It is the rsync algorithm: a weak rolling checksum finds candidate blocks
+    at any offset, and md5 confirms them. Files are read by chunks, so memory
+    is bounded by the number of blocks instead of the file size.
+
+    The weak checksum of a block is adler32 of zlib. Rolling it one byte
+    forward is done in Python, which is only needed over data matching no
+    block, so the time of delta grows with changed bytes, and it gives up
+    after max_literal of them.
+    '''
+    def __init__(self, block_size: int) -> None:
+        self.size = 0
+        self.block_size = block_size
+        self.md5 = hashlib.md5().hexdigest()
+        self._blocks: Dict[int, Dict[bytes, int]] = {}
+
+    @staticmethod
+    def default_block_size(size: int) -> int:
+        return max(2048, min(1 << 16, 1 << math.isqrt(size).bit_length()))
+
+    @classmethod
+    def from_file(cls, path: str, block_size: int = None) -> 'Signature':
+        sig = cls(block_size or cls.default_block_size(os.path.getsize(path)))
+        bs = sig.block_size
+        h = hashlib.md5()
+        with open(path, 'rb') as f:
+            for i, block in enumerate(iter(lambda: f.read(bs), b'')):
+                sig.size += len(block)
+                h.update(block)
+                # the last short block is never matched, it is sent as data
+                if len(block) == bs:
+                    sig._blocks.setdefault(zlib.adler32(block), {}).setdefault(
+                        hashlib.md5(block).digest(), i)
+        sig.md5 = h.hexdigest()
+        return sig
+
+    def _match(self, weak: int, block: bytes) -> Optional[int]:
+        strongs = self._blocks.get(weak)
+        if strongs is None:
+            return None
+        return strongs.get(hashlib.md5(block).digest())
+
+    def delta_file(self,
+                   path: str,
+                   out: BinaryIO,
+                   max_literal: Optional[int] = None) -> bool:
+        '''write the file at path to out as copies of blocks and literal data
+
+        False is returned when literal data is more than max_literal, then it
+        is cheaper to send the file itself, and out is incomplete.
+        '''
+        bs = self.block_size
+        if max_literal is None:
+            max_literal = os.path.getsize(path)
+        # data of the file from its offset base, which is not written yet
+        buf = bytearray()
+        eof = False
+        pos = 0
+        copy_start, copy_num = 0, 0
+        literal_start = 0
+        literal_sent = 0
+        weak = None
+
+        def flush(end):
+            nonlocal copy_num, literal_start, literal_sent
+            if copy_num:
+                out.write(_head.pack(_copy, copy_start, copy_num))
+                copy_num = 0
+            if end > literal_start:
+                literal_sent += end - literal_start
+                out.write(_head.pack(_data, end - literal_start, 0))
+                out.write(buf[literal_start:end])
+                literal_start = end
+
+        with open(path, 'rb') as f:
+            while True:
+                if len(buf) - pos <= bs and not eof:
+                    # drop written data, and read the next chunk
+                    del buf[:literal_start]
+                    pos -= literal_start
+                    literal_start = 0
+                    chunk = f.read(_chunk_size)
+                    eof = not chunk
+                    buf += chunk
+                    continue
+                if len(buf) - pos < bs:
+                    break
+                block = bytes(buf[pos:pos + bs])
+                if weak is None:
+                    weak = zlib.adler32(block)
+                index = self._match(weak, block)
+                if index is not None:
+                    if copy_num and index == copy_start + copy_num and literal_start == pos:
+                        copy_num += 1
+                    else:
+                        flush(pos)
+                        copy_start, copy_num = index, 1
+                    pos += bs
+                    literal_start = pos
+                    weak = None
+                    continue
+                if pos + bs == len(buf):
+                    break
+                if literal_sent + pos - literal_start >= max_literal:
+                    return False
+                if pos - literal_start >= _chunk_size:
+                    flush(pos)
+                # roll one byte forward
+                old, new = buf[pos], buf[pos + bs]
+                a = (weak & 0xffff) - old + new
+                b = (weak >> 16) - bs * old + a - 1
+                weak = (b % _mod) << 16 | a % _mod
+                pos += 1
+            flush(len(buf))
+        return literal_sent <= max_literal
@@ -8,11 +8,13 @@ from loguru import logger
 from typing import (Dict)
 
 from pilot import conf as pconf
+from pilot import error as perr
 from . import obj as pobj
 
 
 class CachedInfoUtil(pobj.CachedInfoGroupEntry):
-    @pobj.cached_info(depend_on_id=False)
+    # outputs of commands change, and daemons run many distinct commands
+    @pobj.cached_info(depend_on_id=False, ttl=300)
     async def get_by_cmd(self, cmd: str) -> str:
         res = await self.owner.run(cmd,
                                    redirect_stderr_tty=True,
@@ -26,6 +28,8 @@ class CachedInfoUtil(pobj.CachedInfoGroupEntry):
                     *,
                     event: anyio.Event,
                     interval: float = 0.1):
+        # the watch is restarted when its transport is lost
+        @perr.retry(ConnectionError, max_get=3, interval=1)
         async def watch(buf, msg):
             cmd = f'''first="true"; \
 echo "{msg}";
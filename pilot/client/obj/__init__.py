@@ -9,6 +9,7 @@ from .core import (
     SingletonObj,
     IdIdentifiedObj,
     ObjOwner,
+    InfoGetterStore,
 )
 from .state import (
     StateEnum,
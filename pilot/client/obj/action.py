@@ -14,6 +14,8 @@ from typing import (
 from loguru import logger
 
 from pilot import error as perr
+from pilot import trace as ptrace
+from pilot.client.connector import limit as plimit
 from . import core as pcore
 from . import info as pinfo
 from . import state as pstate
@@ -64,7 +66,8 @@ class _Acting(pinfo.CachedInfoGroupEntry, Generic[_Action, Result]):
         def clean_cache():
             self._action.clean_cache(obj=self._obj)
 
-        @perr.retry(_UnexpectedStateError,
+        # ConnectionError is retried to ride out a lost transport
+        @perr.retry((_UnexpectedStateError, ConnectionError),
                     max_get=max_get,
                     interval=interval,
                     when_retry_it=clean_cache)
@@ -86,7 +89,13 @@ class _Acting(pinfo.CachedInfoGroupEntry, Generic[_Action, Result]):
                 logger.debug('wait failed due to {}', e)
                 raise
 
-        self._exit_state: pstate._State = await wait_finish()
+        with ptrace.span('wait_finish',
+                         action=self._action.name,
+                         obj=self._obj) as span:
+            with plimit.priority(plimit.Priority.ACTION):
+                self._exit_state: pstate._State = await wait_finish()
+            if span is not None:
+                span.set(exit_state=self._exit_state)
         self._is_finished = True
         return self
 
@@ -242,12 +251,18 @@ class Action(pcore.ProxyObj, Generic[Obj, Result]):
     def register_hook(self):
         pass
 
-    async def __call__(self,
-                       *args,
-                       exception=Exception,
-                       max_get: Optional[int] = None,
-                       interval: Optional[int] = None,
-                       **kwargs):
+    async def __call__(self, *args, **kwargs):
+        with ptrace.span('action', action=self.name, obj=self._obj):
+            # commands of an action go ahead of background polls
+            with plimit.priority(plimit.Priority.ACTION):
+                return await self._call(*args, **kwargs)
+
+    async def _call(self,
+                    *args,
+                    exception=Exception,
+                    max_get: Optional[int] = None,
+                    interval: Optional[int] = None,
+                    **kwargs):
         # TODO: record action failed time
         max_get = max_get or self.func_max_get
         interval = interval or self.func_interval
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import collections
 from loguru import logger
 from abc import (
     ABC,
@@ -12,6 +13,7 @@ from typing import (
     runtime_checkable,
     Dict,
     Any,
+    Iterator,
     Protocol,
 )
 
@@ -29,7 +31,7 @@ class ObjStorable(Protocol):
         ...
 
     @property
-    def info_getter_stores(self) -> Dict[int, pinfo._CachedInfoGetterBase]:
+    def info_getter_stores(self) -> InfoGetterStore:
         ...
 
 
@@ -110,13 +112,82 @@ class ProxyObj(_Obj):
         return self._parent.id
 
 
+class InfoGetterStore:
+    '''Getters of cached infos of an owner, which is bounded by max_size.
+
+    The least recently used getters are evicted beyond max_size, except
+    those loading their value. An expired getter is dropped when it is got,
+    so a new one loads the value again. Both clean the caches which the
+    getter depends on, as deleting the info does.
+    '''
+    def __init__(self, max_size: Optional[int] = None) -> None:
+        self._getters: collections.OrderedDict[
+            Any, pinfo._CachedInfoGetterBase] = collections.OrderedDict()
+        self.max_size = max_size
+        self.evictions = 0
+        self.expirations = 0
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} size={len(self)} max_size={self.max_size} evictions={self.evictions} expirations={self.expirations}>'
+
+    def __len__(self) -> int:
+        return len(self._getters)
+
+    def __contains__(self, info_id) -> bool:
+        return info_id in self._getters
+
+    def __iter__(self) -> Iterator:
+        return iter(self._getters)
+
+    def peek(self, info_id) -> Optional[pinfo._CachedInfoGetterBase]:
+        '''get without touching its recency or expiration'''
+        return self._getters.get(info_id)
+
+    def get(self, info_id) -> Optional[pinfo._CachedInfoGetterBase]:
+        getter = self._getters.get(info_id)
+        if getter is None:
+            return None
+        # a loading getter reloads the expired value by itself
+        if getter.expired and not getter.loading:
+            del self._getters[info_id]
+            self.expirations += 1
+            getter.invalidate(self, due_to='expiration')
+            return None
+        self._getters.move_to_end(info_id)
+        return getter
+
+    def __setitem__(self, info_id, getter: pinfo._CachedInfoGetterBase):
+        self._getters[info_id] = getter
+        self._getters.move_to_end(info_id)
+        self._evict(keep=info_id)
+
+    def _evict(self, keep) -> None:
+        if self.max_size is None or len(self._getters) <= self.max_size:
+            return
+        excess = len(self._getters) - self.max_size
+        victims = []
+        for info_id, getter in self._getters.items():
+            if len(victims) == excess:
+                break
+            if info_id != keep and not getter.loading:
+                victims.append((info_id, getter))
+        for info_id, getter in victims:
+            del self._getters[info_id]
+            self.evictions += 1
+            getter.invalidate(self, due_to='eviction')
+        logger.debug('{} evicted {} getters', self, len(victims))
+
+
 class ObjOwner(Obj):
     '''Owner of obj is also a obj'''
+    # set it to bound getters of each owner, None is unbounded
+    max_info_getters: Optional[int] = 4096
+
     def __init__(self) -> None:
         super().__init__()
         self._obj_stores: Dict[Optional[int], 'Obj'] = {}
         # TODO: with lock
-        self._info_getter_stores: Dict[int, pinfo._CachedInfoGetterBase] = {}
+        self._info_getter_stores = InfoGetterStore(self.max_info_getters)
 
     # following methods are for ObjStorable
     @property
@@ -124,7 +195,7 @@ class ObjOwner(Obj):
         return self._obj_stores
 
     @property
-    def info_getter_stores(self) -> Dict[int, pinfo._CachedInfoGetterBase]:
+    def info_getter_stores(self) -> InfoGetterStore:
         return self._info_getter_stores
 
     # following methods are for Obj
@@ -4,6 +4,7 @@ import functools
 import collections
 import enum
 import asyncio
+import time
 import anyio
 from abc import abstractmethod
 from loguru import logger
@@ -21,6 +22,7 @@ from typing import (
     overload,
 )
 
+from pilot import trace as ptrace
 from . import core as pcore
 from .error import ObjUsage
 
@@ -99,8 +101,10 @@ class _CachedInfoGetterBase(Generic[Spec, Cached]):
     _cached_value: Cached
 
     def __init__(self, spec: Spec, obj: Obj, info_id: InfoId):
+        self._spec = spec
         self._info_id = info_id
         self._is_cached: bool = False
+        self._cached_at: float = 0
 
         self._get_func = functools.partial(spec.func, obj, *info_id.args,
                                            **info_id.kwargs)
@@ -108,37 +112,82 @@ class _CachedInfoGetterBase(Generic[Spec, Cached]):
     def __repr__(self) -> str:
         return f'<{self.__class__.__name__} info_id={self._info_id}>'
 
+    @property
+    def loading(self) -> bool:
+        return False
+
+    @property
+    def expired(self) -> bool:
+        ttl = self._spec.ttl
+        return self._is_cached and ttl is not None and time.monotonic(
+        ) - self._cached_at >= ttl
+
+    def _store(self, value: Cached) -> None:
+        self._cached_value = value
+        self._is_cached = True
+        self._cached_at = time.monotonic()
+
     @abstractmethod
     def get(self) -> Cached:
         pass
 
     @abstractmethod
-    def clean_cache(self) -> None:
+    def clean_cache(self, due_to: Optional[str] = None) -> None:
         pass
 
+    def invalidate(self, info_getter_stores, due_to: str) -> None:
+        '''clean the cache and caches it depends on, like deleting the info
+
+        Getters which are not stored are not created for it.
+        '''
+        self.clean_cache(due_to=due_to)
+        for depend_info in self._spec.depend_infos:
+            depended_info_id = depend_info.to_info_id(self._info_id.obj_id)
+            getter = info_getter_stores.peek(depended_info_id)
+            if getter is not None:
+                getter.clean_cache(due_to=self)
+
 
 class _AsyncCachedInfoGetter(_CachedInfoGetterBase):
     def __init__(self, spec: Spec, obj: Obj, info_id: InfoId):
         super().__init__(spec, obj, info_id=info_id)
         self._lock = anyio.Lock()
+        self._loaders = 0
+
+    @property
+    def loading(self) -> bool:
+        return self._loaders > 0
 
     def get(self) -> Cached:
         get_func = self._get_func
 
         @functools.wraps(get_func)
         async def load_value():
-            async with self._lock:
-                if self._is_cached:
-                    logger.debug('{} gets {} from cache', self,
-                                 self._cached_value)
-                    return self._cached_value
-                value = await get_func()
-                self._cached_value = value
-                self._is_cached = True
-                logger.debug('{} gets {} and stores it to cache', self, value)
-
-                self._info_id.trace_and_add_depend(1)
-                return value
+            # a loading getter is never evicted
+            self._loaders += 1
+            try:
+                with ptrace.span('cached_info', info=self) as span:
+                    with ptrace.span('cached_info.lock'):
+                        await self._lock.acquire()
+                    try:
+                        if self._is_cached and not self.expired:
+                            logger.debug('{} gets {} from cache', self,
+                                         self._cached_value)
+                            if span is not None:
+                                span.set(hit=True)
+                            return self._cached_value
+                        with ptrace.span('cached_info.load'):
+                            value = await get_func()
+                        self._store(value)
+                        logger.debug('{} gets {} and stores it to cache', self,
+                                     value)
+
+                        self._info_id.trace_and_add_depend(1)
+                        return value
+                    finally:
+                        self._lock.release()
+            finally:
+                self._loaders -= 1
 
         return load_value()
 
@@ -163,7 +212,7 @@ class _CachedInfoGetter(_CachedInfoGetterBase):
         self._cached_value = value
         return value
 
-    def clean_cache(self) -> None:
+    def clean_cache(self, due_to: Optional[str] = None) -> None:
         # TODO: lock this
         self._is_cached = False
 
@@ -213,6 +262,10 @@ class _InfoId:
         hash_kwargs = hash(tuple(sorted(self._kwargs.items())))
         return hash((self._spec, self._obj_id, self._args, hash_kwargs))
 
+    @property
+    def obj_id(self) -> Optional[pcore.ID]:
+        return self._obj_id
+
     @property
     def args(self) -> Tuple[Any, ...]:
         return self._args
@@ -268,9 +321,15 @@ def _depend_to_set(item):
 class _CachedInfoSpec(Generic[Obj, Cached]):
     __slots__ = '_func', '_depend_infos'
 
-    def __init__(self, *, graph: _DependGraph, depend) -> None:
+    def __init__(self,
+                 *,
+                 graph: _DependGraph,
+                 depend,
+                 ttl: Optional[float] = None) -> None:
         self._graph: _DependGraph = graph
         self._depend_infos: Set[_DependInfo] = _depend_to_set(depend)
+        # seconds which a cached value is valid for, None is forever
+        self._ttl = ttl
 
     def __repr__(self) -> str:
         return f'<{self.__class__.__name__} of {self.func.__name__}>'
@@ -284,6 +343,14 @@ class _CachedInfoSpec(Generic[Obj, Cached]):
     def graph(self) -> _DependGraph:
         return self._graph
 
+    @property
+    def ttl(self) -> Optional[float]:
+        return self._ttl
+
+    @property
+    def depend_infos(self) -> Set[_DependInfo]:
+        return self._depend_infos
+
     @property
     def field_name(self) -> str:
         return self._field_name
@@ -311,9 +378,13 @@ class _CachedInfoSpec(Generic[Obj, Cached]):
 
 class _CachedInfoFuncSpec(_CachedInfoSpec):
     # TODO: support to clean cache
-    def __init__(self, func: Callable[[Obj], Cached], *, graph: _DependGraph,
-                 depend):
-        super().__init__(graph=graph, depend=depend)
+    def __init__(self,
+                 func: Callable[[Obj], Cached],
+                 *,
+                 graph: _DependGraph,
+                 depend,
+                 ttl: Optional[float] = None):
+        super().__init__(graph=graph, depend=depend, ttl=ttl)
         self._func: Callable[[Obj], Cached] = func
 
     @property
@@ -336,9 +407,13 @@ class _CachedInfoFuncSpec(_CachedInfoSpec):
 
 class _CachedInfoPropertySpec(_CachedInfoSpec):
     '''treat as a spec, so it has function and not client'''
-    def __init__(self, func, *, graph: _DependGraph,
-                 depend: Optional[_DependInfo]):
-        super().__init__(graph=graph, depend=depend)
+    def __init__(self,
+                 func,
+                 *,
+                 graph: _DependGraph,
+                 depend: Optional[_DependInfo],
+                 ttl: Optional[float] = None):
+        super().__init__(graph=graph, depend=depend, ttl=ttl)
         self._func = func
 
     @property
@@ -424,50 +499,58 @@ depend = _DependInfo.gen
 @overload
 def cached_info(depend: Callable[[Obj], Cached] = ...,
                 graph: _DependGraph = ...,
-                depend_on_id: bool = ...):
+                depend_on_id: bool = ...,
+                ttl: Optional[float] = ...):
     ...
 
 
 @overload
 def cached_info(depend: None = ...,
                 graph: _DependGraph = ...,
-                depend_on_id: bool = ...):
+                depend_on_id: bool = ...,
+                ttl: Optional[float] = ...):
     ...
 
 
 @overload
 def cached_info(depend: collections.abc.Iterable[Spec],
                 graph: _DependGraph = ...,
-                depend_on_id: bool = ...):
+                depend_on_id: bool = ...,
+                ttl: Optional[float] = ...):
     ...
 
 
 @overload
 def cached_info(depend: Spec,
                 graph: _DependGraph = ...,
-                depend_on_id: bool = ...):
+                depend_on_id: bool = ...,
+                ttl: Optional[float] = ...):
     ...
 
 
 def cached_info(depend=None,
                 graph: _DependGraph = _graph,
-                depend_on_id: bool = True):
+                depend_on_id: bool = True,
+                ttl: Optional[float] = None):
     if callable(depend) and not isinstance(depend, _CachedInfoSpec):
         return cached_info()(depend)
 
     def decorater(func: Callable[[Obj], Cached]) -> _CachedInfoFuncSpec:
-        spec = _CachedInfoFuncSpec(func, graph=graph, depend=depend)
+        spec = _CachedInfoFuncSpec(func, graph=graph, depend=depend, ttl=ttl)
         return spec
 
     return decorater
 
 
-def cached_info_property(depend=None, graph=_graph):
+def cached_info_property(depend=None, graph=_graph, ttl=None):
     if callable(depend) and not isinstance(depend, _CachedInfoSpec):
         return cached_info_property()(depend)
 
     def decorater(func):
-        spec = _CachedInfoPropertySpec(func, graph=graph, depend=depend)
+        spec = _CachedInfoPropertySpec(func,
+                                       graph=graph,
+                                       depend=depend,
+                                       ttl=ttl)
         return spec
 
     return decorater
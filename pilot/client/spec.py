@@ -32,6 +32,15 @@ EnterInfo = TypeVar('EnterInfo', bound=pconn.EnterInfo)
 Connector = TypeVar('Connector', bound=pconn.Connector)
 
 
+@dataclasses.dataclass(frozen=True)
+class AdmissionSetting:
+    '''sessions to a host, see connector.Admission'''
+    # sessions started per second
+    rate: Optional[float] = None
+    burst: int = 1
+    max_in_flight: Optional[int] = None
+
+
 # TODO:
 # Fix omegaconf problems
 # 1. can't get dataclass from dict
@@ -45,6 +54,12 @@ class ConnectSetting(Generic[Agent]):
     port: Optional[int] = None
     args: Tuple[Any, ...] = dataclasses.field(default_factory=tuple)
     kwargs: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    # bastion which the connection tunnels over, clients behind one bastion
+    # share one connection to it, which is connected by jump_kwargs
+    jump_host: Optional[pconn.LoginSSHInfo] = None
+    jump_kwargs: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    # admission of the connection instead of that of the client spec
+    admission: Optional[AdmissionSetting] = None
 
     def __post_init__(self) -> None:
         if self.force_connect_agent is None and self.connect_type_path is None:
@@ -121,6 +136,8 @@ class ClientSpec(Generic[Client, EnterInfo]):
         default_factory=list)
     enter_info: Optional[EnterInfo] = None
     lazy_enter_info: Optional[LazyEnterInfo[EnterInfo]] = None
+    # admission shared by connect settings without their own
+    admission: Optional[AdmissionSetting] = None
 
     def __post_init__(self) -> None:
         if self.force_client_type is None and self.client_type_path is None:
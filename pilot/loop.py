@@ -1,10 +1,25 @@
 import functools
 import contextlib
+import dataclasses
+import time
+import asyncio
 import anyio
+from loguru import logger
 from typing import (
-    TypeVar, )
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Generic,
+    Iterable,
+    List,
+    Optional,
+    TypeVar,
+)
 
 Func = TypeVar('Func')
+Key = TypeVar('Key')
+Value = TypeVar('Value')
 
 
 async def gather(*coros):
@@ -64,3 +79,94 @@ class TaskGroup:
 async def create_task_group() -> TaskGroup:
     async with anyio.create_task_group() as tg:
         yield TaskGroup(tg)
+
+
+@dataclasses.dataclass
+class FanOutResult(Generic[Key, Value]):
+    key: Key
+    value: Optional[Value] = None
+    error: Optional[BaseException] = None
+    elapsed: float = 0
+
+    @property
+    def success(self) -> bool:
+        return self.error is None
+
+
+class FanOut(Generic[Key, Value]):
+    '''Call func for every key with a concurrency limit.
+
+    Iterate it to get FanOutResult as soon as each key finishes. An error
+    of one key is stored in its result and does not stop others. Tasks are
+    created only when there is a free slot, so keys can be a lot.
+    '''
+    def __init__(self, keys: Iterable[Key], func: Callable[[Key],
+                                                           Awaitable[Value]],
+                 *, concurrency: int) -> None:
+        if concurrency < 1:
+            raise ValueError(f'concurrency({concurrency}) must be positive')
+        self._keys = list(keys)
+        self._func = func
+        self._concurrency = concurrency
+        self._finished = 0
+        self._failed = 0
+        self._started = False
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self._finished}/{self.total} failed={self._failed}>'
+
+    @property
+    def total(self) -> int:
+        return len(self._keys)
+
+    @property
+    def finished(self) -> int:
+        return self._finished
+
+    @property
+    def failed(self) -> int:
+        return self._failed
+
+    async def _call(self, key: Key) -> FanOutResult[Key, Value]:
+        start = time.perf_counter()
+        try:
+            value = await self._func(key)
+        except Exception as e:
+            logger.debug('{} failed on {}, due to {}', self, key, e)
+            return FanOutResult(key,
+                                error=e,
+                                elapsed=time.perf_counter() - start)
+        return FanOutResult(key,
+                            value=value,
+                            elapsed=time.perf_counter() - start)
+
+    async def __aiter__(self) -> AsyncIterator[FanOutResult[Key, Value]]:
+        if self._started:
+            raise RuntimeError(f'{self} can be iterated only once')
+        self._started = True
+
+        keys = iter(self._keys)
+        pending = set()
+        try:
+            while True:
+                for key in keys:
+                    pending.add(asyncio.ensure_future(self._call(key)))
+                    if len(pending) >= self._concurrency:
+                        break
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    res = task.result()
+                    self._finished += 1
+                    if not res.success:
+                        self._failed += 1
+                    yield res
+        finally:
+            for task in pending:
+                task.cancel()
+        logger.info('{} finished', self)
+
+    async def collect(self) -> List[FanOutResult[Key, Value]]:
+        return [res async for res in self]
@@ -0,0 +1,192 @@
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import time
+import weakref
+from typing import (
+    Any,
+    Dict,
+    IO,
+    Iterator,
+    Optional,
+)
+
+# span of the running code, which tasks inherit from who creates them
+_current: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar(
+    'pilot_trace_span', default=None)
+_ids = itertools.count(1)
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional['Span'],
+                 attrs: Dict[str, Any]) -> None:
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent_id = None if parent is None else parent.span_id
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.tid = _task_id()
+        self.error: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.name} id={self.span_id} parent={self.parent_id}>'
+
+    @property
+    def duration(self) -> float:
+        end = time.perf_counter() if self.end is None else self.end
+        return end - self.start
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+
+# small ids of tasks, which are threads of the trace
+_task_ids: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_next_task_ids = itertools.count(1)
+
+
+def _task_id() -> int:
+    '''small id of the running task, which is a thread of the trace'''
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is None:
+        return 0
+    tid = _task_ids.get(task)
+    if tid is None:
+        tid = _task_ids[task] = next(_next_task_ids)
+    return tid
+
+
+def _attr(value: Any) -> Any:
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class Exporter:
+    '''Write finished spans to a file, as Chrome trace or JSON lines.
+
+    The Chrome trace is the JSON array format, whose closing bracket may be
+    missing, so each span is appended at once and the file can be loaded
+    even if the process is killed. Spans of one task are on one thread.
+    '''
+    formats = ('chrome', 'jsonl')
+
+    def __init__(self, path: str, format: str = 'chrome') -> None:
+        if format not in self.formats:
+            raise ValueError(f'Unknown trace format: {format}')
+        self._path = path
+        self._format = format
+        self._file: IO[str] = open(path, 'w')
+        # timestamps are relative to this
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self.count = 0
+        if format == 'chrome':
+            self._file.write('[')
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self._path} format={self._format}>'
+
+    def _event(self, span: Span) -> Dict[str, Any]:
+        args = {k: _attr(v) for k, v in span.attrs.items()}
+        args['span_id'] = span.span_id
+        args['parent_id'] = span.parent_id
+        if span.error is not None:
+            args['error'] = span.error
+        if self._format == 'chrome':
+            return {
+                'name': span.name,
+                'ph': 'X',
+                'ts': (span.start - self._origin) * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': self._pid,
+                'tid': span.tid,
+                'args': args,
+            }
+        return {
+            'name': span.name,
+            'start': span.start - self._origin,
+            'duration': span.duration,
+            'task': span.tid,
+            **args,
+        }
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(self._event(span))
+        if self._format == 'chrome':
+            self._file.write(f'{"," if self.count else ""}\n{line}')
+        else:
+            self._file.write(f'{line}\n')
+        self.count += 1
+
+    def close(self) -> None:
+        if self._format == 'chrome':
+            self._file.write('\n]\n')
+        self._file.close()
+
+
+_exporter: Optional[Exporter] = None
+
+
+def enabled() -> bool:
+    return _exporter is not None
+
+
+def enable(path: str, format: str = 'chrome') -> Exporter:
+    '''trace spans to path until disable'''
+    global _exporter
+    disable()
+    _exporter = Exporter(path, format)
+    return _exporter
+
+
+def disable() -> None:
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+        _exporter = None
+
+
+@contextlib.contextmanager
+def tracing(path: str, format: str = 'chrome') -> Iterator[Exporter]:
+    exporter = enable(path, format)
+    try:
+        yield exporter
+    finally:
+        if _exporter is exporter:
+            disable()
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    '''span of the block, which is a child of the current span
+
+    It yields None and costs nothing else when tracing is disabled.
+    '''
+    if _exporter is None:
+        yield None
+        return
+    s = Span(name, _current.get(), attrs)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f'{e.__class__.__name__}: {e}'
+        raise
+    finally:
+        s.end = time.perf_counter()
+        _current.reset(token)
+        # tracing may be disabled in the meantime
+        if _exporter is not None:
+            _exporter.export(s)
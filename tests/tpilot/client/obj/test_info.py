@@ -184,3 +184,129 @@ async def test_get_cached_info_by_obj_with_id():
         assert str(obj_b.info) == '<CachedDataInfoPerObj id=b>'
         assert await obj_a.info.value == 1
         assert await obj_b.info.value == 2
+
+
+@pytest.mark.asyncio
+async def test_get_cached_info_ttl():
+    class CachedDataInfo(pobj.CachedInfoGroupEntry):
+        @pobj.cached_info(depend_on_id=False, ttl=0.05)
+        async def get_by_key(self, key):
+            return await self.owner.run(key)
+
+    class ClientForTest(ClientBaseForTest):
+        info = CachedDataInfo.as_property()
+
+    async with pmock.mock_client_run(ClientForTest) as it:
+        it.mock_run.side_effect = lambda key: key
+        info = it.client.info
+        stores = it.client.info_getter_stores
+
+        assert await info.get_by_key('a') == 'a'
+        assert await info.get_by_key('a') == 'a'
+        assert it.mock_run.call_count == 1
+        await asyncio.sleep(0.06)
+        assert await info.get_by_key('a') == 'a'
+        assert it.mock_run.call_count == 2
+        assert stores.expirations == 1
+        assert len(stores) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_cached_info_lru():
+    class CachedDataInfo(pobj.CachedInfoGroupEntry):
+        @pobj.cached_info(depend_on_id=False)
+        async def get_by_key(self, key):
+            return await self.owner.run(key)
+
+    class ClientForTest(ClientBaseForTest):
+        info = CachedDataInfo.as_property()
+
+    async with pmock.mock_client_run(ClientForTest) as it:
+        it.mock_run.side_effect = lambda key: key
+        info = it.client.info
+        stores = it.client.info_getter_stores
+        stores.max_size = 2
+
+        for key in ['a', 'b', 'a', 'c']:
+            await info.get_by_key(key)
+        assert stores.evictions == 1
+        assert len(stores) == 2
+        it.mock_run.reset_mock()
+        # b is the least recently used one
+        await info.get_by_key('a')
+        it.mock_run.assert_not_called()
+        await info.get_by_key('b')
+        it.mock_run.assert_called_once_with('b')
+
+
+@pytest.mark.asyncio
+async def test_get_cached_info_evict_depend():
+    class CachedDataInfo(pobj.CachedInfoGroupEntry):
+        @pobj.cached_info_property()
+        async def keys(self):
+            return await self.owner.run()
+
+        @pobj.cached_info_property()
+        async def a(self):
+            return (await self.keys)['a']
+
+        @pobj.cached_info_property()
+        async def b(self):
+            return 'b'
+
+        @pobj.cached_info_property()
+        async def c(self):
+            return 'c'
+
+    class ClientForTest(ClientBaseForTest):
+        info = CachedDataInfo.as_property()
+
+    async with pmock.mock_client_run(ClientForTest) as it:
+        it.mock_run.return_value = {'a': 1}
+        info = it.client.info
+        stores = it.client.info_getter_stores
+        stores.max_size = 3
+
+        assert await info.a == 1
+        await info.b
+        await info.c
+        assert stores.evictions == 1
+        # a is evicted like it is deleted, so keys is loaded again
+        assert await info.keys == {'a': 1}
+        assert it.mock_run.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_cached_info_not_evict_loading():
+    class CachedDataInfo(pobj.CachedInfoGroupEntry):
+        @pobj.cached_info(depend_on_id=False)
+        async def get_by_key(self, key):
+            return await self.owner.run(key)
+
+    class ClientForTest(ClientBaseForTest):
+        info = CachedDataInfo.as_property()
+
+    loaded = asyncio.Event()
+
+    async def effect(key):
+        if key == 'a':
+            await loaded.wait()
+        return key
+
+    async with pmock.mock_client_run(ClientForTest) as it:
+        it.mock_run.side_effect = effect
+        info = it.client.info
+        stores = it.client.info_getter_stores
+        stores.max_size = 1
+
+        task = asyncio.create_task(info.get_by_key('a'))
+        await asyncio.sleep(0)
+        assert await info.get_by_key('b') == 'b'
+        assert stores.evictions == 0
+        assert len(stores) == 2
+        loaded.set()
+        assert await task == 'a'
+
+        await info.get_by_key('c')
+        assert stores.evictions == 2
+        assert len(stores) == 1
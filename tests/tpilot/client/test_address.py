@@ -0,0 +1,56 @@
+import asyncio
+import pytest
+
+from pilot.client import connector as pconn
+from pilot.client.connector import address as paddr
+
+
+@pytest.mark.asyncio
+async def test_local_address_index():
+    loads = []
+
+    def load():
+        loads.append(1)
+        return frozenset({'10.0.0.1'} if len(loads) == 1 else {'10.0.0.2'})
+
+    index = pconn.LocalAddressIndex(refresh_interval=None, load=load)
+    results = await asyncio.gather(
+        *[index.is_local(host) for host in ['10.0.0.1', '10.0.0.3']])
+    assert results == [True, False]
+    # lookups share one build
+    assert index.refresh_count == 1
+    assert index.build_time >= 0
+    assert await index.is_local('10.0.0.1')
+    assert index.refresh_count == 1
+
+    await index.refresh()
+    assert index.refresh_count == 2
+    assert await index.is_local('10.0.0.2')
+    assert not await index.is_local('10.0.0.1')
+
+
+@pytest.mark.asyncio
+async def test_local_address_index_refresh_interval():
+    addresses = [frozenset({'10.0.0.1'}), frozenset({'10.0.0.2'})]
+    index = pconn.LocalAddressIndex(refresh_interval=0,
+                                    load=lambda: addresses.pop(0))
+    assert await index.is_local('10.0.0.1')
+    # stale one is used until the rebuild in the background is done
+    assert await index.is_local('10.0.0.1')
+    await asyncio.sleep(0.1)
+    assert index.refresh_count == 2
+    assert await index.is_local('10.0.0.2')
+
+
+@pytest.mark.asyncio
+async def test_auto_shell_agent_local(monkeypatch):
+    monkeypatch.setattr(
+        paddr, 'local_addresses',
+        pconn.LocalAddressIndex(load=lambda: frozenset({'10.0.0.1'})))
+    async with pconn.Connector() as connector:
+        conn = await connector.connect_by_agent(
+            pconn.AutoShellAgent,
+            info=pconn.LoginSSHInfo(host='10.0.0.1', username='u'))
+        assert isinstance(conn, pconn.SubprocessAgent.connection_cls)
+        res = await conn.run('echo 1')
+        assert res.stdout == '1\n'
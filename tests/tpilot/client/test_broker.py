@@ -0,0 +1,90 @@
+import asyncio
+import os
+import pytest
+
+from pilot.client import core as pclient
+from pilot.client import broker as pbroker
+from pilot.client import connector as pconn
+
+
+@pytest.mark.asyncio
+async def test_broker(tmp_path):
+    path = f'{tmp_path}/broker.sock'
+    pool = pclient.ClientCachedPool(
+        {'local': pclient.get_localhost_spec_info()})
+    async with pool:
+        broker = pbroker.Broker(pool, path=path)
+        serving = asyncio.create_task(broker.serve())
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+
+        async with pbroker.BrokerClient(path) as client:
+            assert await client.ping() == os.getpid()
+            first, second = await asyncio.gather(client.run('local', 'echo 1'),
+                                                 client.run('local', 'echo 2'))
+            assert (first.stdout, second.stdout) == ('1\n', '2\n')
+
+            res = await client.run('local', 'exit 3', check=False)
+            assert res.exit_status == 3
+            with pytest.raises(pconn.ExitStatusNotSuccess):
+                await client.run('local', 'exit 3')
+            with pytest.raises(pbroker.BrokerError):
+                await client.run('unknown', 'echo 1')
+
+            with open(f'{tmp_path}/src', 'w') as f:
+                f.write('data')
+            stat = await client.scp(f'{tmp_path}/src',
+                                    ('local', f'{tmp_path}/dst'))
+            assert stat.files == 1
+            with open(f'{tmp_path}/dst') as f:
+                assert f.read() == 'data'
+
+            metrics = await client.metrics()
+            assert metrics['localhost']['histograms']['command']['count'] >= 4
+
+            await client.shutdown()
+        await asyncio.wait_for(serving, 5)
+    assert not os.path.exists(path)
+
+
+@pytest.mark.asyncio
+async def test_broker_idle_timeout(tmp_path):
+    path = f'{tmp_path}/broker.sock'
+    async with pclient.ClientCachedPool({}) as pool:
+        broker = pbroker.Broker(pool, path=path, idle_timeout=0.1)
+        await asyncio.wait_for(broker.serve(), 5)
+
+
+def test_broker_default_path(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    os.chmod(tmp_path, 0o700)
+    assert pbroker.default_path() == f'{tmp_path}/pilot-broker.sock'
+    # other users may enter it
+    os.chmod(tmp_path, 0o777)
+    with pytest.raises(pbroker.BrokerError):
+        pbroker.default_path()
+
+
+@pytest.mark.asyncio
+async def test_broker_refuse_other_user(tmp_path, monkeypatch):
+    path = f'{tmp_path}/broker.sock'
+    async with pclient.ClientCachedPool({}) as pool:
+        broker = pbroker.Broker(pool, path=path)
+        serving = asyncio.create_task(broker.serve())
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        assert os.stat(path).st_mode & 0o777 == 0o600
+
+        monkeypatch.setattr(pbroker, '_peer_uid', lambda sock: os.getuid() + 1)
+        with pytest.raises(pbroker.BrokerError):
+            async with pbroker.BrokerClient(path):
+                pass
+        # the broker closes the connection at once
+        reader, writer = await asyncio.open_unix_connection(path)
+        assert await reader.readline() == b''
+        writer.close()
+        monkeypatch.undo()
+
+        async with pbroker.BrokerClient(path) as client:
+            await client.shutdown()
+        await asyncio.wait_for(serving, 5)
@@ -0,0 +1,24 @@
+import mmap
+
+from pilot.client import connector as pconn
+
+
+def test_spill_buffer():
+    buf = pconn.SpillBuffer(threshold=4)
+    buf.write(b'ab')
+    assert not buf.spilled
+    assert bytes(buf.view) == b'ab'
+    buf.write(b'cde')
+    assert buf.spilled
+    assert len(buf) == 5
+    assert isinstance(buf.view, mmap.mmap)
+    assert buf.view[1:4] == b'bcd'
+    assert buf.decode() == 'abcde'
+    buf.close()
+
+
+def test_spill_buffer_decode_errors():
+    buf = pconn.SpillBuffer()
+    buf.write('é'.encode('utf-8')[:1])
+    assert buf.decode(errors='replace') == '�'
+    assert buf.decode(encoding='latin-1') == '\xc3'
@@ -0,0 +1,306 @@
+import pytest
+import mock
+import asyncio
+import asyncssh
+import contextlib
+
+from pilot.client import connector as pconn
+
+
+def new_transport_opener(opened):
+    @contextlib.asynccontextmanager
+    async def open_transport():
+        conn = mock.MagicMock(name=f'transport{len(opened)}')
+        conn.is_closed.return_value = False
+        opened.append(conn)
+        yield conn
+
+    return open_transport
+
+
+async def hold(conn, started, release):
+    started.append(conn)
+    await release.wait()
+    return conn
+
+
+@pytest.mark.asyncio
+async def test_limiter_fifo():
+    limiter = pconn.Limiter(1)
+    order = []
+
+    async def worker(i):
+        async with limiter.slot():
+            order.append(i)
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*[worker(i) for i in range(5)])
+    assert order == [0, 1, 2, 3, 4]
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.parametrize('fifo, expected', [
+    (True, ['first', 'poll', 'action']),
+    (False, ['first', 'action', 'poll']),
+])
+@pytest.mark.asyncio
+async def test_limiter_fifo_priority(fifo, expected):
+    limiter = pconn.Limiter(1, fifo=fifo)
+    order = []
+
+    async def worker(name):
+        async with limiter.slot():
+            order.append(name)
+            await asyncio.sleep(0)
+
+    tasks = [asyncio.create_task(worker('first'))]
+    with pconn.priority(pconn.Priority.BACKGROUND):
+        tasks.append(asyncio.create_task(worker('poll')))
+    with pconn.priority(pconn.Priority.ACTION):
+        tasks.append(asyncio.create_task(worker('action')))
+    await asyncio.gather(*tasks)
+    assert order == expected
+
+
+@pytest.mark.asyncio
+async def test_token_bucket():
+    bucket = pconn.TokenBucket(rate=50, burst=2)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.gather(*[bucket.acquire() for _ in range(5)])
+    # 2 of the burst at once, then one every 20ms
+    assert loop.time() - start >= 0.055
+
+
+@pytest.mark.asyncio
+async def test_admission():
+    metrics = pconn.HostMetrics('h')
+    admission = pconn.Admission(max_in_flight=2, metrics=metrics)
+    running = []
+    peak = 0
+
+    async def worker():
+        nonlocal peak
+        async with admission.slot():
+            running.append(1)
+            peak = max(peak, len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+    await asyncio.gather(*[worker() for _ in range(6)])
+    assert peak == 2
+    assert admission.in_flight == 0
+    assert admission.admitted == 6
+    assert admission.waited > 0
+    assert metrics.histograms['admission_wait'].count == 6
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_limit_sessions():
+    opened = []
+    started = []
+    release = asyncio.Event()
+    async with pconn.ChannelPool(new_transport_opener(opened),
+                                 max_sessions=2) as pool:
+        await pool.add_transport()
+        tasks = [
+            asyncio.create_task(pool.call(hold, started, release))
+            for _ in range(5)
+        ]
+        await asyncio.sleep(0.01)
+        assert len(started) == 2
+        assert pool.in_flight == 2
+        assert pool.waiting == 3
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert len(started) == 5
+        assert pool.in_flight == 0
+        assert len(opened) == 1
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_wake_by_priority():
+    opened = []
+    started = []
+    release = asyncio.Event()
+    async with pconn.ChannelPool(new_transport_opener(opened),
+                                 max_sessions=1) as pool:
+        await pool.add_transport()
+        holder = asyncio.create_task(pool.call(hold, started, release))
+        await asyncio.sleep(0)
+
+        order = []
+
+        async def poll(name):
+            await pool.call(hold, started, release)
+            order.append(name)
+
+        # tasks inherit the priority of who creates them
+        with pconn.priority(pconn.Priority.BACKGROUND):
+            tasks = [asyncio.create_task(poll(f'poll{i}')) for i in range(3)]
+        await asyncio.sleep(0.01)
+        with pconn.priority(pconn.Priority.ACTION):
+            tasks.append(asyncio.create_task(poll('action')))
+        await asyncio.sleep(0.01)
+        assert pool.waiting == 4
+
+        release.set()
+        await asyncio.gather(holder, *tasks)
+        assert order == ['action', 'poll0', 'poll1', 'poll2']
+
+
+def test_current_priority():
+    assert pconn.current_priority() == pconn.Priority.INTERACTIVE
+    assert pconn.current_priority(read_only=True) == pconn.Priority.BACKGROUND
+    with pconn.priority(pconn.Priority.ACTION):
+        assert pconn.current_priority(read_only=True) == pconn.Priority.ACTION
+    assert pconn.current_priority() == pconn.Priority.INTERACTIVE
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_open_extra_transport():
+    opened = []
+    started = []
+    release = asyncio.Event()
+    async with pconn.ChannelPool(new_transport_opener(opened),
+                                 max_sessions=2,
+                                 max_transports=3) as pool:
+        await pool.add_transport()
+        tasks = [
+            asyncio.create_task(pool.call(hold, started, release))
+            for _ in range(7)
+        ]
+        await asyncio.sleep(0.01)
+        assert pool.transport_num == 3
+        assert len(started) == 6
+        assert pool.waiting == 1
+        assert started.count(opened[2]) == 2
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert pool.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_extra_transport_failed():
+    opened = []
+    started = []
+    release = asyncio.Event()
+    open_transport = new_transport_opener(opened)
+
+    @contextlib.asynccontextmanager
+    async def open_extra_failed():
+        if opened:
+            # the holder releases its slot in the meantime
+            release.set()
+            await asyncio.sleep(0.01)
+            raise OSError('open failed')
+        async with open_transport() as conn:
+            yield conn
+
+    async with pconn.ChannelPool(open_extra_failed,
+                                 max_sessions=1,
+                                 max_transports=2) as pool:
+        await pool.add_transport()
+        holder = asyncio.create_task(pool.call(hold, started, release))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(pool.call(hold, started, release), timeout=1)
+        await holder
+        assert len(started) == 2
+        assert pool.transport_num == 1
+        assert pool.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_shrink_when_refused():
+    opened = []
+    started = []
+    release = asyncio.Event()
+    refused = asyncssh.ChannelOpenError(
+        asyncssh.OPEN_ADMINISTRATIVELY_PROHIBITED, 'open failed')
+
+    refused_once = False
+
+    async def open_channel(conn):
+        nonlocal refused_once
+        if len(started) == 2 and not refused_once:
+            refused_once = True
+            raise refused
+        return await hold(conn, started, release)
+
+    async with pconn.ChannelPool(new_transport_opener(opened),
+                                 max_sessions=10) as pool:
+        await pool.add_transport()
+        tasks = [
+            asyncio.create_task(pool.call(open_channel)) for _ in range(4)
+        ]
+        await asyncio.sleep(0.01)
+        assert len(started) == 2
+        assert pool.waiting == 2
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert len(started) == 4
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_raise_when_refused_first_channel():
+    opened = []
+    refused = asyncssh.ChannelOpenError(
+        asyncssh.OPEN_ADMINISTRATIVELY_PROHIBITED, 'open failed')
+
+    async with pconn.ChannelPool(new_transport_opener(opened)) as pool:
+        await pool.add_transport()
+        with pytest.raises(asyncssh.ChannelOpenError):
+            await pool.call(mock.AsyncMock(side_effect=refused))
+        assert pool.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_reopen_closed_transport():
+    opened = []
+    async with pconn.ChannelPool(new_transport_opener(opened)) as pool:
+        await pool.add_transport()
+
+        async def open_channel(conn):
+            if conn is opened[0]:
+                # the transport is lost before the channel is opened
+                conn.is_closed.return_value = True
+                raise asyncssh.ChannelOpenError(asyncssh.OPEN_CONNECT_FAILED,
+                                                'SSH connection closed')
+            return conn
+
+        assert await pool.call(open_channel) == opened[1]
+        assert pool.transport_num == 1
+        assert pool.primary == opened[1]
+        assert pool.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_transport_reopen():
+    opened = []
+    async with pconn.ChannelPool(new_transport_opener(opened)) as pool:
+        await pool.add_transport()
+        assert await pool.transport() is opened[0]
+        opened[0].is_closed.return_value = True
+        assert not pool.has_transport
+        # the tunnel of a host behind a bastion is opened by it
+        assert await pool.transport() is opened[1]
+        assert pool.has_transport
+        assert pool.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_broken_when_reopen_failed():
+    @contextlib.asynccontextmanager
+    async def open_transport():
+        raise OSError('unreachable')
+        yield
+
+    async with pconn.ChannelPool(open_transport,
+                                 reconnect_max=2,
+                                 reconnect_interval=0.01) as pool:
+        with pytest.raises(OSError):
+            await pool.call(mock.AsyncMock())
+        assert pool.broken
@@ -0,0 +1,365 @@
+import io
+import os
+import asyncio
+import contextlib
+import pytest
+
+from pilot.client import connector as pconn
+from pilot.client.connector import subprocess as pproc
+from pilot.client.connector import session as psession
+from pilot.client.connector import expect as pexp
+
+
+@contextlib.asynccontextmanager
+async def ssh_connection(**kwargs):
+    '''AsyncsshConnection to a local server, which runs commands by sh'''
+    import asyncssh
+
+    class Server(asyncssh.SSHServer):
+        def begin_auth(self, username):
+            return True
+
+        def password_auth_supported(self):
+            return True
+
+        def validate_password(self, username, password):
+            return True
+
+    procs = []
+
+    async def handle(process):
+        proc = await asyncio.create_subprocess_shell(
+            process.command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        procs.append(proc)
+        await process.redirect(stdin=proc.stdin)
+
+        async def forward(reader, writer):
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                writer.write(chunk)
+
+        await asyncio.gather(forward(proc.stdout, process.stdout),
+                             forward(proc.stderr, process.stderr))
+        process.exit(await proc.wait())
+        await process.wait_closed()
+
+    server = await asyncssh.create_server(
+        Server,
+        '127.0.0.1',
+        0,
+        server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')],
+        process_factory=handle,
+        encoding=None)
+    port = server.sockets[0].getsockname()[1]
+    info = pconn.LoginSSHInfo(host='127.0.0.1',
+                              username='u',
+                              port=port,
+                              password='x')
+    try:
+        async with pconn.AsyncsshAgent.connect(info, **kwargs) as conn:
+            yield conn
+    finally:
+        # commands left by a failed test
+        for proc in procs:
+            if proc.returncode is None:
+                proc.kill()
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_subprocess_stream_lines():
+    conn = pproc.SubprocessConnection()
+    async with conn.stream('echo a; echo b >&2; echo c; exit 3',
+                           check=False) as stream:
+        lines = [line async for line in stream.iter_lines()]
+    assert lines == ['a', 'c']
+    assert stream.exit_status == 3
+    assert stream.stderr == 'b\n'
+
+
+@pytest.mark.asyncio
+async def test_asyncssh_stream_lines():
+    async with ssh_connection() as conn:
+        async with conn.stream('seq 3') as stream:
+            lines = [line async for line in stream.iter_lines()]
+    assert lines == ['1', '2', '3']
+    assert stream.exit_status == 0
+
+
+@pytest.mark.asyncio
+async def test_asyncssh_run_text(tmp_path):
+    path = f'{tmp_path}/out'
+    async with ssh_connection() as conn:
+        # text input, and output to text files which asyncssh writes str to
+        res = await asyncio.wait_for(conn.run('cat; echo err >&2',
+                                              input='h\u00e9llo\n'),
+                                     timeout=5)
+        assert (res.stdout, res.stderr) == ('h\u00e9llo\n', 'err\n')
+        with open(path, 'w') as out:
+            res = await conn.run('printf "h\\303\\251llo"',
+                                 stdout=out,
+                                 stderr=io.StringIO())
+        assert res.exit_status == 0
+        # a file of fd 1, which is regular under the capture of pytest
+        await conn.run('echo tty', redirect_stdout_tty=True)
+        assert conn.is_alive
+    with open(path) as f:
+        assert f.read() == 'h\u00e9llo'
+
+
+@pytest.mark.asyncio
+async def test_subprocess_stream_chunks_bytes():
+    conn = pproc.SubprocessConnection()
+    async with conn.stream('printf "abcdef"', encoding=None) as stream:
+        chunks = [chunk async for chunk in stream.iter_chunks(4)]
+    assert b''.join(chunks) == b'abcdef'
+    assert stream.exit_status == 0
+
+
+@pytest.mark.asyncio
+async def test_subprocess_stream_stop_early():
+    conn = pproc.SubprocessConnection()
+    async with conn.stream('yes') as stream:
+        async for line in stream.iter_lines():
+            assert line == 'y'
+            break
+    assert stream.exit_status != 0
+
+
+@pytest.mark.asyncio
+async def test_subprocess_stream_check():
+    conn = pproc.SubprocessConnection()
+    with pytest.raises(pconn.ExitStatusNotSuccess):
+        async with conn.stream('exit 1') as stream:
+            async for line in stream.iter_lines():
+                pass
+
+
+@pytest.mark.asyncio
+async def test_subprocess_run_many():
+    conn = pproc.SubprocessConnection()
+    results = await conn.run_many(
+        ['echo a', 'printf b; echo c >&2; exit 2', 'true', 'cd / # comment'],
+        check=False)
+    assert [res.command for res in results] == [
+        'echo a', 'printf b; echo c >&2; exit 2', 'true', 'cd / # comment'
+    ]
+    assert [res.stdout for res in results] == ['a\n', 'b', '', '']
+    assert [res.stderr for res in results] == ['', 'c\n', '', '']
+    assert [res.exit_status for res in results] == [0, 2, 0, 0]
+
+
+@pytest.mark.asyncio
+async def test_subprocess_run_many_check():
+    conn = pproc.SubprocessConnection()
+    with pytest.raises(pconn.ExitStatusNotSuccess):
+        await conn.run_many(['true', 'false'])
+
+
+@pytest.mark.asyncio
+async def test_subprocess_persistent_shell():
+    conn = pproc.SubprocessConnection(persistent_shell=True)
+    try:
+        res = await conn.run('cd /tmp; export A=1; echo $$')
+        pid = res.stdout
+        res = await conn.run('pwd; echo $A; echo $$; echo err >&2; printf x')
+        assert res.stdout == f'/tmp\n1\n{pid}x'
+        assert res.stderr == 'err\n'
+        assert res.exit_status == 0
+
+        res = await conn.run('exit 5', check=False)
+        assert res.exit_status == 5
+        res = await conn.run('echo $$')
+        assert res.stdout != pid
+    finally:
+        await conn.aclose()
+
+
+@pytest.mark.asyncio
+async def test_subprocess_run_argv():
+    conn = pproc.SubprocessConnection()
+    res = await conn.run(['echo', 'a  $HOME'])
+    assert res.stdout == 'a  $HOME\n'
+    async with conn.stream(['printf', '%s', 'a;b']) as stream:
+        assert [line async for line in stream.iter_lines()] == ['a;b']
+
+
+@pytest.mark.asyncio
+async def test_subprocess_spawn_limit():
+    conn = pproc.SubprocessConnection()
+    limiter = conn.spawn_limiter
+    old_limit = limiter.limit
+    limiter.limit = 2
+    try:
+        tasks = [
+            asyncio.create_task(conn.run(['sleep', '0.1'])) for _ in range(5)
+        ]
+        await asyncio.sleep(0.05)
+        assert limiter.in_flight == 2
+        assert limiter.waiting == 3
+
+        limiter.limit = 4
+        assert limiter.in_flight == 4
+        await asyncio.gather(*tasks)
+        assert limiter.in_flight == 0
+    finally:
+        limiter.limit = old_limit
+
+
+@pytest.mark.asyncio
+async def test_subprocess_spill_output():
+    conn = pproc.SubprocessConnection(spill_threshold=1000)
+    res = await conn.run('head -c 5000 /dev/zero; echo err >&2')
+    assert res._stdout.spilled
+    assert not res._stderr.spilled
+    assert len(res.stdout_view) == 5000
+    assert res.stdout == '\0' * 5000
+    assert res.stdout is res.stdout
+    assert res.stderr == 'err\n'
+    assert res.output_size == 5004
+    assert res.spilled
+
+    # temp files of results are released with the connection
+    stdout_file = res._stdout._file
+    await conn.aclose()
+    assert stdout_file.closed
+    assert res.stdout == '\0' * 5000
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('persistent_shell', [False, True])
+async def test_subprocess_run_encoding(persistent_shell):
+    conn = pproc.SubprocessConnection(persistent_shell=persistent_shell)
+    cmd = "printf 'a\\377b'"
+    res = await conn.run(cmd, encoding=None)
+    assert res.stdout == b'a\xffb'
+    res = await conn.run(cmd, errors='replace')
+    assert res.stdout == 'a�b'
+    res = await conn.run(cmd)
+    with pytest.raises(UnicodeDecodeError):
+        res.stdout
+    assert res.success
+    out, err = await conn.run_many([cmd, 'echo e >&2'], encoding=None)
+    assert out.stdout == b'a\xffb'
+    assert err.stderr == b'e\n'
+
+
+@pytest.mark.asyncio
+async def test_persistent_shell_unparsed_cmd():
+    conn = pproc.SubprocessConnection(persistent_shell=True)
+    await conn.run('cd /tmp')
+    res = await asyncio.wait_for(conn.run("echo 'foo", check=False), timeout=5)
+    assert res.exit_status == 2
+    res = await conn.run('pwd')
+    assert res.stdout == '/tmp\n'
+    await conn.aclose()
+
+
+@pytest.mark.asyncio
+async def test_merged_shell_session():
+    @contextlib.asynccontextmanager
+    async def open_shell():
+        # like a shell behind a pty, stderr is merged into stdout
+        process = await asyncio.create_subprocess_exec(
+            '/bin/sh',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT)
+        try:
+            yield process.stdin, process.stdout, None, process.wait
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    session = psession.MergedShellSession(open_shell)
+    try:
+        res = await session.run('cd /tmp; echo out; echo err >&2; false')
+        assert res == (b'out\n', b'err\n', 1)
+        res = await session.run('pwd; printf x >&2; printf y')
+        assert res == (b'/tmp\ny', b'x', 0)
+        res = await asyncio.wait_for(session.run("echo 'foo"), timeout=5)
+        assert res.exit_status == 2
+        assert res.stdout == b''
+        assert res.stderr
+        res = await session.run('exit 4')
+        assert res.exit_status == 4
+        assert not session.opened
+        res = await session.run('echo again')
+        assert res.stdout == b'again\n'
+    finally:
+        await session.close()
+
+
+@pytest.mark.asyncio
+async def test_expect_connection(tmp_path, monkeypatch):
+    # stands for expect, which logs in and bridges the shell of the host
+    fake_expect = tmp_path / 'expect'
+    fake_expect.write_text("""#!/bin/sh
+echo __pilot_expect_password
+read password
+[ "$password" = secret ] || exit 1
+echo __pilot_expect_ready
+exec /bin/sh 2>&1
+""")
+    fake_expect.chmod(0o755)
+    monkeypatch.setattr(pexp, '_expect_path', str(fake_expect))
+    info = pconn.LoginSSHInfo(host='h', username='u', password='secret')
+    conn = pexp.ExpectConnection(info, pproc.SubprocessConnection())
+    try:
+        res = await conn.run('echo a; echo b >&2')
+        assert (res.stdout, res.stderr) == ('a\n', 'b\n')
+        res = await conn.run(['echo', 'a b'])
+        assert res.stdout == 'a b\n'
+        res = await conn.run('cat; echo "$X"',
+                             input="i'n\\\n",
+                             env={'X': "a 'b'"})
+        assert res.stdout == "i'n\\\na 'b'\n"
+        res = await conn.run('od -An -tx1', input=b'\0\xff', encoding=None)
+        assert res.stdout.split() == [b'00', b'ff']
+    finally:
+        await conn.aclose()
+
+    info = pconn.LoginSSHInfo(host='h', username='u', password='wrong')
+    conn = pexp.ExpectConnection(info, pproc.SubprocessConnection())
+    with pytest.raises(ConnectionError):
+        await conn.run('echo a')
+
+
+@pytest.mark.asyncio
+async def test_expect_env_cache(tmp_path, monkeypatch):
+    script = tmp_path / 'session.exp'
+    monkeypatch.setattr(pexp, '_expect_path', '/bin/sh')
+    monkeypatch.setattr(pexp, '_remote_expect_path', str(script))
+    monkeypatch.setattr(pexp, '_expect_envs', {})
+    tunnel = pproc.SubprocessConnection()
+    probes = []
+    run_many = tunnel.run_many
+
+    async def counted_run_many(*args, **kwargs):
+        probes.append(args)
+        return await run_many(*args, **kwargs)
+
+    monkeypatch.setattr(tunnel, 'run_many', counted_run_many)
+
+    await asyncio.gather(*[pexp._ensure_expect_env(tunnel) for _ in range(5)])
+    assert script.read_text() == pexp._expect_script
+    assert len(probes) == 1
+
+    # a stale script is replaced after the checked result expires
+    script.write_text('stale')
+    await pexp._ensure_expect_env(tunnel)
+    assert len(probes) == 1
+    monkeypatch.setattr(pexp, '_env_ttl', 0)
+    await pexp._ensure_expect_env(tunnel)
+    assert len(probes) == 2
+    assert script.read_text() == pexp._expect_script
+    await pexp._ensure_expect_env(tunnel)
+    assert len(probes) == 3
+    assert not os.path.exists(f'{script}.pilot-part')
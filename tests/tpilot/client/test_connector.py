@@ -1,5 +1,6 @@
 import pytest
 import mock
+import asyncio
 import asyncclick as click
 from loguru import logger
 
@@ -178,6 +179,23 @@ async def test_connector_close_all(mock_connect):
         assert mock_connect.return_value.__aenter__.call_count == 3
 
 
+@pytest.mark.asyncio
+@mock.patch(f'{__name__}.TestConnectLocalAgent._connect')
+async def test_connector_reconnect_dead(mock_connect):
+    conn1 = mock.AsyncMock(is_alive=True)
+    conn2 = mock.AsyncMock(is_alive=True)
+    mock_connect.return_value.__aenter__ = mock.AsyncMock(
+        side_effect=[conn1, conn2])
+    async with pconn.Connector() as connector:
+        assert await connector.connect_by_agent(TestConnectLocalAgent) == conn1
+        assert await connector.connect_by_agent(TestConnectLocalAgent) == conn1
+
+        conn1.is_alive = False
+        assert await connector.connect_by_agent(TestConnectLocalAgent) == conn2
+        assert mock_connect.return_value.__aexit__.call_count == 1
+    assert mock_connect.return_value.__aexit__.call_count == 2
+
+
 @pytest.mark.asyncio
 @mock.patch(f'{__name__}.TestConnectAgent._connect')
 async def test_connector_pool(mock_connect):
@@ -187,6 +205,25 @@ async def test_connector_pool(mock_connect):
         assert isinstance(connector, pconn.Connector)
 
 
+@pytest.mark.asyncio
+@mock.patch(f'{__name__}.TestConnectAgent._connect')
+async def test_connector_pool_get_lazy(mock_connect):
+    conn = mock.AsyncMock(is_alive=True)
+    mock_connect.return_value.__aenter__ = mock.AsyncMock(return_value=conn)
+    enter_info = mock.MagicMock(spec=pconn.EnterInfo)
+    async with pconn.ConnectorCachedPool() as pool:
+        lazy = await pool.get_lazy(enter_info,
+                                   TestConnectAgent,
+                                   info=enter_info)
+        assert not lazy.connected
+        mock_connect.assert_not_called()
+
+        await asyncio.gather(lazy.run('ls'), lazy.run('pwd'))
+        assert lazy.connected
+        mock_connect.assert_called_once_with(enter_info)
+        assert conn.run.call_count == 2
+
+
 '''
 _cmds = {
     'ls /home':
@@ -218,3 +255,23 @@ async def test_connection_result(mock_conn, urulogs, cmd):
         f'CMD:pilot.client.connector.connection:ForTestConn run: <(\'{cmd}\',)>'
     ]
 '''
+
+
+@pytest.mark.asyncio
+@mock.patch(f'{__name__}.TestConnectAgent._connect')
+async def test_connector_connect_concurrently(mock_connect):
+    conn = mock.AsyncMock(is_alive=True)
+
+    async def enter(*args):
+        await asyncio.sleep(0.01)
+        return conn
+
+    mock_connect.return_value.__aenter__ = mock.AsyncMock(side_effect=enter)
+    enter_info = mock.MagicMock(spec=pconn.EnterInfo)
+    async with pconn.Connector() as connector:
+        conns = await asyncio.gather(*[
+            connector.connect_by_agent(TestConnectAgent, info=enter_info)
+            for _ in range(3)
+        ])
+        assert conns == [conn] * 3
+        mock_connect.assert_called_once_with(enter_info)
@@ -0,0 +1,427 @@
+import os
+import asyncio
+import pytest
+import mock
+
+from pilot.client import core as pclient
+from pilot.client import mock as pmock
+from pilot.client import spec as pspec
+from pilot.client import connector as pconn
+
+
+class ClientBaseForTest(pclient.Client):
+    async def run(self, *args, **kwargs):
+        conn = await self.connect('test')
+        return await conn.run(*args, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_run_on():
+    async with pmock.mock_client_run(ClientBaseForTest) as it:
+        pool = pclient.ClientCachedPool(
+            {name: it.client._spec
+             for name in ['a', 'b', 'c']})
+        it.mock_run.side_effect = [
+            pmock.mock_cmd_result(stdout='1'),
+            Exception('failed'),
+            pmock.mock_cmd_result(stdout='3'),
+        ]
+        async with pool:
+            fan_out = pool.run_on(['a', 'b', 'c'], 'hostname', concurrency=2)
+            results = {res.key: res async for res in fan_out}
+        assert results.keys() == {'a', 'b', 'c'}
+        assert fan_out.failed == 1
+        assert sorted(res.value.stdout for res in results.values()
+                      if res.success) == ['1', '3']
+        it.mock_run.assert_has_awaits([mock.call('hostname')] * 3)
+
+
+@pytest.mark.asyncio
+async def test_run_on_shared_client():
+    async with pmock.mock_client_run(ClientBaseForTest) as it:
+        spec = it.client._spec
+        pool = pclient.ClientCachedPool({'a': spec})
+        releases = {'first': asyncio.Event(), 'second': asyncio.Event()}
+
+        async def run(cmd):
+            await releases[cmd].wait()
+            return pmock.mock_cmd_result(stdout=cmd)
+
+        it.mock_run.side_effect = run
+
+        async def collect(fan_out):
+            return [res async for res in fan_out]
+
+        async with pool:
+            first = asyncio.create_task(
+                collect(pool.run_on(['a'], 'first', keep_connection=False)))
+            await asyncio.sleep(0.01)
+            second = asyncio.create_task(
+                collect(pool.run_on(['a'], 'second', per_client=1)))
+            await asyncio.sleep(0.01)
+            # calls with other per_client share the limiter of the client,
+            # whose limit is lowered to 1 by the second one
+            limiter = pool._get_client_limiter('a', 1)
+            assert (limiter.in_flight, limiter.waiting) == (1, 1)
+            connector = await pool._get_connector('a', spec)
+
+            releases['first'].set()
+            await first
+            # the second call is still running on it
+            assert connector.connected
+            releases['second'].set()
+            await second
+            assert not connector.connected
+
+
+@pytest.mark.asyncio
+async def test_prewarm():
+    async with pmock.mock_client_run(ClientBaseForTest) as it:
+        pool = pclient.ClientCachedPool(
+            {name: it.client._spec
+             for name in ['a', 'b', 'c']})
+        it.agent._connect.return_value.__aenter__.side_effect = [
+            it.mock_conn, Exception('refused'), it.mock_conn
+        ]
+        async with pool:
+            results = await pool.prewarm(['a', 'b', 'c'], agents=['test'])
+            assert {
+                res.key: res.success
+                for res in results
+            } == {
+                'a': True,
+                'b': False,
+                'c': True
+            }
+            assert it.agent._connect.call_count == 3
+
+            client = await pool.get_client('a')
+            await client.run('hostname')
+            assert it.agent._connect.call_count == 3
+
+
+def new_local_pool():
+    spec = pspec.ClientSpec(force_client_type=pclient.SubprocessClient,
+                            connect_settings=[
+                                pspec.ConnectSetting(
+                                    name='local',
+                                    force_connect_agent=pconn.SubprocessAgent)
+                            ])
+    return pclient.ClientCachedPool({'local': spec})
+
+
+@pytest.mark.asyncio
+async def test_use_file_by_delta(tmp_path):
+    path = f'{tmp_path}/data'
+    data = os.urandom(100000)
+    with open(path, 'wb') as f:
+        f.write(data)
+    async with new_local_pool() as pool:
+        client = await pool.get_client('local')
+        with mock.patch.object(client, 'scp', wraps=client.scp) as mock_scp:
+            async with client.use_file(path, write_mode=True) as local_path:
+                with open(local_path, 'r+b') as f:
+                    f.seek(50000)
+                    f.write(b'changed')
+        # download the file and upload the delta
+        assert mock_scp.await_count == 2
+        assert mock_scp.await_args.args[1] == (client, f'{path}.pilot-delta')
+    with open(path, 'rb') as f:
+        assert f.read() == data[:50000] + b'changed' + data[50007:]
+    assert os.listdir(tmp_path) == ['data']
+
+
+@pytest.mark.asyncio
+async def test_use_file_by_delta_symlink(tmp_path):
+    path = f'{tmp_path}/data'
+    data = os.urandom(100000)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, 0o640)
+    if os.geteuid() == 0:
+        os.chown(path, 1234, 1234)
+    owner = os.stat(path)
+    os.symlink('data', f'{tmp_path}/link')
+    async with new_local_pool() as pool:
+        client = await pool.get_client('local')
+        async with client.use_file(f'{tmp_path}/link',
+                                   write_mode=True) as local_path:
+            with open(local_path, 'r+b') as f:
+                f.seek(50000)
+                f.write(b'changed')
+    # written through the link, and the file keeps its owner and mode
+    assert os.readlink(f'{tmp_path}/link') == 'data'
+    with open(path, 'rb') as f:
+        assert f.read() == data[:50000] + b'changed' + data[50007:]
+    st = os.stat(path)
+    assert (st.st_uid, st.st_gid) == (owner.st_uid, owner.st_gid)
+    assert st.st_mode & 0o777 == 0o640
+    assert sorted(os.listdir(tmp_path)) == ['data', 'link']
+
+
+@pytest.mark.asyncio
+async def test_open(tmp_path):
+    path = f'{tmp_path}/data'
+    async with new_local_pool() as pool:
+        client = await pool.get_client('local')
+        async with client.open(path, 'w', buffer_size=4) as f:
+            for i in range(10):
+                await f.write(f'line {i}\n')
+        async with client.open(path, 'a') as f:
+            await f.write('end')
+
+        async with client.open(path, buffer_size=4) as f:
+            lines = [line async for line in f]
+            assert lines == [f'line {i}\n' for i in range(10)] + ['end']
+            await f.seek(-3, os.SEEK_END)
+            assert await f.read() == 'end'
+            await f.seek(7)
+            assert await f.read(6) == 'line 1'
+            assert f.tell() == 13
+
+        async with client.open(path, 'r+b') as f:
+            await f.seek(5)
+            await f.write(b'X')
+            await f.seek(0)
+            assert await f.readline() == b'line X\n'
+
+
+@pytest.mark.asyncio
+async def test_provision_keys(tmp_path, monkeypatch):
+    from pilot.client.connector import expect as pexp
+
+    # stands for expect, which logs in and bridges the shell of the host
+    fake_expect = tmp_path / 'expect'
+    fake_expect.write_text('''#!/bin/sh
+echo __pilot_expect_password
+read password
+[ "$password" = secret ] || exit 1
+echo __pilot_expect_ready
+exec /bin/sh 2>&1
+''')
+    fake_expect.chmod(0o755)
+    monkeypatch.setattr(pexp, '_expect_path', str(fake_expect))
+    monkeypatch.setattr(pexp, '_remote_expect_path',
+                        str(tmp_path / 'session.exp'))
+    monkeypatch.setattr(pexp, '_expect_envs', {})
+    monkeypatch.setenv('HOME', str(tmp_path))
+    pub_key_path = tmp_path / 'id_rsa.pub'
+    pub_key_path.write_text('ssh-rsa AAAA pilot@test\n')
+
+    def spec(password):
+        return pspec.ClientSpec(
+            force_client_type=pclient.AsyncsshClient,
+            enter_info=pconn.LoginSSHInfo(host='h',
+                                          username='u',
+                                          password=password),
+            connect_settings=[
+                pspec.ConnectSetting(name='ssh',
+                                     force_connect_agent=pconn.AsyncsshAgent)
+            ])
+
+    clients = {'a': spec('secret'), 'b': spec('secret'), 'c': spec('wrong')}
+    async with pclient.ClientCachedPool(clients) as pool:
+        results = await pool.provision_keys(['a', 'b', 'c'],
+                                            pub_key_path=str(pub_key_path),
+                                            concurrency=1)
+    assert [res.key for res in results] == ['a', 'b', 'c']
+    assert results[0].success and results[1].success
+    # both are localhost here, the key is there for the second one
+    assert [results[0].value, results[1].value] == [True, False]
+    assert isinstance(results[2].error, ConnectionError)
+    auth_path = tmp_path / '.ssh' / 'authorized_keys'
+    assert auth_path.read_text() == 'ssh-rsa AAAA pilot@test\n'
+    assert oct(auth_path.stat().st_mode & 0o777) == '0o600'
+
+
+@pytest.mark.asyncio
+async def test_jump_host():
+    import asyncio
+    import asyncssh
+
+    logins = []
+
+    # both the bastion and hosts behind it, which are told by username
+    class Server(asyncssh.SSHServer):
+        def begin_auth(self, username):
+            logins.append(username)
+            return True
+
+        def password_auth_supported(self):
+            return True
+
+        def validate_password(self, username, password):
+            return True
+
+        def connection_requested(self, dest_host, dest_port, orig_host,
+                                 orig_port):
+            return True
+
+    def handle(process):
+        process.stdout.write(f'{process.get_extra_info("username")}\n')
+        process.exit(0)
+
+    server = await asyncssh.create_server(
+        Server,
+        '127.0.0.1',
+        0,
+        server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')],
+        process_factory=handle)
+    port = server.sockets[0].getsockname()[1]
+    jump_host = pconn.LoginSSHInfo(host='127.0.0.1',
+                                   username='bastion',
+                                   port=port,
+                                   password='x')
+
+    def spec(name):
+        return pspec.ClientSpec(
+            force_client_type=pclient.AsyncsshClient,
+            enter_info=pconn.LoginSSHInfo(host='127.0.0.1',
+                                          username=name,
+                                          port=port,
+                                          password='x'),
+            connect_settings=[
+                pspec.ConnectSetting(name='ssh',
+                                     force_connect_agent=pconn.AsyncsshAgent,
+                                     jump_host=jump_host,
+                                     jump_kwargs={'max_tunnel_opens': 2})
+            ])
+
+    names = [f'host{i}' for i in range(6)]
+    try:
+        async with pclient.ClientCachedPool(
+            {name: spec(name)
+             for name in names}) as pool:
+            clients = [await pool.get_client(name) for name in names]
+            results = await asyncio.gather(*[c.run('whoami') for c in clients])
+            assert [res.stdout.strip() for res in results] == names
+    finally:
+        server.close()
+        await server.wait_closed()
+    # one handshake of the bastion, which all hosts tunnel over
+    assert logins.count('bastion') == 1
+    assert sorted(name for name in logins if name != 'bastion') == names
+
+
+@pytest.mark.asyncio
+async def test_jump_host_reconnect():
+    import asyncio
+    import asyncssh
+
+    logins = []
+    bastions = []
+
+    class Server(asyncssh.SSHServer):
+        def connection_made(self, conn):
+            self._conn = conn
+
+        def begin_auth(self, username):
+            logins.append(username)
+            if username == 'bastion':
+                bastions.append(self._conn)
+            return True
+
+        def password_auth_supported(self):
+            return True
+
+        def validate_password(self, username, password):
+            return True
+
+        def connection_requested(self, dest_host, dest_port, orig_host,
+                                 orig_port):
+            return True
+
+    def handle(process):
+        process.stdout.write(f'{process.get_extra_info("username")}\n')
+        process.exit(0)
+
+    server = await asyncssh.create_server(
+        Server,
+        '127.0.0.1',
+        0,
+        server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')],
+        process_factory=handle)
+    port = server.sockets[0].getsockname()[1]
+    jump_host = pconn.LoginSSHInfo(host='127.0.0.1',
+                                   username='bastion',
+                                   port=port,
+                                   password='x')
+    spec = pspec.ClientSpec(force_client_type=pclient.AsyncsshClient,
+                            enter_info=pconn.LoginSSHInfo(host='127.0.0.1',
+                                                          username='host',
+                                                          port=port,
+                                                          password='x'),
+                            connect_settings=[
+                                pspec.ConnectSetting(
+                                    name='ssh',
+                                    force_connect_agent=pconn.AsyncsshAgent,
+                                    jump_host=jump_host)
+                            ])
+    try:
+        async with pclient.ClientCachedPool({'host': spec}) as pool:
+            client = await pool.get_client('host')
+            assert (await client.run('whoami')).stdout == 'host\n'
+            # the bastion drops, and the host behind it with it
+            bastions[0].close()
+            await asyncio.sleep(0.1)
+            res = await asyncio.wait_for(client.run('whoami'), timeout=5)
+            assert res.stdout == 'host\n'
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert logins.count('bastion') == 2
+
+
+@pytest.mark.asyncio
+async def test_admission_of_spec(monkeypatch):
+    import asyncio
+    from pilot.client.connector import metrics as pmetrics
+
+    registry = pconn.MetricsRegistry()
+    monkeypatch.setattr(pmetrics, 'registry', registry)
+    monkeypatch.setattr(pconn, 'metrics_registry', registry)
+    spec = pspec.ClientSpec(force_client_type=pclient.SubprocessClient,
+                            admission=pspec.AdmissionSetting(max_in_flight=1),
+                            connect_settings=[
+                                pspec.ConnectSetting(
+                                    name='localhost',
+                                    force_connect_agent=pconn.SubprocessAgent)
+                            ])
+    async with pclient.ClientCachedPool({'local': spec}) as pool:
+        client = await pool.get_client('local')
+        conn = await client.connect('localhost')
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(*[conn.run('sleep 0.05') for _ in range(3)])
+        # commands of the host run one by one
+        assert loop.time() - start >= 0.15
+        assert conn.admission.admitted == 4
+    # connect and commands are queued by the admission
+    wait = registry.host('localhost').histograms['admission_wait']
+    assert wait.count == 4
+    assert wait.sum > 0
+
+
+def test_admission_of_spec_by_host():
+    spec = pspec.ClientSpec(
+        force_client_type=pclient.AsyncsshClient,
+        enter_info=pconn.LoginSSHInfo(host='h', username='u'),
+        admission=pspec.AdmissionSetting(max_in_flight=1),
+        connect_settings=[
+            pspec.ConnectSetting(name='local',
+                                 force_connect_agent=pconn.SubprocessAgent),
+            pspec.ConnectSetting(name='ssh',
+                                 force_connect_agent=pconn.AsyncsshAgent),
+            pspec.ConnectSetting(name='ssh2',
+                                 port=2222,
+                                 force_connect_agent=pconn.AsyncsshAgent),
+        ])
+    connector = pclient._PerClientConnector(spec)
+    local, ssh, ssh2 = (connector.admission(setting)
+                        for setting in spec.connect_settings)
+    # settings of one host share its admission, which is observed as it
+    assert ssh is ssh2
+    assert local is not ssh
+    assert ssh._metrics.host == 'h'
+    assert local._metrics.host == 'localhost'
+    assert connector.admission(spec.connect_settings[0]) is local
@@ -0,0 +1,55 @@
+import json
+import math
+import pytest
+
+from pilot.client import connector as pconn
+from pilot.client.connector import metrics as pmetrics
+
+
+def test_histogram():
+    hist = pconn.Histogram([1, 2, 4])
+    for value in [0.5, 1, 3, 3, 10]:
+        hist.observe(value)
+    assert hist.count == 5
+    assert hist.sum == 17.5
+    assert hist.buckets() == [(1, 2), (2, 2), (4, 4), (math.inf, 5)]
+    assert hist.quantile(0.5) == 4
+    assert hist.quantile(1) == math.inf
+
+
+def test_registry_dump():
+    registry = pconn.MetricsRegistry()
+    metrics = registry.host('h"1')
+    metrics.observe('command', 0.2)
+    metrics.count_error('connect')
+    registry.host('h2').observe('command', 20)
+    assert registry.slowest('command', n=1) == [('h2', 30)]
+
+    text = registry.dump_prometheus()
+    assert '# TYPE pilot_command_seconds histogram' in text
+    assert 'pilot_command_seconds_bucket{host="h\\"1",le="0.25"} 1' in text
+    assert 'pilot_command_seconds_count{host="h2"} 1' in text
+    assert 'pilot_errors_total{host="h\\"1",kind="connect"} 1' in text
+    assert 'pilot_in_flight{host="h2"} 0' in text
+
+    dumped = json.loads(registry.dump_json())
+    assert dumped['h"1']['errors'] == {'connect': 1}
+    assert dumped['h2']['histograms']['command']['count'] == 1
+
+
+@pytest.mark.asyncio
+async def test_connection_metrics(monkeypatch):
+    registry = pconn.MetricsRegistry()
+    monkeypatch.setattr(pmetrics, 'registry', registry)
+    async with pconn.SubprocessAgent.connect() as conn:
+        await conn.run('printf 12345')
+        await conn.run_many(['echo 1', 'false'], check=False)
+        with pytest.raises(FileNotFoundError):
+            await conn.run(['/nonexistent/pilot'])
+    metrics = registry.host('localhost')
+    assert metrics.histograms['command'].count == 3
+    assert metrics.histograms['channel_open'].count == 3
+    assert metrics.bytes_in.count == 2
+    assert metrics.bytes_in.sum >= 5
+    assert metrics.in_flight == 0
+    assert metrics.errors == {'command': 1, 'channel_open': 1}
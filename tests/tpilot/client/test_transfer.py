@@ -0,0 +1,161 @@
+import os
+import asyncio
+import pytest
+
+from pilot.client import connector as pconn
+from pilot.client.connector import transfer as ptrans
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def new_transfer(**kwargs):
+    return pconn.Transfer(ptrans.LocalFileSystem(), ptrans.LocalFileSystem(),
+                          **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_transfer_dir(tmp_path):
+    data = os.urandom(10000)
+    write_file(f'{tmp_path}/src/a', data)
+    write_file(f'{tmp_path}/src/sub/b', b'b')
+    write_file(f'{tmp_path}/src/empty', b'')
+    os.chmod(f'{tmp_path}/src/a', 0o755)
+
+    stat = await new_transfer(block_size=1000,
+                              max_requests=3).copy(f'{tmp_path}/src',
+                                                   f'{tmp_path}/dst')
+    assert read_file(f'{tmp_path}/dst/a') == data
+    assert read_file(f'{tmp_path}/dst/sub/b') == b'b'
+    assert read_file(f'{tmp_path}/dst/empty') == b''
+    assert os.stat(f'{tmp_path}/dst/a').st_mode & 0o777 == 0o755
+    assert stat.files == 3 and stat.bytes == 10001
+    assert not any(
+        name.endswith('.pilot-part') for name in os.listdir(f'{tmp_path}/dst'))
+
+    # copy into an existing directory
+    await new_transfer().copy(f'{tmp_path}/src/a', f'{tmp_path}/dst/sub')
+    assert read_file(f'{tmp_path}/dst/sub/a') == data
+
+
+@pytest.mark.asyncio
+async def test_transfer_resume(tmp_path):
+    data = os.urandom(10000)
+    write_file(f'{tmp_path}/src', data)
+    part = data[:5000] + b'\0' * 1000 + data[6000:7000]
+    src_stat = await ptrans.LocalFileSystem().stat(f'{tmp_path}/src')
+    # blocks after the first 5000 bytes may be lost by out of order writes
+    write_file(f'{tmp_path}/dst.pilot-part', part)
+    write_file(f'{tmp_path}/dst.pilot-part.src', ptrans._source_tag(src_stat))
+
+    stat = await new_transfer(block_size=1000,
+                              max_requests=2).copy(f'{tmp_path}/src',
+                                                   f'{tmp_path}/dst')
+    assert read_file(f'{tmp_path}/dst') == data
+    assert stat.resumed_bytes == 5000
+    assert stat.bytes == 5000
+    assert not os.path.exists(f'{tmp_path}/dst.pilot-part')
+    assert not os.path.exists(f'{tmp_path}/dst.pilot-part.src')
+
+    # the source is changed since the partial file is copied
+    write_file(f'{tmp_path}/dst.pilot-part', part)
+    write_file(f'{tmp_path}/dst.pilot-part.src', ptrans._source_tag(src_stat))
+    os.utime(f'{tmp_path}/src', (0, src_stat.mtime + 1))
+    stat = await new_transfer(block_size=1000,
+                              max_requests=2).copy(f'{tmp_path}/src',
+                                                   f'{tmp_path}/dst')
+    assert read_file(f'{tmp_path}/dst') == data
+    assert stat.resumed_bytes == 0
+    assert stat.bytes == 10000
+
+
+@pytest.mark.asyncio
+async def test_scp_options(tmp_path):
+    write_file(f'{tmp_path}/src/a', b'a' * 3000)
+    write_file(f'{tmp_path}/src/b', b'b')
+    os.utime(f'{tmp_path}/src/a', (1000, 2000))
+    progress = []
+
+    # the keyword arguments of asyncssh.scp
+    await pconn.scp(f'{tmp_path}/src/a',
+                    f'{tmp_path}/a',
+                    preserve=True,
+                    block_size=1000,
+                    progress_handler=lambda *args: progress.append(args))
+    assert read_file(f'{tmp_path}/a') == b'a' * 3000
+    assert os.stat(f'{tmp_path}/a').st_mtime == 2000
+    assert progress[-1] == (f'{tmp_path}/src/a'.encode(),
+                            f'{tmp_path}/a'.encode(), 3000, 3000)
+
+    with pytest.raises(IsADirectoryError):
+        await pconn.scp(f'{tmp_path}/src', f'{tmp_path}/dst', recurse=False)
+
+    # b cannot replace a directory
+    write_file(f'{tmp_path}/dst/src/b/c', b'c')
+    errors = []
+    stat = await pconn.scp(f'{tmp_path}/src',
+                           f'{tmp_path}/dst',
+                           recurse=True,
+                           error_handler=errors.append)
+    assert stat.files == 1
+    assert len(errors) == 1 and isinstance(errors[0], OSError)
+
+
+@pytest.mark.asyncio
+async def test_transfer_symlinks(tmp_path):
+    write_file(f'{tmp_path}/src/a', b'a')
+    write_file(f'{tmp_path}/src/sub/b', b'b')
+    os.symlink('a', f'{tmp_path}/src/link')
+    # a link back to a parent is not followed
+    os.symlink('..', f'{tmp_path}/src/sub/up')
+
+    stat = await asyncio.wait_for(new_transfer(max_files=2).copy(
+        f'{tmp_path}/src', f'{tmp_path}/dst'),
+                                  timeout=5)
+    assert stat.files == 4
+    assert os.readlink(f'{tmp_path}/dst/link') == 'a'
+    assert os.readlink(f'{tmp_path}/dst/sub/up') == '..'
+    assert read_file(f'{tmp_path}/dst/sub/b') == b'b'
+
+
+@pytest.mark.asyncio
+async def test_transfer_existing_destination(tmp_path):
+    write_file(f'{tmp_path}/src', b'new')
+    write_file(f'{tmp_path}/target', b'old')
+    os.chmod(f'{tmp_path}/target', 0o600)
+    os.symlink('target', f'{tmp_path}/link')
+    os.link(f'{tmp_path}/target', f'{tmp_path}/hard')
+    write_file(f'{tmp_path}/owned', b'old')
+    if os.geteuid() == 0:
+        os.chown(f'{tmp_path}/owned', 1234, 1234)
+
+    # written through the symlink, and the hardlink sees it
+    await new_transfer().copy(f'{tmp_path}/src', f'{tmp_path}/link')
+    assert os.readlink(f'{tmp_path}/link') == 'target'
+    assert read_file(f'{tmp_path}/target') == b'new'
+    assert read_file(f'{tmp_path}/hard') == b'new'
+    assert os.stat(f'{tmp_path}/target').st_mode & 0o777 == 0o600
+
+    owned = os.stat(f'{tmp_path}/owned')
+    await new_transfer().copy(f'{tmp_path}/src', f'{tmp_path}/owned')
+    st = os.stat(f'{tmp_path}/owned')
+    assert read_file(f'{tmp_path}/owned') == b'new'
+    assert (st.st_uid, st.st_gid) == (owned.st_uid, owned.st_gid)
+
+    # a plain file behind a symlink is replaced, not the symlink
+    os.symlink('owned', f'{tmp_path}/link2')
+    write_file(f'{tmp_path}/src', b'newer')
+    await new_transfer().copy(f'{tmp_path}/src', f'{tmp_path}/link2')
+    assert os.readlink(f'{tmp_path}/link2') == 'owned'
+    assert read_file(f'{tmp_path}/owned') == b'newer'
+    assert sorted(os.listdir(tmp_path)) == [
+        'hard', 'link', 'link2', 'owned', 'src', 'target'
+    ]
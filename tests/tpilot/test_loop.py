@@ -63,3 +63,47 @@ async def test_tg_start_task(urulogs):
         'INFO:tests.tpilot.test_loop:1 return 1',
         'INFO:tests.tpilot.test_loop:2 return 2',
     ]
+
+
+@pytest.mark.asyncio
+async def test_fan_out_concurrency_and_errors():
+    running = 0
+    max_running = 0
+
+    async def func(key):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01 * (key % 3))
+        running -= 1
+        if key == 3:
+            raise ValueError(key)
+        return key * 2
+
+    fan_out = ploop.FanOut(range(10), func, concurrency=4)
+    results = await fan_out.collect()
+    assert max_running == 4
+    assert fan_out.finished == 10
+    assert fan_out.failed == 1
+    assert {
+        res.key: res.value
+        for res in results if res.success
+    } == {
+        key: key * 2
+        for key in range(10) if key != 3
+    }
+    failed = [res for res in results if not res.success]
+    assert len(failed) == 1 and isinstance(failed[0].error, ValueError)
+
+
+@pytest.mark.asyncio
+async def test_fan_out_yield_when_finished():
+    async def func(key):
+        await asyncio.sleep(key)
+        return key
+
+    keys = [
+        res.key
+        async for res in ploop.FanOut([0.03, 0.01, 0.02], func, concurrency=3)
+    ]
+    assert keys == [0.01, 0.02, 0.03]
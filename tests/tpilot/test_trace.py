@@ -0,0 +1,95 @@
+import asyncio
+import json
+import pytest
+
+from pilot import trace as ptrace
+from pilot.client import connector as pconn
+from pilot.client import core as pclient
+from pilot.client import obj as pobj
+from pilot.client import mock as pmock
+
+
+def _load_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.asyncio
+async def test_span_follows_tasks(tmp_path):
+    path = tmp_path / 'trace.jsonl'
+
+    async def child(name):
+        with ptrace.span(name):
+            await asyncio.sleep(0.01)
+
+    assert ptrace.enabled() is False
+    with ptrace.span('disabled') as span:
+        assert span is None
+    with ptrace.tracing(str(path), format='jsonl'):
+        with ptrace.span('root', key='v') as root:
+            await asyncio.gather(child('a'), child('b'))
+        with pytest.raises(ValueError):
+            with ptrace.span('failed'):
+                raise ValueError('boom')
+    assert ptrace.enabled() is False
+
+    spans = {s['name']: s for s in _load_jsonl(path)}
+    assert set(spans) == {'root', 'a', 'b', 'failed'}
+    assert spans['root']['parent_id'] is None
+    assert spans['root']['key'] == 'v'
+    assert spans['a']['parent_id'] == root.span_id
+    assert spans['b']['parent_id'] == root.span_id
+    # gathered children run in their own tasks
+    assert spans['a']['task'] != spans['b']['task']
+    assert spans['a']['duration'] <= spans['root']['duration']
+    assert spans['failed']['error'] == 'ValueError: boom'
+
+
+@pytest.mark.asyncio
+async def test_chrome_trace(tmp_path):
+    path = tmp_path / 'trace.json'
+    with ptrace.tracing(str(path)) as exporter:
+        async with pconn.SubprocessAgent.connect() as conn:
+            await conn.run('echo 1')
+    assert exporter.count == 2
+
+    with open(path) as f:
+        events = json.load(f)
+    assert [e['name'] for e in events] == ['connect', 'run']
+    assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in events)
+    assert events[0]['args']['agent'] == 'SubprocessAgent'
+    assert events[1]['args']['exit_status'] == 0
+
+
+@pytest.mark.asyncio
+async def test_cached_info_spans(tmp_path):
+    class CachedDataInfo(pobj.CachedInfoGroupEntry):
+        @pobj.cached_info_property()
+        async def keys(self):
+            return await self.owner.run()
+
+    class ClientForTest(pclient.Client):
+        info = CachedDataInfo.as_property()
+
+        async def run(self, *args, **kwargs):
+            conn = await self.connect('test')
+            return await conn.run(*args, **kwargs)
+
+    path = tmp_path / 'trace.jsonl'
+    async with pmock.mock_client_run(ClientForTest) as it:
+        it.mock_run.return_value = ['a']
+        with ptrace.tracing(str(path), format='jsonl'):
+            assert await it.client.info.keys == ['a']
+            assert await it.client.info.keys == ['a']
+
+    spans = _load_jsonl(path)
+    infos = [s for s in spans if s['name'] == 'cached_info']
+    assert len(infos) == 2
+    assert infos[1]['hit'] is True
+    by_parent = {}
+    for s in spans:
+        by_parent.setdefault(s['parent_id'], []).append(s['name'])
+    assert by_parent[infos[0]['span_id']] == [
+        'cached_info.lock', 'cached_info.load'
+    ]
+    assert by_parent[infos[1]['span_id']] == ['cached_info.lock']